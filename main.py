@@ -1,390 +1,338 @@
-# from pathlib import Path
-# from google import genai
-# from google.genai import types
-# from PIL import Image, ImageDraw, ImageFont
-# import os
-# import json
-# from pydantic import BaseModel
-# import cv2
-# import yt_dlp
-# import tempfile
-# import re
-
-# class VideoResponseFormat(BaseModel):
-#     description: str
-#     dark_pattern_type: str
-#     confidence: int
-#     bounding_box: list
-#     timestamp: str
-
-# class ImageResponseFormat(BaseModel):
-#     description: str
-#     dark_pattern_type: str
-#     confidence: int
-#     bounding_box: list
-
-# def download_youtube_video(url, output_path=None):
-#     """Download YouTube video to a temporary file."""
-#     if output_path is None:
-#         output_path = tempfile.mktemp(suffix='.mp4')
-    
-#     ydl_opts = {
-#         'format': 'best[height<=720]',  # Limit to 720p for faster processing
-#         'outtmpl': output_path,
-#     }
-    
-#     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-#         ydl.download([url])
-    
-#     # Check if file was actually created
-#     if not os.path.exists(output_path):
-#         raise FileNotFoundError(f"Video download failed - file not found at {output_path}")
-    
-#     return output_path
-
-# def timestamp_to_seconds(timestamp):
-#     """Convert timestamp string (HH:MM:SS) to seconds."""
-#     parts = timestamp.split(':')
-#     if len(parts) == 3:
-#         hours, minutes, seconds = map(int, parts)
-#         return hours * 3600 + minutes * 60 + seconds
-#     elif len(parts) == 2:
-#         minutes, seconds = map(int, parts)
-#         return minutes * 60 + seconds
-#     else:
-#         return int(parts[0])
-
-# def extract_frame_at_timestamp(video_path, timestamp, output_path=None):
-#     """Extract a frame from video at the specified timestamp."""
-#     cap = cv2.VideoCapture(video_path)
-    
-#     if not cap.isOpened():
-#         raise ValueError(f"Could not open video file: {video_path}")
-    
-#     # Get video properties
-#     fps = cap.get(cv2.CAP_PROP_FPS)
-#     frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
-#     duration = frame_count / fps if fps > 0 else 0
-    
-#     # Convert timestamp to seconds
-#     seconds = timestamp_to_seconds(timestamp)
-    
-#     # Set video position to the timestamp
-#     cap.set(cv2.CAP_PROP_POS_MSEC, seconds * 1000)
-    
-#     # Read the frame
-#     ret, frame = cap.read()
-#     cap.release()
-    
-#     if not ret:
-#         raise ValueError(f"Could not extract frame at timestamp {timestamp}")
-    
-#     # Convert BGR to RGB
-#     frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-    
-#     # Convert to PIL Image
-#     pil_image = Image.fromarray(frame_rgb)
-    
-#     # Save if output path is provided
-#     if output_path:
-#         pil_image.save(output_path)
-    
-#     return pil_image
-
-# def analyze_youtube_video(video_url):
-#     video_prompt = """
-#     You are a video analysis AI. The user wants to detect and track instances of the following target object in a video:
-
-#     Target object: Dark Patterns  
-#     Types of Dark Patterns you may encounter:
-#     1. Comparison Prevention
-#     2. Confirmation Shaming
-#     3. Disguised Ads
-#     4. Fake Scarcity
-#     5. Fake Social Proof
-#     6. Fake Urgency
-#     7. Forced Action
-#     8. Hard to Cancel
-#     9. Hidden Costs
-#     10. Hidden Subscription
-#     11. Nagging
-#     12. Obstruction
-#     13. Preselection
-#     14. Sneaking
-#     15. Trick Wording
-#     16. Visual Interference
-
-#     Your Tasks:
-#     1. Detect instances of dark patterns in the video.
-#     2. For each detection event, report **individually** — one event per object instance.
-#     - Do not group multiple detections into one entry.
-#     3. For each detection, include:
-#     - Estimated timestamp (e.g., "00:00:07")
-#     - The dark pattern type identified
-#     - A short description of how and where it appears
-#     - A bounding box in `[y_min, x_min, y_max, x_max]` format
-#         - Coordinates must be **normalized to a 720p resolution** (1280x720)
-#         - Origin `(0,0)` is the top-left corner of the image
-#     - Confidence level (0–100 scale)
-
-#     4. Output your results as a **JSON array**, where each element corresponds to **one detection event**, with the following fields:
-#     - `"description": str`
-#     - `"dark_pattern_type": str`
-#     - `"confidence": int`
-#     - `"bounding_box": list`
-#     - `"timestamp": str`
-
-#     Example JSON output:
-#     [
-#         {
-#             "description": "A disguised ad appears as part of the product recommendation carousel.",
-#             "dark_pattern_type": "Disguised Ads",
-#             "confidence": 87,
-#             "bounding_box": [0.15, 0.30, 0.25, 0.50],
-#             "timestamp": "00:00:07"
-#         },
-#         {
-#             "description": "Fake scarcity message shown below the product image.",
-#             "dark_pattern_type": "Fake Scarcity",
-#             "confidence": 91,
-#             "bounding_box": [0.40, 0.60, 0.45, 0.75],
-#             "timestamp": "00:00:12"
-#         }
-#     ]
-
-#     Important:
-#     - Ensure each detection is **reported separately** in the array.
-#     - Follow the JSON format strictly.
-#     - Keep bounding box values normalized to 720p.
-#     """
-
-#     # # Download the video
-#     # print(f"Downloading video from {video_url}...")
-#     # video_path = download_youtube_video(video_url)
-
-#     client = genai.Client()
-#     response = client.models.generate_content(
-#         model='models/gemini-2.5-flash',
-#         contents=types.Content(
-#             parts=[
-#                 types.Part(
-#                     file_data=types.FileData(file_uri=video_url)
-#                 ),
-#                 types.Part(text=video_prompt)
-#             ]
-#         )
-#     )
-#     # my_dark_patterns: list[VideoResponseFormat] = response.parsed
-#     print(response.text)
-
-#     # # Extract frames and draw bounding boxes for each detected pattern
-#     # for pattern in my_dark_patterns:
-#     #     try:
-#     #         # Extract frame at the timestamp
-#     #         frame = extract_frame_at_timestamp(video_path, pattern.timestamp)
-            
-#     #         # Save frame to temporary file
-#     #         temp_frame_path = tempfile.mktemp(suffix='.png')
-#     #         frame.save(temp_frame_path)
-            
-#     #         # Draw bounding box on the frame
-#     #         img_with_box = draw_bounding_box(
-#     #             image_path=temp_frame_path,
-#     #             bounding_box=pattern.bounding_box,
-#     #             label=pattern.dark_pattern_type,
-#     #             confidence=pattern.confidence
-#     #         )
-            
-#     #         # Save the frame with bounding box
-#     #         safe_pattern_type = ''.join(c for c in pattern.dark_pattern_type if c.isalnum() or c in '-_')
-#     #         safe_timestamp = pattern.timestamp.replace(':', '-')
-#     #         filename = f'video_frame_{safe_timestamp}_{safe_pattern_type}.png'
-#     #         save_image_to_output(img_with_box, filename)
-#     #         print(f'Saved frame with bounding box: {filename}')
-            
-#     #         # Clean up temporary frame file
-#     #         try:
-#     #             os.remove(temp_frame_path)
-#     #         except:
-#     #             pass
-                
-#     #     except Exception as e:
-#     #         print(f"Failed to process frame at {pattern.timestamp}: {str(e)}")
-
-#     # # Clean up the downloaded video
-#     # try:
-#     #     os.remove(video_path)
-#     # except:
-#     #     pass
-
-# # def analyze_video(object_description, video_path):
-# #     video_prompt = """
-# #     You are a video analysis AI. The user wants to locate and track the object described below:
-
-# #     Target object: "{object_description}"
-
-# #     Tasks:
-# #     1. Find the object in the video and summarize where and how it appears.
-# #     2. Track the object through time and identify 3–7 key events. For each event:
-# #         - Provide an estimated timestamp (e.g., "00:00:07")
-# #         - Describe what the object is doing
-# #         - Include a bounding box in y_min, x_min, y_max, x_max format with a label and confidence level
-# #         - Coordinates must be normalized to a 0–1000 scale
-# #         - Origin is the top-left of the image
-# #     """
-
-# #     client = genai.Client()
-# #     response = client.models.generate_content(
-# #         model='models/gemini-2.5-flash',
-# #         contents=types.Content(
-# #             parts=[
-# #                 types.Part(
-# #                     file_data=types.FileData(file_uri='https://www.youtube.com/watch?v=T3qH-uY3t-Y&ab_channel=monday.com')
-# #                 ),
-# #                 types.Part(text=video_prompt.format(object_description=object_description))
-# #             ]
-# #         )
-# #     )
-# #     print(response.text)
-
-
-# def analyze_image(image_path):
-#     text_prompt = """
-#     You are an image analysis AI. The user wants to analyze the following:
-
-#     Target object: Dark Patterns
-#     Type of Dark Patterns:
-#     1. Comparison Prevention
-#     2. Confirmation Shaming
-#     3. Disguised Ads
-#     4. Fake scarcity
-#     5. Fake social proof
-#     6. Fake urgency
-#     7. Forced action
-#     8. Hard to cancel
-#     9. Hidden costs
-#     10. Hidden subscription
-#     11. Nagging
-#     12. Obstruction
-#     13. Preselection
-#     14. Sneaking
-#     15. Trick Wording
-#     16. Visual interference
-
-#     Tasks:
-#     1. Find the object in the image and summarize where and how it appears.
-#     2. Describe what the object is doing in detail.
-#     3. Return your answer as a JSON object with the following fields:
-#         description: str
-#         dark_pattern_type: str
-#         confidence: int
-#         bounding_box: list
-#     Notes:
-#     - The bounding box must be in y_min, x_min, y_max, x_max format, normalized to a 0–1000 scale.
-#     - The origin is the top-left of the image.
-#     """
-
-#     client = genai.Client()
-#     with open(image_path, 'rb') as f:
-#         image_bytes = f.read()
-
-#     response = client.models.generate_content(
-#         model='gemini-2.5-flash',
-#         contents=[
-#             types.Part.from_bytes(
-#                 data=image_bytes,
-#                 mime_type='image/png'
-#             ),
-#             types.Part(text=text_prompt)
-#         ],
-#         config={
-#             "response_mime_type": "application/json",
-#             "response_schema": list[ImageResponseFormat]
-#         }
-#     )
-
-#     # Try to parse the JSON from the response
-#     try:
-#         my_dark_patterns: list[ImageResponseFormat] = response.parsed
-#         for tmp_result in my_dark_patterns:
-#             img = draw_bounding_box(
-#                 image_path=image_path,
-#                 bounding_box=tmp_result.bounding_box,
-#                 label=tmp_result.dark_pattern_type,
-#                 confidence=tmp_result.confidence
-#             )
-#             # Remove special characters from dark_pattern_type to ensure valid filename
-#             safe_pattern_type = ''.join(c for c in tmp_result.dark_pattern_type if c.isalnum() or c in '-_')
-#             filename = f'{Path(image_path).stem}_{safe_pattern_type}.png'
-#             save_image_to_output(img, filename)
-#             print(f'Saved image to {filename}')
-#     except Exception as e:
-#         print("Failed to parse JSON or draw bounding box:", e)
-
-# def draw_bounding_box(image_path, bounding_box, label, confidence):
-#     """
-#     Draws a bounding box with label and confidence on the image.
-#     Args:
-#         image_path (str): Path to the input image.
-#         bounding_box (list): [y_min, x_min, y_max, x_max] in 0-1000 scale.
-#         label (str): Label for the bounding box.
-#         confidence (float): Confidence value (0-100).
-#     Returns:
-#         Image object with bounding box drawn.
-#     """
-#     image = Image.open(image_path).convert('RGB')
-#     draw = ImageDraw.Draw(image)
-#     width, height = image.size
-
-#     # Convert normalized coordinates to pixel values
-#     y_min, x_min, y_max, x_max = bounding_box
-    
-#     y_min = int(y_min / 1000 * height)
-#     y_max = int(y_max / 1000 * height)
-#     x_min = int(x_min / 1000 * width)
-#     x_max = int(x_max / 1000 * width)
-
-#     # Draw rectangle
-#     draw.rectangle((x_min, y_min, x_max, y_max), outline='red', width=3)
-
-#     # Prepare label text
-#     text = f"{label} ({confidence}%)"
-#     try:
-#         font = ImageFont.truetype("arial.ttf", 20)
-#     except:
-#         font = ImageFont.load_default()
-#     # Calculate text size using textbbox for compatibility
-#     text_bbox = draw.textbbox((x_min, y_min), text, font=font)
-#     text_width = text_bbox[2] - text_bbox[0]
-#     text_height = text_bbox[3] - text_bbox[1]
-#     text_bg = (x_min, y_min - text_height, x_min + text_width, y_min)
-#     draw.rectangle(text_bg, fill='red')
-#     draw.text((x_min, y_min - text_height), text, fill='white', font=font)
-
-#     return image
-
-# def save_image_to_output(image, filename):
-#     """
-#     Saves the image to the output folder, creating it if necessary.
-#     Args:
-#         image (PIL.Image): Image object to save.
-#         filename (str): Name of the file to save as.
-#     """
-#     output_dir = 'output'
-#     os.makedirs(output_dir, exist_ok=True)
-#     output_path = os.path.join(output_dir, filename)
-#     image.save(output_path)
-
-
-# if __name__ == '__main__':
-#     analyze_youtube_video('https://www.youtube.com/watch?v=K-j7Ty2rHBc&ab_channel=KevinStratvert')
-#     # analyze_image('reference/comparison-prevention.png')
-
-#     # Process all deceptive_design files in reference directory
-#     # reference_dir = 'reference'
-#     # if os.path.exists(reference_dir):
-#     #     for filename in os.listdir(reference_dir):
-#     #         if filename.startswith('deceptive_design') and filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-#     #             file_path = os.path.join(reference_dir, filename)
-#     #             print(f"Processing {filename}...")
-#     #             analyze_image(file_path)
\ No newline at end of file
+"""
+Detect dark patterns in screenshots, video files and YouTube videos.
+
+Run from the repository root, e.g.:
+    python main.py reference/images
+    python main.py reference/videos/random_sgcarmart-2.mov --start 0s --end 63s --output-mode both
+    python main.py "https://www.youtube.com/watch?v=XEzRZ35urlk" --start 1250s --end 1570s
+    python main.py --manifest jobs.jsonl --concurrency 8 --summary -
+
+Installed in editable mode (uv sync, or pip install -e .), the same CLI
+is also available as `dark-patterns`.
+
+Inputs are image files, video files, directories (their images and videos)
+or URLs. A manifest is a JSONL file with one job per line: an object with
+an "input" and optionally "type" (image, video or youtube) and per-job
+"start", "end", "output_mode", "chunk_seconds", "keyframes_only" and
+"stream", which override the command line.
+
+Rendered images go to <output-dir>/images_mask, and each video's frames
+and annotated video to a folder of its own under <output-dir>. A JSON run
+summary with the outcome and latency of every item is written to
+<output-dir>/run_summary.json (or --summary). With "--summary -" it is the
+only output on stdout and progress goes to stderr. With --metrics,
+per-stage latencies, bytes transferred and tokens used are added to it and
+written to a JSON or Prometheus text file.
+
+Every detection, with its mask as COCO RLE, is also appended to the
+results store in <output-dir>/results (or --results-store), where it can be
+queried, re-rendered and exported without calling the model again:
+    python src/results_store.py query --type "Fake urgency" --min-confidence 80
+    python src/results_store.py render reference/images/deceptive_design_fake_urgency.png
+    python src/results_store.py coco output/coco.json
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+# The analyzers live in src/ and are only imported once a run starts, so
+# --help does not pay for cv2, yt_dlp or google-genai.
+sys.path.insert(0, str(Path(__file__).resolve().parent / 'src'))
+
+IMAGE_SUFFIXES = {'.png', '.jpg', '.jpeg', '.bmp', '.gif', '.webp'}
+VIDEO_SUFFIXES = {'.mp4', '.mov', '.webm', '.mkv', '.avi', '.m4v', '.mpeg', '.mpg', '.wmv', '.flv', '.3gp'}
+JOB_OPTIONS = ('start', 'end', 'output_mode', 'chunk_seconds', 'keyframes_only', 'stream')
+
+def expand_input(value, job_type=None):
+    """Turn one input (file, directory or URL) into jobs of the form {'type': ..., 'input': ...}."""
+    if job_type is None and value.startswith(('http://', 'https://')):
+        job_type = 'youtube'
+    if job_type == 'youtube':
+        return [{'type': 'youtube', 'input': value}]
+
+    path = Path(value)
+    if path.is_dir():
+        return [
+            job for child in sorted(path.iterdir())
+            if child.suffix.lower() in IMAGE_SUFFIXES | VIDEO_SUFFIXES
+            for job in expand_input(str(child))
+        ]
+    if not path.exists():
+        raise ValueError(f"Input not found: {value}")
+    if job_type is None:
+        if path.suffix.lower() in IMAGE_SUFFIXES:
+            job_type = 'image'
+        elif path.suffix.lower() in VIDEO_SUFFIXES:
+            job_type = 'video'
+        else:
+            raise ValueError(f"Cannot tell whether {value} is an image or a video; set its type in a manifest")
+    return [{'type': job_type, 'input': str(path)}]
+
+def read_manifest(path):
+    """Read the jobs of a JSONL manifest."""
+    jobs = []
+    with open(path, 'r') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                options = {key: entry[key] for key in JOB_OPTIONS if key in entry}
+                jobs.extend(dict(job, **options) for job in expand_input(entry['input'], entry.get('type')))
+            except (ValueError, KeyError) as e:
+                raise ValueError(f"{path}:{line_number}: invalid manifest entry: {e}")
+    return jobs
+
+def video_duration_offset(video_path):
+    """Length of a video file as an offset string such as '63s'."""
+    from video_reader import video_reader_pool
+
+    with video_reader_pool.lease(video_path) as reader:
+        if reader.fps <= 0 or reader.frame_count <= 0:
+            raise ValueError(f"Could not read the length of {video_path}; pass --end")
+        return f'{reader.frame_count / reader.fps:g}s'
+
+def store_result(source, add):
+    """Call `add` to store the detections of a finished job; a storage error is reported without failing the job."""
+    try:
+        add()
+    except Exception as e:
+        print(f"Failed to add {source} to the results store: {e}")
+
+def run_video_job(job, args, encoding, store=None, limiter=None, dedupe_index=None):
+    """Analyze one video file or YouTube job and add its detections to `store`; returns the detections."""
+    options = {
+        'structured_output': True,
+        'chunk_seconds': job.get('chunk_seconds', args.chunk_seconds),
+        'chunk_overlap_seconds': args.chunk_overlap_seconds,
+        'max_workers': args.concurrency,
+        'encoding': encoding,
+        'output_mode': job.get('output_mode', args.output_mode),
+        'hold_seconds': args.hold_seconds,
+        'video_max_height': args.video_max_height,
+        'limiter': limiter,
+    }
+    start = job.get('start', args.start)
+    end = job.get('end', args.end)
+
+    # Each video gets its own folder, as frame file names only carry the timestamp
+    if job['type'] == 'youtube':
+        from video_youtube_detection import analyze_youtube_video, video_cache_key
+
+        if end is None:
+            raise ValueError("YouTube jobs need an end offset (--end or \"end\" in the manifest)")
+        output_dir = str(Path(args.output_dir) / f"youtube_{video_cache_key(job['input'])[:12]}")
+        detections = analyze_youtube_video(
+            job['input'], start, end, stream=job.get('stream', args.stream), output_dir=output_dir, **options
+        )
+        if store is not None:
+            from video_frames import offset_to_seconds
+            from video_youtube_detection import VIDEO_CACHE_DIR, download_youtube_video
+
+            def add_to_store():
+                # The analyzed section is in the video cache; timestamps are in source time
+                start_seconds, end_seconds = offset_to_seconds(start), offset_to_seconds(end)
+                clip = download_youtube_video(job['input'], start_seconds=start_seconds, end_seconds=end_seconds, cache_dir=VIDEO_CACHE_DIR)
+                store.add_video_result(job['input'], detections, clip, offset_seconds=start_seconds, kind='youtube')
+
+            store_result(job['input'], add_to_store)
+        return detections
+
+    from video_file_detection import analyze_video
+
+    if end is None:
+        end = video_duration_offset(job['input'])
+    output_dir = str(Path(args.output_dir) / Path(job['input']).stem)
+    detections = analyze_video(
+        job['input'], start, end, keyframes_only=job.get('keyframes_only', args.keyframes_only), output_dir=output_dir,
+        dedupe_index=dedupe_index, **options
+    )
+    if store is not None:
+        store_result(job['input'], lambda: store.add_video_result(job['input'], detections))
+    return detections
+
+def run(args):
+    """Run every job and return the run summary."""
+    jobs = [job for value in args.inputs for job in expand_input(value)]
+    if args.manifest:
+        jobs.extend(read_manifest(args.manifest))
+    if not jobs:
+        raise SystemExit("Nothing to do: pass inputs or --manifest")
+
+    from metrics import metrics
+    from phash_index import PerceptualHashIndex
+    from rate_limiter import RateLimiter
+    from response_cache import response_cache
+    from results_store import ResultsStore
+
+    if args.metrics:
+        metrics.enabled = True
+    if args.no_cache:
+        response_cache.bypass = True
+    if args.cache_dir:
+        response_cache.cache_dir = args.cache_dir
+
+    encoding = None
+    if args.format is not None:
+        from annotation import OutputEncoding
+
+        encoding = OutputEncoding(args.format, png_compress_level=args.png_compress_level, quality=args.quality)
+
+    store = ResultsStore(args.results_store or str(Path(args.output_dir) / 'results'))
+    # One set of quotas for every model request of the run, images and videos alike
+    limiter = RateLimiter(args.requests_per_minute, args.tokens_per_minute)
+    # One perceptual-hash index for images and keyframes alike
+    dedupe_index = PerceptualHashIndex() if args.dedupe else None
+
+    image_jobs = [job for job in jobs if job['type'] == 'image']
+    video_jobs = [job for job in jobs if job['type'] != 'image']
+    items = []
+    started_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    started = time.perf_counter()
+
+    def timed_video_job(job):
+        job_started = time.perf_counter()
+        detections = run_video_job(job, args, encoding, store, limiter, dedupe_index)
+        return len(detections), time.perf_counter() - job_started
+
+    # Videos run on a shared worker pool while the image batch streams through
+    # its own request and render pools in this thread, under the same limits
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        futures = {pool.submit(timed_video_job, job): job for job in video_jobs}
+
+        if image_jobs:
+            from image_detection import analyze_images_concurrently
+
+            results = analyze_images_concurrently(
+                [Path(job['input']) for job in image_jobs],
+                Path(args.output_dir) / 'images_mask',
+                max_concurrency=args.concurrency,
+                limiter=limiter,
+                max_retries=args.max_retries,
+                dedupe_index=dedupe_index,
+                encoding=encoding,
+                mask_workers=args.mask_workers,
+                image_token_budget=args.image_token_budget,
+            )
+            for result in results:
+                item = {'input': str(result.path), 'type': 'image', 'latency_seconds': round(result.latency, 3)}
+                if result.error is not None:
+                    item.update(status='error', error=str(result.error))
+                    print(f"Failed to process {result.path.name}: {result.error}")
+                else:
+                    store_result(result.path, lambda: store.add_image_result(result.path, result.segmentation_masks))
+                    item.update(status='ok', detections=len(result.segmentation_masks), output=str(result.output_path))
+                    print(f"Saved {result.output_path} ({len(result.segmentation_masks)} masks, {result.latency:.1f}s)")
+                items.append(item)
+
+        for future in as_completed(futures):
+            job = futures[future]
+            item = {'input': job['input'], 'type': job['type']}
+            try:
+                detections, latency = future.result()
+                item.update(status='ok', detections=detections, latency_seconds=round(latency, 3))
+            except Exception as e:
+                item.update(status='error', error=str(e))
+                print(f"Failed to process {job['input']}: {e}")
+            items.append(item)
+
+    stats = response_cache.stats
+    summary = {
+        'started_at': started_at,
+        'wall_seconds': round(time.perf_counter() - started, 3),
+        'jobs': len(items),
+        'succeeded': sum(item['status'] == 'ok' for item in items),
+        'failed': sum(item['status'] == 'error' for item in items),
+        'response_cache': {'hits': stats.hits, 'misses': stats.misses, 'hit_rate': round(stats.hit_rate, 3)},
+        'results_store': {'path': store.directory, 'run': store.run, 'detections': len(store.query(run=store.run))},
+        'items': items,
+    }
+    if 'video_reader' in sys.modules:
+        frame_stats = sys.modules['video_reader'].video_reader_pool.stats
+        summary['frame_cache'] = {'hits': frame_stats.hits, 'misses': frame_stats.misses, 'evictions': frame_stats.evictions}
+    if metrics.enabled:
+        summary['metrics'] = metrics.snapshot()
+    if args.coco:
+        store.export_coco(args.coco, store.query(run=store.run))
+    return summary
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='*', help='image or video files, directories or YouTube URLs')
+    parser.add_argument('--manifest', help='JSONL file with one job per line')
+
+    group = parser.add_argument_group('video range')
+    group.add_argument('--start', default='0s', help='start offset of video jobs (default: %(default)s)')
+    group.add_argument('--end', help='end offset of video jobs (default: the end of a video file; required for YouTube)')
+
+    group = parser.add_argument_group('concurrency')
+    group.add_argument('--concurrency', type=int, default=4, help='requests and video jobs in flight (default: %(default)s)')
+    group.add_argument('--requests-per-minute', type=float, help='request quota shared by all jobs')
+    group.add_argument('--tokens-per-minute', type=float, help='input token quota shared by all jobs')
+    group.add_argument('--max-retries', type=int, default=5, help='retries on rate limit and server errors (default: %(default)s)')
+    group.add_argument('--mask-workers', type=int,
+                       help='decode and render image masks in this many processes instead of threads')
+    group.add_argument('--chunk-seconds', type=float, help='analyze video ranges as concurrent windows of this length')
+    group.add_argument('--chunk-overlap-seconds', type=float, default=5, help='overlap between windows (default: %(default)s)')
+
+    group = parser.add_argument_group('caching')
+    group.add_argument('--no-cache', action='store_true', help='always call the model (fresh responses are still cached)')
+    group.add_argument('--cache-dir', help='response cache directory (default: .cache/responses)')
+    group.add_argument('--dedupe', action='store_true', help='reuse detections of near-duplicate images and keyframes (perceptual hash)')
+
+    group = parser.add_argument_group('analysis')
+    group.add_argument('--keyframes-only', action='store_true', help='send scene-change keyframes instead of video files')
+    group.add_argument('--stream', action='store_true', help='stream YouTube detections and annotate each as it arrives')
+    group.add_argument('--image-token-budget', type=int,
+                       help='most image tokens per image request; larger images (and tiles) are sent smaller')
+
+    group = parser.add_argument_group('output')
+    group.add_argument('--output-dir', default='output', help='folder for all outputs (default: %(default)s)')
+    group.add_argument('--output-mode', choices=['frames', 'video', 'both'], default='frames',
+                       help='annotated frames, an annotated video or both, for video jobs (default: %(default)s)')
+    group.add_argument('--format', choices=['png', 'jpeg', 'webp'],
+                       help='image format (default: PNG frames; images keep their source format)')
+    group.add_argument('--quality', type=int, default=90, help='JPEG/WebP quality (default: %(default)s)')
+    group.add_argument('--png-compress-level', type=int, default=6, help='PNG zlib level 0-9 (default: %(default)s)')
+    group.add_argument('--hold-seconds', type=float, default=1.0,
+                       help='how long a detection stays on screen in annotated videos (default: %(default)s)')
+    group.add_argument('--video-max-height', type=int, help='downscale annotated videos to this height')
+    group.add_argument('--metrics',
+                       help='record per-stage latencies, bytes and tokens to this file (Prometheus text for .prom, JSON otherwise)')
+    group.add_argument('--results-store',
+                       help='append-only store the detections and masks are added to (default: <output-dir>/results)')
+    group.add_argument('--coco', help="also export this run's detections to this file as COCO JSON with RLE masks")
+    group.add_argument('--summary', help="path of the JSON run summary, or '-' for stdout (default: <output-dir>/run_summary.json)")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    # With the summary on stdout, progress and model output go to stderr so it stays parseable
+    with contextlib.redirect_stdout(sys.stderr) if args.summary == '-' else contextlib.nullcontext():
+        try:
+            summary = run(args)
+        except ValueError as e:
+            raise SystemExit(f"error: {e}")
+
+    if args.metrics:
+        from metrics import metrics
+
+        metrics.write(args.metrics)
+
+    if args.summary == '-':
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    else:
+        summary_path = Path(args.summary or Path(args.output_dir) / 'run_summary.json')
+        summary_path.parent.mkdir(parents=True, exist_ok=True)
+        summary_path.write_text(json.dumps(summary, indent=2))
+        print(f"Run summary: {summary_path} ({summary['succeeded']} succeeded, {summary['failed']} failed, {summary['wall_seconds']:.1f}s)")
+    return 1 if summary['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
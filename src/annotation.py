@@ -0,0 +1,249 @@
+from PIL import Image, ImageDraw
+import dataclasses
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from metrics import metrics
+from render_resources import DETECTION_COLORS, get_font
+
+@dataclasses.dataclass(frozen=True)
+class OutputEncoding:
+    """
+    How annotated frames are encoded when saved.
+
+    Args:
+        format (str): 'png', 'jpeg' or 'webp'.
+        png_compress_level (int): zlib level 0-9 for PNG; lower is faster and larger.
+        quality (int): Quality 1-100 for JPEG and WebP.
+    """
+    format: str = 'png'
+    png_compress_level: int = 6
+    quality: int = 90
+
+    def __post_init__(self):
+        if self.format not in ('png', 'jpeg', 'webp'):
+            raise ValueError(f"Unsupported output format: {self.format}")
+
+    @property
+    def extension(self) -> str:
+        return '.jpg' if self.format == 'jpeg' else f'.{self.format}'
+
+    def save_kwargs(self) -> dict:
+        """Keyword arguments for `Image.save`."""
+        if self.format == 'png':
+            return {'format': 'PNG', 'compress_level': self.png_compress_level}
+        return {'format': self.format.upper(), 'quality': self.quality}
+
+@metrics.timed('render.boxes')
+def draw_bounding_boxes(image, boxes, colors=DETECTION_COLORS):
+    """
+    Draws several labelled bounding boxes on a copy of the image in one pass.
+    Args:
+        image (PIL.Image | np.ndarray | str): The frame, as a PIL image, an
+            RGB array or a path to an image file.
+        boxes (list[tuple[list, str]]): (bounding box, label) pairs, with
+            boxes as [y_min, x_min, y_max, x_max] in 0-1000 scale.
+        colors (list[str]): Colours given to the boxes in order, cycling.
+    Returns:
+        New RGB Image object with the boxes drawn; the input is left untouched.
+    """
+    if isinstance(image, (str, os.PathLike)):
+        image = Image.open(image)
+    elif not isinstance(image, Image.Image):
+        # An array; checked this way so drawing does not need numpy imported
+        image = Image.fromarray(image)
+    # convert() always returns a copy, so shared or cached frames are never drawn on
+    image = image.convert('RGB')
+    draw = ImageDraw.Draw(image)
+    width, height = image.size
+
+    font = get_font(20)
+
+    # Convert normalized coordinates to pixel values
+    rects = []
+    for (y_min, x_min, y_max, x_max), _ in boxes:
+        rects.append((int(x_min / 1000 * width), int(y_min / 1000 * height), int(x_max / 1000 * width), int(y_max / 1000 * height)))
+
+    # Draw every rectangle before any label, so boxes never cover labels
+    for i, rect in enumerate(rects):
+        draw.rectangle(rect, outline=colors[i % len(colors)], width=3)
+
+    for i, ((x_min, y_min, _, _), (_, label)) in enumerate(zip(rects, boxes)):
+        color = colors[i % len(colors)]
+        text = f"{label}"
+        # Calculate text size using textbbox for compatibility
+        text_bbox = draw.textbbox((x_min, y_min), text, font=font)
+        text_width = text_bbox[2] - text_bbox[0]
+        text_height = text_bbox[3] - text_bbox[1]
+        text_bg = (x_min, y_min - text_height, x_min + text_width, y_min)
+        draw.rectangle(text_bg, fill=color)
+        draw.text((x_min, y_min - text_height), text, fill='white', font=font)
+
+    return image
+
+def draw_bounding_box(image, bounding_box, label):
+    """
+    Draws a bounding box with label on a copy of the image.
+    Args:
+        image (PIL.Image | np.ndarray | str): The frame, as a PIL image, an
+            RGB array or a path to an image file.
+        bounding_box (list): [y_min, x_min, y_max, x_max] in 0-1000 scale.
+        label (str): Label for the bounding box.
+    Returns:
+        New RGB Image object with bounding box drawn; the input is left untouched.
+    """
+    return draw_bounding_boxes(image, [(bounding_box, label)], colors=['red'])
+
+@metrics.timed('encode.image')
+def save_image_to_output(image, filename, output_dir='output', encoding=None):
+    """
+    Saves the image to the output folder, creating it if necessary.
+    Args:
+        image (PIL.Image): Image object to save.
+        filename (str): Name of the file to save as. With an `encoding`, its
+            extension is appended.
+        output_dir (str): Folder to save to.
+        encoding (OutputEncoding): Optional output encoding; otherwise the
+            format follows the file name.
+    Returns:
+        str: Path of the saved file.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if encoding is None:
+        output_path = os.path.join(output_dir, filename)
+        image.save(output_path)
+    else:
+        output_path = os.path.join(output_dir, filename + encoding.extension)
+        if encoding.format == 'jpeg' and image.mode not in ('RGB', 'L'):
+            # JPEG has no alpha channel
+            image = image.convert('RGB')
+        image.save(output_path, **encoding.save_kwargs())
+    return output_path
+
+class FrameWriter:
+    """
+    Encodes and saves images on a thread pool, so drawing the next frame overlaps with writing the last one.
+
+    At most `max_pending` images are queued at once; `submit` blocks beyond
+    that, which keeps memory bounded when encoding is slower than drawing.
+    Use as a context manager to wait for every write on exit.
+
+    Args:
+        output_dir (str): Folder the images are saved to.
+        encoding (OutputEncoding): Output encoding, PNG by default.
+        max_workers (int): Number of writer threads.
+        max_pending (int): Maximum number of queued or in-progress writes.
+    """
+
+    def __init__(self, output_dir='output', encoding=None, max_workers=2, max_pending=16):
+        self.output_dir = output_dir
+        self.encoding = encoding or OutputEncoding()
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def _save(self, image, name, sidecar):
+        output_path = save_image_to_output(image, name, self.output_dir, self.encoding)
+        if sidecar is not None:
+            with open(os.path.join(self.output_dir, f'{name}.json'), 'w') as f:
+                json.dump(sidecar, f, indent=2)
+        return output_path
+
+    def submit(self, image, name, sidecar=None):
+        """
+        Queue `image` to be saved as `name` plus the encoding's extension.
+
+        A `sidecar` dict is written next to it as `name`.json.
+
+        Returns:
+            Future: Resolves to the saved image path.
+        """
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._save, image, name, sidecar)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def close(self):
+        """Wait for every queued write to finish."""
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def frame_filename(prefix, timestamp):
+    """File name (without extension) for the annotated frame at a timestamp."""
+    return f'{prefix}_{timestamp.replace(":", "-")}'
+
+def annotate_frame_detections(frame, items, writer, prefix='video_frame', frame_index=None):
+    """
+    Draws every detection reported on a video frame onto it and queues the result on `writer`.
+
+    The boxes get distinct colours from DETECTION_COLORS. A JSON sidecar with
+    the frame index, timestamp and detections (each with its box colour) is
+    saved alongside the image.
+    Args:
+        frame (PIL.Image | np.ndarray): The video frame.
+        items (list[VideoDetection]): Detections on this frame.
+        writer (FrameWriter): Writer saving the annotated frame.
+        prefix (str): File name prefix.
+        frame_index (int): Index of the frame in the video, if known.
+    Returns:
+        Future: Resolves to the saved image path.
+    """
+    colors = [DETECTION_COLORS[i % len(DETECTION_COLORS)] for i in range(len(items))]
+    img_with_boxes = draw_bounding_boxes(frame, [(item.bounding_box, item.type) for item in items], colors)
+
+    name = frame_filename(prefix, items[0].timestamp)
+    sidecar = {
+        'frame_index': frame_index,
+        'timestamp': items[0].timestamp,
+        'image': name + writer.encoding.extension,
+        'detections': [dict(item.model_dump(), color=color) for item, color in zip(items, colors)],
+    }
+    future = writer.submit(img_with_boxes, name, sidecar)
+
+    def report(future):
+        if future.exception() is not None:
+            print(f"Failed to save frame at {items[0].timestamp}: {future.exception()}")
+        else:
+            print(f'Saved frame with {len(items)} detection(s): {os.path.basename(future.result())}')
+
+    future.add_done_callback(report)
+    return future
+
+def annotate_detection_frames(video_path, items, writer, prefix='video_frame', offset_seconds=0):
+    """
+    Draws the detections of a video onto their frames and queues each frame once on `writer`.
+
+    Every requested frame is decoded once, in a single pass over the video
+    (see `group_detections_by_frame`); detections whose frame cannot be
+    extracted, and frames that fail to draw, are reported and skipped.
+    Args:
+        video_path (str): Path to the video file.
+        items (list[VideoDetection]): Detections, with timestamps in source time.
+        writer (FrameWriter): Writer saving the annotated frames.
+        prefix (str): File name prefix.
+        offset_seconds (float): Source time of the file's first frame, for
+            clips cut out of a longer video.
+    """
+    from video_frames import group_detections_by_frame
+
+    groups = group_detections_by_frame(video_path, items, offset_seconds=offset_seconds)
+    grouped = {id(item) for _, _, group in groups for item in group}
+    for item in items:
+        if id(item) not in grouped:
+            print(f"Failed to process frame at {item.timestamp}: Could not extract frame at timestamp {item.timestamp}")
+
+    # Draw all detections of a frame together in memory; the writer saves them in the background
+    for frame_index, frame, group in groups:
+        try:
+            annotate_frame_detections(frame, group, writer, prefix=prefix, frame_index=frame_index)
+        except Exception as e:
+            print(f"Failed to process frame at {group[0].timestamp}: {str(e)}")
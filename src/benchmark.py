@@ -0,0 +1,439 @@
+"""
+Offline micro-benchmarks for the CPU-side hot paths.
+
+Run from the repository root, e.g.:
+    python src/benchmark.py compositing
+    python src/benchmark.py annotation
+    python src/benchmark.py video-render --sizes 720 1080
+    python src/benchmark.py imports
+    python src/benchmark.py mask-decode --mask-counts 10 20 50
+    python src/benchmark.py mask-workers --workers 1 2 4 8
+    python src/benchmark.py metrics
+    python src/benchmark.py pipeline --latency 2 --jitter 1
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+from PIL import Image
+
+def _best_of(fn, repeats):
+    """Return the fastest of `repeats` timed runs of `fn`, in milliseconds."""
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+def _random_masks(width, height, count, rng):
+    from image_detection import SegmentationMask
+
+    masks = []
+    for _ in range(count):
+        box_w = int(rng.integers(width // 10, width // 3))
+        box_h = int(rng.integers(height // 10, height // 3))
+        x0 = int(rng.integers(0, width - box_w))
+        y0 = int(rng.integers(0, height - box_h))
+        crop = rng.integers(0, 256, (box_h, box_w), dtype=np.uint8)
+        masks.append(SegmentationMask(y0, x0, y0 + box_h, x0 + box_w, crop, 'label', (width, height)))
+    return masks
+
+def bench_compositing(args):
+    """Per-mask `overlay_mask_on_img` loop against single-pass `composite_masks`."""
+    from image_detection import overlay_mask_on_img, composite_masks
+
+    colors = ['red', 'green', 'blue', 'yellow', 'orange', 'pink', 'purple', 'brown']
+    rng = np.random.default_rng(0)
+
+    print(f"{'size':>10} {'masks':>6} {'per-mask ms':>12} {'single-pass ms':>15} {'speedup':>8}")
+    for size in args.sizes:
+        img = Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8))
+        for count in args.mask_counts:
+            masks = _random_masks(size, size, count, rng)
+            full_masks = [mask.full_mask() for mask in masks]
+
+            def per_mask():
+                out = img
+                for i, mask in enumerate(full_masks):
+                    out = overlay_mask_on_img(out, mask, colors[i % len(colors)])
+                return out
+
+            def single_pass():
+                return composite_masks(img, masks, colors)
+
+            before = _best_of(per_mask, args.repeats)
+            after = _best_of(single_pass, args.repeats)
+            print(f"{size:>5}x{size:<4} {count:>6} {before:>12.1f} {after:>15.1f} {before / after:>7.1f}x")
+
+def bench_annotation(args):
+    """Drawing labelled boxes with a font load per box against the cached fonts of `render_resources`."""
+    from PIL import ImageDraw, ImageFont
+    from annotation import draw_bounding_boxes
+
+    rng = np.random.default_rng(0)
+
+    def random_boxes(count):
+        boxes = []
+        for _ in range(count):
+            y_min, x_min = (int(v) for v in rng.integers(50, 600, 2))
+            boxes.append(([y_min, x_min, y_min + 300, x_min + 300], 'Fake urgency'))
+        return boxes
+
+    print(f"{'size':>10} {'boxes':>6} {'load per box us/box':>20} {'cached us/box':>14} {'speedup':>8}")
+    for size in args.sizes:
+        img = Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8))
+        for count in args.mask_counts:
+            boxes = random_boxes(count)
+
+            def load_per_box():
+                # The previous renderer: resolve the font (or fail to) for every box
+                image = img.copy()
+                draw = ImageDraw.Draw(image)
+                for (y_min, x_min, y_max, x_max), label in boxes:
+                    x_min, y_min = int(x_min / 1000 * size), int(y_min / 1000 * size)
+                    draw.rectangle((x_min, y_min, int(x_max / 1000 * size), int(y_max / 1000 * size)), outline='red', width=3)
+                    try:
+                        font = ImageFont.truetype("arial.ttf", 20)
+                    except OSError:
+                        font = ImageFont.load_default()
+                    left, top, right, bottom = draw.textbbox((x_min, y_min), label, font=font)
+                    draw.rectangle((x_min, y_min - (bottom - top), x_min + right - left, y_min), fill='red')
+                    draw.text((x_min, y_min - (bottom - top)), label, fill='white', font=font)
+                return image
+
+            def cached():
+                return draw_bounding_boxes(img, boxes)
+
+            before = _best_of(load_per_box, args.repeats) * 1000 / count
+            after = _best_of(cached, args.repeats) * 1000 / count
+            print(f"{size:>5}x{size:<4} {count:>6} {before:>20.0f} {after:>14.0f} {before / after:>7.1f}x")
+
+def bench_video_render(args):
+    """Throughput of `render_annotated_video` on synthetic clips, against real time."""
+    import resource
+    import tempfile
+    import cv2
+    from schemas import VideoDetection
+    from video_frames import seconds_to_timestamp
+    from video_render import render_annotated_video
+
+    rng = np.random.default_rng(0)
+    fps = 30
+    print(f"{'source':>10} {'seconds':>8} {'max height':>11} {'render fps':>11} {'x real time':>12} {'peak RSS MB':>12}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args.sizes:
+            width, height = size * 16 // 9 // 2 * 2, size
+            for seconds in args.durations:
+                source = f'{tmp_dir}/source_{size}_{seconds}.mp4'
+                writer = cv2.VideoWriter(source, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+                frame = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+                for i in range(seconds * fps):
+                    # Scroll the noise so the encoder cannot skip frames
+                    writer.write(np.roll(frame, 4 * i, axis=1))
+                writer.release()
+
+                items = [
+                    VideoDetection(
+                        timestamp=seconds_to_timestamp(t), type='Fake urgency', description='',
+                        bounding_box=[int(v) for v in sorted(rng.integers(0, 1000, 2))] * 2,
+                    )
+                    for t in rng.integers(0, seconds, 2 * seconds)
+                ]
+                for max_height in [None, size // 2]:
+                    stats = render_annotated_video(source, items, f'{tmp_dir}/annotated.mp4', max_height=max_height)
+                    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+                    print(f"{width:>5}x{height:<4} {seconds:>8} {str(max_height):>11} {stats.frames / stats.seconds:>11.0f} "
+                          f"{stats.realtime_factor:>11.1f}x {peak_mb:>12.0f}")
+
+def _segmentation_response(width, height, count, rng):
+    """Synthetic segmentation items: boxes in 0-1000 coordinates with base64 PNG masks of elliptic blobs."""
+    from replay_client import synthetic_segmentation_response
+    from schemas import SegmentationItem, parse_items
+
+    return parse_items(synthetic_segmentation_response(rng, count, (width, height)), SegmentationItem)
+
+def bench_mask_decode(args):
+    """`decode_segmentation_masks` with the OpenCV decoder against Pillow, and the pixels on which their masks disagree."""
+    from image_detection import decode_segmentation_masks, mask_boxes
+
+    rng = np.random.default_rng(0)
+    width, height = args.image_size
+    print(f"{width}x{height}, masks sent at roughly their box size")
+    print(f"{'masks':>6} {'pil ms':>8} {'cv2 ms':>8} {'speedup':>8} {'boxes us':>9} {'pixels differing':>17}")
+    for count in args.mask_counts:
+        items = _segmentation_response(width, height, count, rng)
+        before = _best_of(lambda: decode_segmentation_masks(items, (width, height), decoder="pil"), args.repeats)
+        after = _best_of(lambda: decode_segmentation_masks(items, (width, height), decoder="cv2"), args.repeats)
+        boxes = _best_of(lambda: mask_boxes(items, (width, height)), args.repeats) * 1000
+
+        pil_masks = decode_segmentation_masks(items, (width, height), decoder="pil")
+        cv2_masks = decode_segmentation_masks(items, (width, height), decoder="cv2")
+        differing = sum(int(np.count_nonzero(a.crop != b.crop)) for a, b in zip(pil_masks, cv2_masks))
+        total = sum(mask.crop.size for mask in pil_masks)
+        print(f"{count:>6} {before:>8.2f} {after:>8.2f} {before / after:>7.1f}x {boxes:>9.1f} {differing / total:>16.3%}")
+
+def bench_mask_workers(args):
+    """Images per second through mask decode, compositing and saving: on the calling thread against `MaskWorkerPool`."""
+    import tempfile
+    from pathlib import Path
+    from image_detection import decode_segmentation_masks, plot_segmentation_masks, save_rendered_masks
+    from mask_workers import MaskWorkerPool
+
+    rng = np.random.default_rng(0)
+    width, height = args.image_size
+    # Flat panels, which compress like a screenshot rather than like noise
+    image = Image.fromarray(rng.integers(0, 256, (12, 16, 3), dtype=np.uint8)).resize((width, height), Image.Resampling.NEAREST)
+    responses = [_segmentation_response(width, height, args.masks, rng) for _ in range(args.images)]
+    paths = [Path(f'image_{i}.png') for i in range(args.images)]
+
+    print(f"{args.images} images of {width}x{height}, {args.masks} masks each, {os.cpu_count()} CPUs")
+    print(f"{'stage':>16} {'images/s':>9} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        started = time.perf_counter()
+        for path, items in zip(paths, responses):
+            save_rendered_masks(plot_segmentation_masks(image, decode_segmentation_masks(items, image.size)), path, tmp_dir)
+        baseline = args.images / (time.perf_counter() - started)
+        print(f"{'calling thread':>16} {baseline:>9.1f} {1:>7.1f}x")
+
+        for workers in args.workers:
+            with MaskWorkerPool(workers) as pool:
+                # Start every worker process before timing
+                for future in [pool.decode(responses[0], image.size) for _ in range(workers)]:
+                    future.result()
+                started = time.perf_counter()
+                futures = [pool.render(image, items, path, tmp_dir) for path, items in zip(paths, responses)]
+                for future in futures:
+                    future.result()
+                throughput = args.images / (time.perf_counter() - started)
+            print(f"{f'{workers} processes':>16} {throughput:>9.1f} {throughput / baseline:>7.1f}x")
+
+def bench_metrics(args):
+    """Cost per call of a `metrics` span and a `timed` function, disabled and enabled, against no instrumentation."""
+    from metrics import Metrics
+
+    calls = 200_000
+
+    def per_call_ns(fn):
+        return _best_of(lambda: [fn() for _ in range(calls)], args.repeats) * 1e6 / calls
+
+    def plain():
+        pass
+
+    print(f"{'instrumentation':>24} {'ns per call':>12}")
+    print(f"{'none':>24} {per_call_ns(plain):>12.0f}")
+    for enabled in (False, True):
+        registry = Metrics(enabled=enabled)
+        state = 'enabled' if enabled else 'disabled'
+
+        def spanned():
+            with registry.span('stage'):
+                pass
+
+        print(f"{f'span, {state}':>24} {per_call_ns(spanned):>12.0f}")
+        print(f"{f'timed, {state}':>24} {per_call_ns(registry.timed('stage')(plain)):>12.0f}")
+
+def _synthetic_video(path, seconds, fps=30, width=640, height=360, seed=0):
+    """Write a clip of flat panels sliding across the screen, which encodes and decodes like a screen recording."""
+    import cv2
+
+    rng = np.random.default_rng(seed)
+    panels = cv2.resize(rng.integers(0, 256, (9, 16, 3), dtype=np.uint8), (width, height), interpolation=cv2.INTER_NEAREST)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    for i in range(int(seconds * fps)):
+        writer.write(np.roll(panels, 4 * i, axis=1))
+    writer.release()
+    return path
+
+def _run_pipeline(scenario, inputs, responses, latency, jitter, tmp_dir):
+    """
+    Run one end-to-end pipeline scenario against a `ReplayClient`, in a process of its own so its peak RSS is its own.
+
+    Returns:
+        dict: 'items', 'seconds', per-item 'latencies', 'peak_rss_mb' and the `metrics` snapshot.
+    """
+    import contextlib
+    import io
+    import resource
+    import genai_client
+    from metrics import metrics
+    from replay_client import ReplayClient
+    from response_cache import response_cache
+
+    genai_client.set_client(ReplayClient(responses, latency=latency, jitter=jitter))
+    # Every request reaches the stand-in, and the real response cache is left alone
+    response_cache.bypass = True
+    response_cache.cache_dir = os.path.join(tmp_dir, 'responses')
+    metrics.enabled = True
+    output_dir = os.path.join(tmp_dir, f'output_{scenario}')
+
+    latencies = []
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if scenario == 'images':
+            from image_detection import analyze_images_concurrently
+
+            for result in analyze_images_concurrently(inputs, output_dir):
+                if result.error is not None:
+                    raise result.error
+                latencies.append(result.latency)
+        elif scenario == 'video':
+            from video_file_detection import analyze_video
+
+            for path, end_offset in inputs:
+                item_started = time.perf_counter()
+                analyze_video(path, '0s', end_offset, output_mode='both', output_dir=output_dir)
+                latencies.append(time.perf_counter() - item_started)
+        elif scenario == 'youtube':
+            import video_youtube_detection
+
+            # The clips are already in this cache, as if downloaded by an earlier run
+            video_youtube_detection.VIDEO_CACHE_DIR = os.path.join(tmp_dir, 'videos')
+            for url, end_offset in inputs:
+                item_started = time.perf_counter()
+                video_youtube_detection.analyze_youtube_video(url, '0s', end_offset, stream=True, output_dir=output_dir)
+                latencies.append(time.perf_counter() - item_started)
+    seconds = time.perf_counter() - started
+
+    return {
+        'items': len(latencies),
+        'seconds': seconds,
+        'latencies': latencies,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'metrics': metrics.snapshot(),
+    }
+
+def bench_pipeline(args):
+    """
+    The image, video file and YouTube pipelines end to end, with the model replaced by a `ReplayClient`.
+
+    Responses are replayed from `--recordings` (see `replay_client.RecordingClient`)
+    or generated: segmentation JSON with base64 masks, and video event lists.
+    Images come from `--images-dir`; videos are synthetic clips of `--durations`
+    seconds. Reports throughput, p50/p95 latency per item and peak RSS of every
+    scenario, then the p50/p95 of each stage recorded by `metrics`.
+    """
+    import shutil
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+    from replay_client import load_recordings, synthetic_segmentation_response, synthetic_video_response
+    from video_youtube_detection import video_cache_key
+
+    rng = np.random.default_rng(0)
+    if args.recordings:
+        responses = load_recordings(args.recordings)
+    else:
+        responses = {
+            'segmentation': [synthetic_segmentation_response(rng, args.masks) for _ in range(8)],
+            # Timestamps within the shortest clip, so every detection lands on a frame
+            'video': [synthetic_video_response(rng, min(args.durations)) for _ in range(4)],
+        }
+
+    image_paths = sorted(
+        os.path.join(args.images_dir, name) for name in os.listdir(args.images_dir)
+        if name.lower().endswith(('.png', '.jpg', '.jpeg', '.webp'))
+    )
+    print(f"latency {args.latency}s +- {args.jitter}s, {len(image_paths)} images, "
+          f"clips of {', '.join(map(str, args.durations))}s, {os.cpu_count()} CPUs")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        videos = [(_synthetic_video(f'{tmp_dir}/clip_{seconds}.mp4', seconds), f'{seconds}s') for seconds in args.durations]
+        clips = []
+        os.makedirs(f'{tmp_dir}/videos')
+        for (path, end_offset), seconds in zip(videos, args.durations):
+            url = f'https://www.youtube.com/watch?v=benchmark{seconds}'
+            shutil.copy(path, f'{tmp_dir}/videos/{video_cache_key(url, 0.0, float(seconds))}.mp4')
+            clips.append((url, end_offset))
+        scenarios = {'images': image_paths, 'video': videos, 'youtube': clips}
+
+        results = {}
+        for scenario in args.scenarios:
+            # A fresh interpreter per scenario, so the peak RSS of one does not carry over to the next
+            with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as executor:
+                results[scenario] = executor.submit(
+                    _run_pipeline, scenario, scenarios[scenario], responses, args.latency, args.jitter, tmp_dir
+                ).result()
+
+    print(f"{'scenario':>10} {'items':>6} {'items/s':>8} {'p50 s':>7} {'p95 s':>7} {'peak RSS MB':>12}")
+    for scenario, result in results.items():
+        p50, p95 = np.percentile(result['latencies'], [50, 95])
+        print(f"{scenario:>10} {result['items']:>6} {result['items'] / result['seconds']:>8.2f} "
+              f"{p50:>7.2f} {p95:>7.2f} {result['peak_rss_mb']:>12.0f}")
+
+    for scenario, result in results.items():
+        print(f"\n{scenario}: {'stage':>26} {'count':>6} {'p50 ms':>8} {'p95 ms':>8}")
+        for stage, stats in result['metrics']['stages'].items():
+            print(f"{'':>{len(scenario) + 1}} {stage:>26} {stats['count']:>6} "
+                  f"{stats['p50_seconds'] * 1000:>8.1f} {stats['p95_seconds'] * 1000:>8.1f}")
+
+# Third-party packages that dominate import time
+HEAVY_MODULES = ['google.genai', 'cv2', 'yt_dlp', 'numpy', 'pydantic', 'PIL']
+
+def _import_profile(module):
+    """Import `module` in a fresh interpreter under `-X importtime`; returns its cumulative import time (ms) and the modules loaded."""
+    # No API key, to show the modules import without credentials
+    env = {key: value for key, value in os.environ.items() if key not in ('GOOGLE_API_KEY', 'GEMINI_API_KEY')}
+    env['PYTHONPATH'] = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        env=env, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr.strip().splitlines()[-1]}")
+
+    cumulative = None
+    loaded = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line.split('|')
+        loaded.add(name.strip())
+        if name.strip() == module:
+            cumulative = int(cumulative_us) / 1000
+    return cumulative, loaded
+
+def bench_imports(args):
+    """Import time of each module in a fresh interpreter (`python -X importtime`), and the heavy dependencies it pulls in."""
+    print(f"{'module':>24} {'import ms':>10}  heavy dependencies loaded")
+    for module in args.modules:
+        profiles = [_import_profile(module) for _ in range(args.repeats)]
+        best = min(cumulative for cumulative, _ in profiles)
+        heavy = [name for name in HEAVY_MODULES if name in profiles[0][1]]
+        print(f"{module:>24} {best:>10.0f}  {', '.join(heavy) or '-'}")
+
+BENCHMARKS = {
+    'compositing': bench_compositing,
+    'annotation': bench_annotation,
+    'video-render': bench_video_render,
+    'imports': bench_imports,
+    'mask-decode': bench_mask_decode,
+    'mask-workers': bench_mask_workers,
+    'metrics': bench_metrics,
+    'pipeline': bench_pipeline,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 1024, 2048])
+    parser.add_argument('--mask-counts', type=int, nargs='+', default=[1, 5, 10, 20, 40])
+    parser.add_argument('--durations', type=int, nargs='+', default=[10, 60], help='clip lengths in seconds (video-render, pipeline)')
+    parser.add_argument('--images', type=int, default=32, help='images per run (mask-workers)')
+    parser.add_argument('--masks', type=int, default=10, help='masks per image (mask-workers, pipeline)')
+    parser.add_argument('--image-size', type=int, nargs=2, default=[1024, 768], metavar=('WIDTH', 'HEIGHT'), help='(mask-decode, mask-workers)')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help='worker processes (mask-workers)')
+    parser.add_argument('--latency', type=float, default=1.0, help='mean seconds per simulated model response (pipeline)')
+    parser.add_argument('--jitter', type=float, default=0.5, help='largest deviation from --latency, in seconds (pipeline)')
+    parser.add_argument('--recordings', help='folder of recorded responses to replay instead of synthetic ones (pipeline)')
+    parser.add_argument('--images-dir', default=os.path.join('reference', 'images'), help='(pipeline)')
+    parser.add_argument('--scenarios', nargs='+', choices=['images', 'video', 'youtube'], default=['images', 'video', 'youtube'],
+                        help='(pipeline)')
+    parser.add_argument('--modules', nargs='+', help='modules to import (imports)', default=[
+        'video_frames', 'annotation', 'image_detection', 'video_file_detection', 'video_youtube_detection',
+    ])
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
@@ -0,0 +1,49 @@
+import threading
+
+# Idle connections kept open for reuse. httpx keeps 20 by default, fewer than
+# the requests a busy batch has in flight, and every connection dropped
+# beyond that costs a fresh TLS handshake on the next request.
+MAX_KEEPALIVE_CONNECTIONS = 64
+
+_client = None
+_lock = threading.Lock()
+
+def get_client():
+    """
+    The process-wide Gemini client, created on first use.
+
+    google-genai is only imported, and the client (which requires an API
+    key) only built, when a request is about to be made. Modules that call
+    the model can therefore be imported, and their helpers used in worker
+    processes, without credentials. Every caller shares this client and so
+    a single HTTP connection pool.
+
+    Returns:
+        genai.Client: The shared client.
+    """
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                import httpx
+                from google import genai
+                from google.genai import types
+
+                _client = genai.Client(
+                    http_options=types.HttpOptions(
+                        client_args={'limits': httpx.Limits(max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS)}
+                    )
+                )
+    return _client
+
+def set_client(client):
+    """
+    Replace the shared client, e.g. with a fake one in tests and benchmarks.
+
+    Args:
+        client: Object with the `genai.Client` interface, or None to build
+            a real client again on the next `get_client()`.
+    """
+    global _client
+    with _lock:
+        _client = client
@@ -1,40 +1,77 @@
+import contextlib
 import dataclasses
 from typing import Tuple
-from google import genai
-from google.genai import types
-from PIL import Image, ImageDraw, ImageFont, ImageColor
+from PIL import Image, ImageDraw, ImageColor
 import io
 import base64
-import json
 import numpy as np
 import os
-
-client = genai.Client()
-
-def parse_json(json_output: str):
-    """Parse JSON output by removing markdown fencing."""
-    lines = json_output.splitlines()
-    for i, line in enumerate(lines):
-        if line == "```json":
-            json_output = "\n".join(lines[i+1:])  # Remove everything before "```json"
-            json_output = json_output.split("```")[0]  # Remove everything after the closing "```"
-            break  # Exit the loop once "```json" is found
-    return json_output
-
-@dataclasses.dataclass(frozen=True)
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+from annotation import OutputEncoding, save_image_to_output
+from genai_client import get_client
+from image_tiling import Tile, box_overlap, image_tokens, plan_resolution, tile_image
+from phash_index import PerceptualHashIndex, phash
+from render_resources import PALETTE, color_to_rgb, get_font
+from rate_limiter import RateLimiter, call_with_retry
+from response_cache import cached_generate_content
+from metrics import metrics
+from schemas import SegmentationItem, parse_items, response_config
+
+@dataclasses.dataclass(frozen=True, slots=True)
 class SegmentationMask:
     # bounding box pixel coordinates (not normalized)
     y0: int  # in [0..height - 1]
     x0: int  # in [0..width - 1]
     y1: int  # in [0..height - 1]
     x1: int  # in [0..width - 1]
-    mask: np.ndarray  # [img_height, img_width] with values 0..255
+    crop: np.ndarray  # [y1 - y0, x1 - x0] with values 0..255, the mask inside the bounding box
     label: str
+    image_size: tuple[int, int]  # (width, height) of the image the mask belongs to
+    type: str | None = None  # type of dark pattern, if the model gave one
+    confidence: float | None = None  # 0-100, if the model gave one
+
+    def full_mask(self) -> np.ndarray:
+        """Expand the mask to a full [img_height, img_width] array, zero outside the bounding box."""
+        width, height = self.image_size
+        mask = np.zeros((height, width), dtype=np.uint8)
+        mask[self.y0:self.y1, self.x0:self.x1] = self.crop
+        return mask
+
+    def packed_bits(self) -> np.ndarray:
+        """Pack the thresholded mask (> 127) into one bit per pixel, row-major."""
+        return np.packbits(self.crop > 127, axis=None)
+
+    @classmethod
+    def from_packed_bits(
+        cls, y0: int, x0: int, y1: int, x1: int, bits: np.ndarray, label: str, image_size: tuple[int, int],
+        type: str | None = None, confidence: float | None = None,
+    ):
+        """Rebuild a mask from `packed_bits`, with 255 for set pixels and 0 elsewhere."""
+        count = (y1 - y0) * (x1 - x0)
+        crop = np.unpackbits(bits, count=count).reshape(y1 - y0, x1 - x0) * np.uint8(255)
+        return cls(y0, x0, y1, x1, crop, label, image_size, type, confidence)
+
+# Rough input tokens of the segmentation prompt, on top of the image's
+PROMPT_TOKENS = 250
+
+def request_segmentation_items(
+    im: Image.Image,
+    structured_output: bool = True,
+    dedupe_index: PerceptualHashIndex | None = None,
+    limiter: RateLimiter | None = None,
+) -> list[SegmentationItem]:
+    """
+    Ask the model for the segmentation masks of dark patterns in an image, sent as given.
 
-def extract_segmentation_masks(im: Image.Image, output_dir: str = "segmentation_outputs"):
-    """Extract segmentation masks for dark patterns from an image."""
-    im.thumbnail([1024, 1024], Image.Resampling.LANCZOS)
-
+    Returns the parsed items, with boxes in 0-1000 coordinates and masks
+    still base64 PNGs (see `decode_segmentation_masks`). With a
+    `dedupe_index`, a near-duplicate of an image analyzed before reuses its
+    detections instead of calling the model. Only requests that reach the
+    model wait for a slot of `limiter`.
+    """
     prompt = """
     Give the segmentation masks for dark patterns.
     Type of Dark Patterns:
@@ -55,58 +92,213 @@ def extract_segmentation_masks(im: Image.Image, output_dir: str = "segmentation_
     15. Trick Wording
     16. Visual interference
     Output a JSON list of segmentation masks where each entry contains the 2D
-    bounding box in the key "box_2d", the segmentation mask in key "mask", and
-    the text label in the key "label". Use descriptive labels.
+    bounding box in the key "box_2d", the segmentation mask in key "mask", the
+    text label in the key "label", the type of dark pattern from the list above
+    in the key "type", and how confident you are in the detection, from 0 to
+    100, in the key "confidence". Use descriptive labels.
     """
 
+    from google.genai import types
+
     config = types.GenerateContentConfig(
         thinking_config=types.ThinkingConfig(thinking_budget=0),  # set thinking_budget to 0 for better results in object detection
+        **(response_config(SegmentationItem) if structured_output else {}),
     )
 
-    response = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=[prompt, im],  # Pillow images can be directly passed as inputs (which will be converted by the SDK)
-        config=config
-    )
+    # Reuse the detections of an already analyzed near-duplicate
+    entry = None
+    if dedupe_index is not None:
+        with metrics.span('segmentation.dedupe_lookup'):
+            hash_value = phash(im)
+            entry = dedupe_index.lookup(im, "segmentation", hash_value)
+    if entry is not None:
+        metrics.increment('dedupe_hits')
+        items = [SegmentationItem.model_validate(item) for item in entry["payload"]]
+    else:
+        def parse(text):
+            with metrics.span('segmentation.parse'):
+                return parse_items(text, SegmentationItem)
+
+        _, items = cached_generate_content(
+            get_client(),
+            model="gemini-2.5-flash",
+            contents=[prompt, im],  # Pillow images can be directly passed as inputs (which will be converted by the SDK)
+            config=config,
+            parse=parse,
+            limiter=limiter,
+            tokens=image_tokens(*im.size) + PROMPT_TOKENS,
+        )
+        if dedupe_index is not None:
+            dedupe_index.add(im, [item.model_dump() for item in items], "segmentation", hash_value)
 
-    # Parse JSON response
-    items = json.loads(parse_json(response.text))
+    return items
 
-    # Create output directory
-    os.makedirs(output_dir, exist_ok=True)
+# Backends of `decode_segmentation_masks`
+MASK_DECODERS = ("cv2", "pil")
 
-    # Process each mask
-    masks = []
-    for i, item in enumerate(items):
-        # Get bounding box coordinates
-        box = item["box_2d"]
-        y0 = int(box[0] / 1000 * im.size[1])
-        x0 = int(box[1] / 1000 * im.size[0])
-        y1 = int(box[2] / 1000 * im.size[1])
-        x1 = int(box[3] / 1000 * im.size[0])
+def _decode_mask_cv2(data: bytes, width: int, height: int) -> np.ndarray:
+    """Decode PNG bytes straight into a NumPy array and resize it to `width` x `height` with OpenCV."""
+    import cv2
+
+    mask = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        raise ValueError("Could not decode segmentation mask PNG")
+    # Area averaging when shrinking, like PIL's antialiased bilinear filter
+    shrinking = width < mask.shape[1] or height < mask.shape[0]
+    return cv2.resize(mask, (width, height), interpolation=cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR)
+
+def _decode_mask_pil(data: bytes, width: int, height: int) -> np.ndarray:
+    mask = Image.open(io.BytesIO(data))
+    return np.array(mask.resize((width, height), Image.Resampling.BILINEAR), dtype=np.uint8)
+
+_MASK_DECODER_FUNCTIONS = {"cv2": _decode_mask_cv2, "pil": _decode_mask_pil}
 
+def mask_boxes(items: list[SegmentationItem], image_size: tuple[int, int]) -> np.ndarray:
+    """Pixel boxes [N, 4] of (y0, x0, y1, x1) for the 0-1000 `box_2d` of every item, converted in one pass."""
+    width, height = image_size
+    boxes = np.array([item.box_2d[:4] for item in items], dtype=np.float64).reshape(-1, 4)
+    # Truncated towards zero, like int()
+    return (boxes / 1000 * np.array([height, width, height, width])).astype(np.int64)
+
+@metrics.timed('segmentation.decode_masks')
+def decode_segmentation_masks(items: list[SegmentationItem], image_size: tuple[int, int], decoder: str = "cv2") -> list[SegmentationMask]:
+    """
+    Decode the masks of a segmentation response onto an image of `image_size` (width, height).
+
+    Boxes are converted to pixels for all items at once (see `mask_boxes`).
+    Each base64 PNG mask is then decoded, resized to its bounding box and
+    thresholded to 0/255; items with an empty box or a mask that is not a
+    PNG data URL are skipped. `decoder` is "cv2" to decode and resize with
+    OpenCV straight into NumPy, or "pil" for Pillow. This is pure CPU work,
+    so it can run in a worker process (see `mask_workers`).
+    """
+    decode_mask = _MASK_DECODER_FUNCTIONS[decoder]
+    masks = []
+    for item, (y0, x0, y1, x1) in zip(items, mask_boxes(items, image_size).tolist()):
         # Skip invalid boxes
         if y0 >= y1 or x0 >= x1:
             continue
 
         # Process mask
-        png_str = item["mask"]
+        png_str = item.mask
         if not png_str.startswith("data:image/png;base64,"):
             continue
 
-        # Remove prefix
-        png_str = png_str.removeprefix("data:image/png;base64,")
-        mask_data = base64.b64decode(png_str)
-        mask = Image.open(io.BytesIO(mask_data))
-
-        # Resize mask to match bounding box
-        mask = mask.resize((x1 - x0, y1 - y0), Image.Resampling.BILINEAR)
-        np_mask = np.zeros((im.size[1], im.size[0]), dtype=np.uint8)
-        np_mask[y0:y1, x0:x1] = mask
-        masks.append(SegmentationMask(y0, x0, y1, x1, np_mask, item["label"]))
+        mask = decode_mask(base64.b64decode(png_str.removeprefix("data:image/png;base64,")), x1 - x0, y1 - y0)
+        # Rendering draws pixels above 127, so threshold once here
+        np.greater(mask, 127, out=mask, casting="unsafe")
+        mask *= 255
+        masks.append(SegmentationMask(y0, x0, y1, x1, mask, item.label, image_size, item.type, item.confidence))
 
     return masks
 
+def request_tiled_items(
+    im: Image.Image,
+    structured_output: bool = True,
+    dedupe_index: PerceptualHashIndex | None = None,
+    max_size: int = 1024,
+    token_budget: int | None = None,
+    request_slots: threading.Semaphore | None = None,
+    limiter: RateLimiter | None = None,
+) -> list[tuple[Tile, list[SegmentationItem]]]:
+    """
+    Ask the model for the segmentation masks of an image, in the regions and sizes planned by `plan_resolution`.
+
+    Tiles are requested concurrently, each request holding one of the
+    `request_slots` if given. `im` itself is never modified.
+
+    Returns:
+        list[tuple[Tile, list[SegmentationItem]]]: The items of every tile, in
+            0-1000 coordinates of that tile; `decode_tiled_masks` maps them
+            back onto the image.
+    """
+    with metrics.span('segmentation.resize'):
+        tiles = plan_resolution(*im.size, max_size=max_size, token_budget=token_budget)
+        images = [tile_image(im, tile) for tile in tiles]
+
+    def request(image):
+        with request_slots or contextlib.nullcontext():
+            return request_segmentation_items(image, structured_output, dedupe_index, limiter)
+
+    if len(tiles) == 1:
+        return [(tiles[0], request(images[0]))]
+
+    metrics.increment('image_tiles', len(tiles))
+    with ThreadPoolExecutor(len(tiles)) as executor:
+        return list(zip(tiles, executor.map(request, images)))
+
+def _merge_masks(a: SegmentationMask, b: SegmentationMask) -> SegmentationMask:
+    """One mask covering the union of two detections of the same object, with the higher confidence."""
+    y0, x0, y1, x1 = min(a.y0, b.y0), min(a.x0, b.x0), max(a.y1, b.y1), max(a.x1, b.x1)
+    crop = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+    for mask in (a, b):
+        region = crop[mask.y0 - y0:mask.y1 - y0, mask.x0 - x0:mask.x1 - x0]
+        np.maximum(region, mask.crop, out=region)
+    confidences = [mask.confidence for mask in (a, b) if mask.confidence is not None]
+    return SegmentationMask(y0, x0, y1, x1, crop, a.label, a.image_size, a.type or b.type, max(confidences, default=None))
+
+def decode_tiled_masks(
+    tiled_items: list[tuple[Tile, list[SegmentationItem]]],
+    image_size: tuple[int, int],
+    overlap_threshold: float = 0.5,
+) -> list[SegmentationMask]:
+    """
+    Decode the masks of `request_tiled_items` onto the whole image of `image_size` (width, height).
+
+    The masks of each tile are decoded at the tile's size in the source
+    image, so they keep its full resolution, and moved to the tile's place.
+    An object in the overlap of two tiles is found in both: detections from
+    different tiles with the same label whose boxes overlap by at least
+    `overlap_threshold` of the smaller one are merged into one mask.
+    """
+    masks = []
+    for index, (tile, items) in enumerate(tiled_items):
+        for mask in decode_segmentation_masks(items, tile.size):
+            masks.append((index, dataclasses.replace(
+                mask, y0=mask.y0 + tile.top, x0=mask.x0 + tile.left, y1=mask.y1 + tile.top, x1=mask.x1 + tile.left,
+                image_size=image_size,
+            )))
+    if len(tiled_items) == 1:
+        return [mask for _, mask in masks]
+
+    kept = []
+    for index, mask in masks:
+        box = (mask.y0, mask.x0, mask.y1, mask.x1)
+        for i, (other_index, other) in enumerate(kept):
+            if (
+                other_index != index
+                and other.label.lower() == mask.label.lower()
+                and box_overlap((other.y0, other.x0, other.y1, other.x1), box) >= overlap_threshold
+            ):
+                kept[i] = (other_index, _merge_masks(other, mask))
+                break
+        else:
+            kept.append((index, mask))
+    return [mask for _, mask in kept]
+
+@metrics.timed('segmentation.extract')
+def extract_segmentation_masks(
+    im: Image.Image,
+    output_dir: str = "segmentation_outputs",
+    structured_output: bool = True,
+    dedupe_index: PerceptualHashIndex | None = None,
+    max_size: int = 1024,
+    token_budget: int | None = None,
+    request_slots: threading.Semaphore | None = None,
+    limiter: RateLimiter | None = None,
+):
+    """
+    Extract segmentation masks for dark patterns from an image, in the coordinates of `im` at its full resolution.
+
+    See `request_tiled_items` and `decode_tiled_masks`.
+    """
+    tiled_items = request_tiled_items(im, structured_output, dedupe_index, max_size, token_budget, request_slots, limiter)
+
+    # Create output directory
+    os.makedirs(output_dir, exist_ok=True)
+
+    return decode_tiled_masks(tiled_items, im.size)
+
 def overlay_mask_on_img(
     img: Image.Image,
     mask: np.ndarray,
@@ -171,6 +363,99 @@ def overlay_mask_on_img(
 
     return result_img
 
+def composite_masks(
+    img: Image.Image,
+    segmentation_masks: list[SegmentationMask],
+    colors: list[str],
+    alpha: float = 0.7
+) -> Image.Image:
+    """
+    Overlays all masks onto a PIL Image in a single pass.
+
+    Produces the same pixels as calling `overlay_mask_on_img` once per mask,
+    but converts the image once and blends each mask into one shared NumPy
+    buffer, touching only the pixels inside the mask's bounding box. Masks are
+    applied in list order, so overlapping masks stack exactly as before.
+
+    Args:
+        img: The base PIL Image object.
+        segmentation_masks: Masks to overlay.
+        colors: Color names, cycled through by mask index.
+        alpha: The alpha transparency level for the overlays.
+
+    Returns:
+        A new PIL Image object (in RGBA mode) with the masks overlaid, or
+        `img` itself if there are no masks.
+
+    Raises:
+        ValueError: If a color name is invalid or alpha is outside the 0.0-1.0 range.
+    """
+    if not (0.0 <= alpha <= 1.0):
+        raise ValueError("Alpha must be between 0.0 and 1.0")
+    if not segmentation_masks:
+        return img
+
+    try:
+        colors_rgb = [color_to_rgb(color) for color in colors]
+    except ValueError as e:
+        raise ValueError(f"Invalid color name in {colors}. Supported names are typically HTML/CSS color names. Error: {e}")
+
+    buffer = np.array(img.convert("RGBA"))
+    height, width = buffer.shape[:2]
+    src_a = int(alpha * 255)
+    if src_a == 0:
+        return Image.fromarray(buffer, 'RGBA')
+
+    # Integer arithmetic of PIL's alpha_composite for a constant source alpha,
+    # so the result is bit-identical to Image.alpha_composite.
+    precision_bits = 7
+
+    def div255(value):
+        return ((value >> 8) + value) >> 8
+
+    # Compositing onto an opaque pixel keeps it opaque, and its new color only
+    # depends on the old one, so opaque images go through 256-entry lookup tables.
+    opaque = bool((buffer[..., 3] == 255).all())
+    opaque_coef1 = (src_a * 255 * 255 * (1 << precision_bits)) // (255 * 255)
+    opaque_coef2 = 255 * (1 << precision_bits) - opaque_coef1
+    channel_values = np.arange(256, dtype=np.uint32)
+    lookup_tables = {}
+
+    for i, mask in enumerate(segmentation_masks):
+        y0, x0 = max(mask.y0, 0), max(mask.x0, 0)
+        y1, x1 = min(mask.y1, height), min(mask.x1, width)
+        if y0 >= y1 or x0 >= x1:
+            continue
+
+        color_rgb = colors_rgb[i % len(colors_rgb)]
+        region = buffer[y0:y1, x0:x1]
+        selected = mask.crop[y0 - mask.y0:y1 - mask.y0, x0 - mask.x0:x1 - mask.x0] > 127
+
+        if opaque:
+            if color_rgb not in lookup_tables:
+                lookup_tables[color_rgb] = [
+                    (div255(src * opaque_coef1 + channel_values * opaque_coef2 + (0x80 << precision_bits)) >> precision_bits).astype(np.uint8)
+                    for src in color_rgb
+                ]
+            for channel, table in enumerate(lookup_tables[color_rgb]):
+                np.copyto(region[..., channel], np.take(table, region[..., channel]), where=selected)
+            continue
+
+        dst = region[selected].astype(np.uint32)
+        outa255 = src_a * 255 + dst[:, 3] * (255 - src_a)
+        coef1 = (src_a * 255 * 255 * (1 << precision_bits)) // outa255
+        coef2 = 255 * (1 << precision_bits) - coef1
+
+        out = np.empty_like(dst)
+        src_rgb = np.array(color_rgb, dtype=np.uint32)
+        tmp = src_rgb[None, :] * coef1[:, None] + dst[:, :3] * coef2[:, None]
+        out[:, :3] = div255(tmp + (0x80 << precision_bits)) >> precision_bits
+        out[:, 3] = div255(outa255 + 0x80)
+        region[selected] = out
+
+    return Image.fromarray(buffer, 'RGBA')
+
+@metrics.timed('render.masks')
 def plot_segmentation_masks(img: Image.Image, segmentation_masks: list[SegmentationMask]):
     """
     Plots bounding boxes on an image with markers for each a name, using PIL, normalized coordinates, and different colors.
@@ -180,20 +465,13 @@ def plot_segmentation_masks(img: Image.Image, segmentation_masks: list[Segmentat
         segmentation_masks: A list of SegmentationMask objects containing the name of the object,
             their positions, and the segmentation mask.
     """
-    # Define a list of colors
-    colors = [
-        'red', 'green', 'blue', 'yellow', 'orange', 'pink', 'purple', 'brown',
-        'gray', 'beige', 'turquoise', 'cyan', 'magenta', 'lime', 'navy', 'maroon',
-        'teal', 'olive', 'coral', 'lavender', 'violet', 'gold', 'silver',
-    ]
-    font = ImageFont.truetype("Arial Bold.ttf", size=14)
+    colors = PALETTE
+    font = get_font(14, bold=True)
 
     # Do this in 3 passes to make sure the boxes and text are always visible.
 
-    # Overlay the mask
-    for i, mask in enumerate(segmentation_masks):
-        color = colors[i % len(colors)]
-        img = overlay_mask_on_img(img, mask.mask, color)
+    # Overlay the masks
+    img = composite_masks(img, segmentation_masks, colors)
 
     # Create a drawing object
     draw = ImageDraw.Draw(img)
@@ -212,23 +490,130 @@ def plot_segmentation_masks(img: Image.Image, segmentation_masks: list[Segmentat
             draw.text((mask.x0 + 8, mask.y0 - 20), mask.label, fill=color, font=font)
     return img
 
-# Example usage
-if __name__ == "__main__":
-    import os
-    from pathlib import Path
-    
-    # Create output directory if it doesn't exist
-    output_dir = Path("output/images_mask")
+def save_rendered_masks(rendered: Image.Image, source_path: Path, output_dir: Path, encoding: OutputEncoding | None = None) -> Path:
+    """
+    Save the rendering of `source_path` to `output_dir` as masks_<name>.
+
+    With an `encoding` the image is saved in that format; otherwise it keeps
+    the source file's name and format.
+    """
+    source_path = Path(source_path)
+    if encoding is not None:
+        return Path(save_image_to_output(rendered, f"masks_{source_path.stem}", str(output_dir), encoding))
+    output_path = Path(output_dir) / f"masks_{source_path.name}"
+    if output_path.suffix.lower() not in ('.png', '.webp') and rendered.mode not in ('RGB', 'L'):
+        # The mask overlays are RGBA; JPEG, and BMP and GIF in older Pillow, have no alpha channel
+        rendered = rendered.convert('RGB')
+    with metrics.span('encode.image'):
+        rendered.save(output_path)
+    return output_path
+
+@dataclasses.dataclass
+class ImageAnalysisResult:
+    path: Path
+    output_path: Path | None  # None if the analysis failed
+    segmentation_masks: list[SegmentationMask]
+    error: Exception | None
+    latency: float  # seconds from submission until the rendered image was saved
+
+def analyze_images_concurrently(
+    image_paths: list[Path],
+    output_dir: Path,
+    max_concurrency: int = 4,
+    render_workers: int = 2,
+    requests_per_minute: float | None = None,
+    tokens_per_minute: float | None = None,
+    max_retries: int = 5,
+    dedupe_index: PerceptualHashIndex | None = None,
+    encoding: OutputEncoding | None = None,
+    mask_workers: int | None = None,
+    image_token_budget: int | None = None,
+    limiter: RateLimiter | None = None,
+):
+    """
+    Analyzes a batch of images concurrently and yields results as each one finishes.
+
+    Requests are paced by the rate limiter and retried with exponential
+    backoff on 429/5xx errors; rendering runs on a separate pool so it
+    overlaps with the requests still in flight.
+
+    Args:
+        image_paths: Paths of the images to analyze.
+        output_dir: Directory the rendered images are saved to, as masks_<name>.
+        max_concurrency: Maximum number of requests in flight.
+        render_workers: Number of threads rendering and saving results.
+        requests_per_minute: Requests-per-minute quota, or None for no limit.
+        tokens_per_minute: Input tokens-per-minute quota, or None for no limit.
+        max_retries: Retries per image on rate limit and server errors.
+        dedupe_index: Optional perceptual-hash index; near-duplicates of
+            images analyzed before reuse their detections without a request.
+        encoding: Output encoding of the rendered images; by default they
+            keep the source file's name and format.
+        mask_workers: Number of worker processes decoding and rendering
+            masks, or None to do it on `render_workers` threads.
+        image_token_budget: Most image tokens per request (see `plan_resolution`);
+            very tall or wide screenshots are split into tiles either way.
+        limiter: Rate limiter shared with other work, used instead of one
+            built from `requests_per_minute` and `tokens_per_minute`.
+    Yields:
+        ImageAnalysisResult for every image, in completion order.
+    """
+    output_dir = Path(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
-    
-    # Process all files in reference folder
-    reference_dir = Path("reference/images")
-    for file_path in reference_dir.iterdir():
-        if file_path.suffix.lower() in ['.png', '.jpg', '.jpeg', '.bmp', '.gif']:
-            im = Image.open(file_path)
-            segmentation_masks = extract_segmentation_masks(im)
-            new_image = plot_segmentation_masks(im, segmentation_masks)
-            
-            # Save with masks_ prefix
-            output_filename = f"masks_{file_path.name}"
-            new_image.save(output_dir / output_filename)
+    limiter = limiter or RateLimiter(requests_per_minute, tokens_per_minute)
+    # The request threads wait on their tiles without holding a slot, so tiles never deadlock
+    request_slots = threading.BoundedSemaphore(max_concurrency)
+
+    mask_pool = None
+    if mask_workers is not None:
+        from mask_workers import MaskWorkerPool
+
+        mask_pool = MaskWorkerPool(mask_workers)
+
+    def attempt(im):
+        # Every tile request that misses the response cache waits for the limiter
+        options = dict(dedupe_index=dedupe_index, token_budget=image_token_budget, request_slots=request_slots, limiter=limiter)
+        if mask_pool is not None:
+            return request_tiled_items(im, **options)
+        return extract_segmentation_masks(im, **options)
+
+    def analyze(path):
+        im = Image.open(path)
+        im.load()
+        return im, call_with_retry(attempt, im, max_retries=max_retries)
+
+    def render(path, im, segmentation_masks):
+        rendered = plot_segmentation_masks(im, segmentation_masks)
+        return save_rendered_masks(rendered, path, output_dir, encoding), segmentation_masks
+
+    with ThreadPoolExecutor(max_concurrency) as request_pool, ThreadPoolExecutor(render_workers) as render_pool, \
+            (mask_pool or contextlib.nullcontext()):
+        started = {}
+        pending = {}
+        for path in image_paths:
+            path = Path(path)
+            started[path] = time.perf_counter()
+            pending[request_pool.submit(analyze, path)] = ("analyze", path)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, path = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    yield ImageAnalysisResult(path, None, [], e, time.perf_counter() - started[path])
+                    continue
+
+                if stage == "analyze":
+                    im, detections = result
+                    if mask_pool is not None:
+                        render_future = mask_pool.render(im, detections, path, output_dir, encoding)
+                    else:
+                        render_future = render_pool.submit(render, path, im, detections)
+                    pending[render_future] = ("render", path)
+                elif mask_pool is not None:
+                    yield ImageAnalysisResult(path, result.output_path, result.masks, None, time.perf_counter() - started[path])
+                else:
+                    output_path, segmentation_masks = result
+                    yield ImageAnalysisResult(path, output_path, segmentation_masks, None, time.perf_counter() - started[path])
@@ -0,0 +1,138 @@
+from PIL import Image
+import dataclasses
+import math
+
+# Gemini bills images up to 384px on both sides as one tile of 258 tokens;
+# larger ones are cut into 768x768 crops of 258 tokens each
+TOKENS_PER_TILE = 258
+SMALL_IMAGE_SIDE = 384
+MODEL_TILE_SIDE = 768
+
+def image_tokens(width, height):
+    """Input tokens the model bills for an image of `width` x `height` pixels."""
+    if width <= SMALL_IMAGE_SIDE and height <= SMALL_IMAGE_SIDE:
+        return TOKENS_PER_TILE
+    return TOKENS_PER_TILE * math.ceil(width / MODEL_TILE_SIDE) * math.ceil(height / MODEL_TILE_SIDE)
+
+@dataclasses.dataclass(frozen=True)
+class Tile:
+    # region of the source image, in pixels
+    left: int
+    top: int
+    right: int
+    bottom: int
+    request_size: tuple[int, int]  # (width, height) the region is sent to the model at
+
+    @property
+    def size(self) -> tuple[int, int]:
+        return (self.right - self.left, self.bottom - self.top)
+
+    @property
+    def tokens(self) -> int:
+        return image_tokens(*self.request_size)
+
+def _tile_spans(length, tile_length, overlap):
+    """
+    (start, end) of the fewest tiles of `tile_length` covering [0, length] with at least `overlap` between neighbours, evenly spread.
+
+    A length no more than `overlap` past one tile stays whole: its tiles
+    would be almost the same region, at twice the cost.
+    """
+    if length - tile_length <= overlap:
+        return [(0, length)]
+    count = math.ceil((length - overlap) / (tile_length - overlap))
+    step = (length - tile_length) / (count - 1)
+    return [(round(i * step), round(i * step) + tile_length) for i in range(count)]
+
+def _request_scale(width, height, max_size, token_budget, snap_tolerance):
+    """Scale at which a region of `width` x `height` is sent: never up, within `max_size` and `token_budget`."""
+    scale = min(1.0, max_size / max(width, height))
+
+    if token_budget is not None and image_tokens(width * scale, height * scale) > token_budget:
+        # The largest scale whose grid of model tiles fits in the budget; one small tile always does
+        budget_tiles = max(1, token_budget // TOKENS_PER_TILE)
+        best = SMALL_IMAGE_SIDE / max(width, height)
+        for columns in range(1, budget_tiles + 1):
+            rows = budget_tiles // columns
+            best = max(best, min(MODEL_TILE_SIDE * columns / width, MODEL_TILE_SIDE * rows / height))
+        scale = min(scale, best)
+
+    # A side just past a model tile boundary pays for a whole extra row or
+    # column of tiles; shrinking slightly below the boundary halves the cost
+    for side in (width, height):
+        scaled = side * scale
+        boundary = MODEL_TILE_SIDE * (math.ceil(scaled / MODEL_TILE_SIDE) - 1)
+        if boundary and boundary / scaled >= 1 - snap_tolerance:
+            scale = boundary / side
+    return scale
+
+def plan_resolution(
+    width,
+    height,
+    max_size=1024,
+    token_budget=None,
+    max_aspect=2.0,
+    overlap=0.15,
+    max_tiles=8,
+    snap_tolerance=0.1,
+):
+    """
+    Plan the requests for an image of `width` x `height`: which regions to send, and at what size.
+
+    An image no more than `max_aspect` times longer than it is wide is sent
+    whole, and so is one whose long side exceeds that by no more than the
+    tile overlap. A taller (or wider) one, such as a full-page screenshot,
+    is cut along its long side into overlapping tiles of at most
+    `max_aspect`, so each can be sent large enough for small print to stay
+    readable instead of squashing the whole page into `max_size`. Neighbouring tiles overlap
+    by `overlap` of a tile, so anything cut by one tile's edge lies whole in
+    the next; at most `max_tiles` tiles are made, longer ones if needed.
+
+    Each region is sent at the largest size that is no larger than the
+    source, fits in `max_size` and costs at most `token_budget` image tokens
+    (see `image_tokens`). A side that only just crosses a model tile
+    boundary is shrunk by up to `snap_tolerance` to save the extra tiles.
+
+    Returns:
+        list[Tile]: The regions to request, top to bottom (or left to right).
+    """
+    if width <= 0 or height <= 0:
+        raise ValueError(f"Cannot plan requests for an image of {width}x{height}")
+    if not 0 <= overlap < 1:
+        raise ValueError("overlap must be in [0, 1)")
+
+    long_side, short_side = max(width, height), min(width, height)
+    tile_length = min(long_side, round(short_side * max_aspect))
+    spans = _tile_spans(long_side, tile_length, round(tile_length * overlap))
+    while len(spans) > max_tiles:
+        tile_length = math.ceil(tile_length * 1.25)
+        spans = _tile_spans(long_side, min(long_side, tile_length), round(tile_length * overlap))
+
+    tiles = []
+    for start, end in spans:
+        left, top, right, bottom = (0, start, width, end) if height >= width else (start, 0, end, height)
+        scale = _request_scale(right - left, bottom - top, max_size, token_budget, snap_tolerance)
+        request_size = (max(1, round((right - left) * scale)), max(1, round((bottom - top) * scale)))
+        tiles.append(Tile(left, top, right, bottom, request_size))
+    return tiles
+
+def tile_image(im, tile):
+    """
+    The region of `im` covered by `tile`, resized to its request size.
+
+    Always a new image, so the source is never modified; an image that is
+    sent whole at full size is returned as is.
+    """
+    if (tile.left, tile.top, tile.right, tile.bottom) != (0, 0, *im.size):
+        im = im.crop((tile.left, tile.top, tile.right, tile.bottom))
+    if im.size != tile.request_size:
+        im = im.resize(tile.request_size, Image.Resampling.LANCZOS)
+    return im
+
+def box_overlap(a, b):
+    """Intersection of two (y0, x0, y1, x1) boxes over the area of the smaller one."""
+    y0, x0 = max(a[0], b[0]), max(a[1], b[1])
+    y1, x1 = min(a[2], b[2]), min(a[3], b[3])
+    intersection = max(0, y1 - y0) * max(0, x1 - x0)
+    smaller = min((a[2] - a[0]) * (a[3] - a[1]), (b[2] - b[0]) * (b[3] - b[1]))
+    return intersection / smaller if smaller > 0 else 0.0
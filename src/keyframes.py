@@ -0,0 +1,138 @@
+from PIL import Image
+import dataclasses
+import io
+import numpy as np
+from phash_index import BKTree, phash
+from video_frames import iter_frames_at_indices, seconds_to_timestamp
+
+@dataclasses.dataclass
+class Keyframe:
+    seconds: float  # time of the frame in the source video
+    image: Image.Image
+
+    @property
+    def timestamp(self) -> str:
+        return seconds_to_timestamp(self.seconds)
+
+def _open_at(video_path, start_seconds):
+    """Open a capture positioned at `start_seconds`; returns (cap, fps, first frame index)."""
+    import cv2
+
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise ValueError(f"Could not open video file: {video_path}")
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    if fps <= 0:
+        cap.release()
+        raise ValueError(f"Could not read the frame rate of {video_path}")
+    start_index = int(round(start_seconds * fps))
+    if start_index > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start_index)
+    return cap, fps, start_index
+
+def frame_signatures(video_path, start_seconds=0, end_seconds=None, sample_fps=2.0, size=32):
+    """
+    Compute cheap signatures for frames sampled at `sample_fps`.
+
+    Each signature is the frame downscaled to `size` x `size` grayscale. Only
+    the sampled frames are retrieved; the rest are just grabbed.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Frame indices [N] and signatures [N, size * size] as float32.
+    """
+    import cv2
+
+    cap, fps, start_index = _open_at(video_path, start_seconds)
+    step = max(1, int(round(fps / sample_fps)))
+    # The frame count is only an estimate for some containers; reading stops at the real end
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) or 2 ** 31
+    end_index = frame_count if end_seconds is None else min(frame_count, int(end_seconds * fps) + 1)
+
+    indices, signatures = [], []
+    try:
+        for frame_index, frame in iter_frames_at_indices(cap, range(start_index, end_index, step), position=start_index):
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            signatures.append(cv2.resize(gray, (size, size), interpolation=cv2.INTER_AREA).ravel())
+            indices.append(frame_index)
+    finally:
+        cap.release()
+
+    if not signatures:
+        return np.empty(0, dtype=np.int64), np.empty((0, size * size), dtype=np.float32)
+    return np.asarray(indices), np.stack(signatures).astype(np.float32)
+
+def scene_change_indices(signatures, threshold=0.08, max_keyframes=32):
+    """
+    Pick the signatures that start a new scene, in one vectorized pass.
+
+    Consecutive signatures are compared by mean absolute difference (0..1).
+    The changes are accumulated, and a keyframe is emitted every time the
+    accumulated change crosses another multiple of `threshold`, so both hard
+    cuts and gradual changes such as scrolling produce keyframes while static
+    stretches produce none. The threshold is raised if needed to stay within
+    `max_keyframes`.
+
+    Returns:
+        np.ndarray: Positions into `signatures` of the keyframes, always including the first.
+    """
+    if len(signatures) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    changes = np.abs(np.diff(signatures, axis=0)).mean(axis=1) / 255
+    accumulated = np.concatenate([[0.0], np.cumsum(changes)])
+    if max_keyframes > 1:
+        threshold = max(threshold, accumulated[-1] / (max_keyframes - 1) * (1 + 1e-9))
+    buckets = np.floor(accumulated / threshold)
+    new_scene = np.concatenate([[True], buckets[1:] > buckets[:-1]])
+    return np.flatnonzero(new_scene)[:max_keyframes]
+
+def select_keyframes(video_path, start_seconds=0, end_seconds=None, sample_fps=2.0, threshold=0.08, max_keyframes=32, max_size=768, dedupe_distance=None):
+    """
+    Select the keyframes of a video section, keeping their source timestamps.
+
+    Runs `frame_signatures` and `scene_change_indices`, then decodes the
+    section once more to retrieve only the chosen frames, shrunk to fit in
+    `max_size`.
+
+    With `dedupe_distance`, a keyframe whose perceptual hash is within that
+    Hamming distance of an earlier keyframe is dropped, so a screen the video
+    returns to (e.g. going back to the cart) is only sent once.
+
+    Returns:
+        list[Keyframe]: The keyframes in time order.
+    """
+    indices, signatures = frame_signatures(video_path, start_seconds, end_seconds, sample_fps)
+    selected = indices[scene_change_indices(signatures, threshold, max_keyframes)]
+    if len(selected) == 0:
+        return []
+
+    import cv2
+
+    cap, fps, start_index = _open_at(video_path, start_seconds)
+    keyframes = []
+    seen = BKTree()
+    try:
+        for frame_index, frame in iter_frames_at_indices(cap, selected.tolist(), position=start_index):
+            image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            if dedupe_distance is not None:
+                hash_value = phash(image)
+                if seen.search(hash_value, dedupe_distance):
+                    continue
+                seen.add(hash_value, frame_index)
+            image.thumbnail([max_size, max_size], Image.Resampling.LANCZOS)
+            keyframes.append(Keyframe(frame_index / fps, image))
+    finally:
+        cap.release()
+    return keyframes
+
+def keyframe_parts(keyframes, jpeg_quality=85):
+    """Request parts for a keyframe batch: each JPEG image preceded by its timestamp."""
+    from google.genai import types
+
+    parts = []
+    for keyframe in keyframes:
+        buffer = io.BytesIO()
+        keyframe.image.save(buffer, format='JPEG', quality=jpeg_quality)
+        parts.append(types.Part(text=f"Frame at {keyframe.timestamp}:"))
+        parts.append(types.Part.from_bytes(data=buffer.getvalue(), mime_type='image/jpeg'))
+    return parts
@@ -0,0 +1,198 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import get_context, shared_memory
+from PIL import Image
+import dataclasses
+import os
+import time
+import traceback
+import numpy as np
+from pathlib import Path
+from image_detection import SegmentationMask, decode_segmentation_masks, decode_tiled_masks, plot_segmentation_masks, save_rendered_masks
+from metrics import metrics
+from schemas import SegmentationItem, parse_items
+
+@dataclasses.dataclass(frozen=True)
+class SharedPixels:
+    """An RGBA image in a shared memory block, handed to a worker process by name."""
+    name: str
+    width: int
+    height: int
+
+    @property
+    def shape(self) -> tuple[int, int, int]:
+        return (self.height, self.width, 4)
+
+@dataclasses.dataclass
+class RenderedMasks:
+    output_path: Path | None  # None unless a source path was given
+    masks: list[SegmentationMask]  # crops thresholded to 0/255
+    image: Image.Image | None  # the rendering, if requested
+
+def _decode(items, image_size):
+    """Masks of a segmentation response: the raw JSON text, its parsed items, or the per-tile items of `request_tiled_items`."""
+    if isinstance(items, str):
+        items = parse_items(items, SegmentationItem)
+    if items and isinstance(items[0], tuple):
+        return decode_tiled_masks(items, image_size)
+    return decode_segmentation_masks(items, image_size)
+
+def _pack_masks(masks):
+    """Masks as (y0, x0, y1, x1, bits, label, type, confidence), at one bit per pixel for the trip back to the parent."""
+    return [(mask.y0, mask.x0, mask.y1, mask.x1, mask.packed_bits(), mask.label, mask.type, mask.confidence) for mask in masks]
+
+def _unpack_masks(packed, image_size):
+    return [
+        SegmentationMask.from_packed_bits(y0, x0, y1, x1, bits, label, image_size, type, confidence)
+        for y0, x0, y1, x1, bits, label, type, confidence in packed
+    ]
+
+def _decode_worker(items, image_size):
+    return _pack_masks(_decode(items, image_size))
+
+def _render(buffer, pixels, items, source_path, output_dir, encoding, return_image):
+    # Image.fromarray maps the shared block without copying it
+    view = np.ndarray(pixels.shape, dtype=np.uint8, buffer=buffer)
+    image = Image.fromarray(view)
+    masks = _decode(items, image.size)
+    rendered = plot_segmentation_masks(image, masks)
+
+    output_path = None
+    if source_path is not None:
+        output_path = save_rendered_masks(rendered, source_path, output_dir, encoding)
+    if return_image:
+        # The rendering goes back through the same block
+        view[...] = np.asarray(rendered.convert("RGBA"))
+    return output_path, _pack_masks(masks)
+
+def _render_worker(pixels, items, source_path, output_dir, encoding, return_image):
+    block = shared_memory.SharedMemory(name=pixels.name)
+    try:
+        return _render(block.buf, pixels, items, source_path, output_dir, encoding, return_image)
+    except BaseException as e:
+        # The traceback holds views of the block, which would keep it from closing
+        traceback.clear_frames(e.__traceback__)
+        raise
+    finally:
+        block.close()
+
+def _chain(future, fn, cleanup=None):
+    """A future resolving to `fn(result)` of `future`, running `cleanup` once it is done either way."""
+    chained = Future()
+
+    def done(future):
+        try:
+            chained.set_result(fn(future.result()))
+        except BaseException as e:
+            chained.set_exception(e)
+        finally:
+            if cleanup is not None:
+                cleanup()
+
+    future.add_done_callback(done)
+    return chained
+
+class MaskWorkerPool:
+    """
+    Decodes segmentation masks and renders them in worker processes.
+
+    Mask decoding (base64, PNG, bilinear resize), compositing and encoding
+    are pure CPU work. On a thread they hold the GIL against the threads
+    waiting on model responses; here they run in parallel, one image per
+    process. Work goes in as response items (or the raw response JSON) and
+    comes back as compact masks packed at one bit per pixel. Image pixels
+    cross between processes through a shared memory block instead of being
+    pickled: the parent writes the image once, the worker maps it without
+    copying and, if asked, writes the rendering back into the same block.
+
+    Workers are started with `spawn`, which is safe next to the request
+    threads; each imports `image_detection` but needs no credentials. Use as
+    a context manager, or call `close`, to shut the workers down.
+
+    Stages timed inside the workers are recorded in their own `metrics`, not
+    the parent's; the parent records each call's time from submission to
+    result as the 'mask_workers.decode' and 'mask_workers.render' stages.
+
+    Args:
+        max_workers (int): Number of worker processes; defaults to the CPU count.
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or os.cpu_count()
+        self._executor = ProcessPoolExecutor(self.max_workers, mp_context=get_context("spawn"))
+
+    def decode(self, items, image_size):
+        """
+        Decode the masks of a segmentation response in a worker process.
+
+        Args:
+            items (str | list[SegmentationItem] | list[tuple[Tile, list[SegmentationItem]]]): The raw
+                response JSON, its parsed items, or the per-tile items of `request_tiled_items`.
+            image_size (tuple[int, int]): (width, height) of the image the masks belong to.
+        Returns:
+            Future: Resolves to the list of SegmentationMask, thresholded to 0/255.
+        """
+        started = time.perf_counter()
+        future = self._executor.submit(_decode_worker, items, image_size)
+
+        def finish(packed):
+            metrics.observe('mask_workers.decode', time.perf_counter() - started)
+            return _unpack_masks(packed, image_size)
+
+        return _chain(future, finish)
+
+    def render(self, image, items, source_path=None, output_dir=None, encoding=None, return_image=False):
+        """
+        Decode the masks of a segmentation response and render them onto `image` in a worker process.
+
+        Args:
+            image (PIL.Image): The analyzed image.
+            items (str | list[SegmentationItem] | list[tuple[Tile, list[SegmentationItem]]]): The raw
+                response JSON, its parsed items, or the per-tile items of `request_tiled_items`.
+            source_path (Path): With `output_dir`, the worker saves the rendering
+                there as masks_<name> (see `save_rendered_masks`).
+            output_dir (Path): Folder the rendering is saved to.
+            encoding (OutputEncoding): Output encoding of the saved rendering.
+            return_image (bool): Also return the rendering as an RGBA image.
+        Returns:
+            Future: Resolves to RenderedMasks.
+        """
+        started = time.perf_counter()
+        width, height = image.size
+        pixels_image = image.convert("RGBA")
+        # The block may be rounded up to whole pages, so only the first width * height * 4 bytes are pixels
+        block = shared_memory.SharedMemory(create=True, size=width * height * 4)
+
+        def release():
+            block.close()
+            block.unlink()
+
+        try:
+            data = pixels_image.tobytes()
+            block.buf[:len(data)] = data
+            future = self._executor.submit(
+                _render_worker, SharedPixels(block.name, width, height), items,
+                source_path if output_dir is not None else None, output_dir, encoding, return_image,
+            )
+        except BaseException:
+            release()
+            raise
+
+        def finish(result):
+            metrics.observe('mask_workers.render', time.perf_counter() - started)
+            output_path, packed = result
+            rendered = None
+            if return_image:
+                rendered = Image.fromarray(np.ndarray((height, width, 4), dtype=np.uint8, buffer=block.buf).copy())
+            return RenderedMasks(output_path, _unpack_masks(packed, image.size), rendered)
+
+        return _chain(future, finish, release)
+
+    def close(self):
+        """Wait for queued work and stop the worker processes."""
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
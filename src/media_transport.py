@@ -0,0 +1,174 @@
+import datetime
+import functools
+import hashlib
+import json
+import mimetypes
+import os
+import threading
+import time
+from metrics import metrics
+
+# Requests are capped at 20MB and inline bytes are base64 encoded on the wire,
+# so anything bigger than this goes through the Files API instead.
+INLINE_MAX_BYTES = 14 * 1024 * 1024
+
+# Size of the blocks read from disk when hashing
+CHUNK_SIZE = 8 * 1024 * 1024
+
+UPLOAD_CACHE_PATH = os.path.join('.cache', 'uploads.json')
+
+# Mime types accepted by Gemini that differ from the ones in `mimetypes`
+VIDEO_MIME_TYPES = {
+    '.mov': 'video/mov',
+    '.mp4': 'video/mp4',
+    '.mpeg': 'video/mpeg',
+    '.mpg': 'video/mpg',
+    '.avi': 'video/avi',
+    '.flv': 'video/x-flv',
+    '.webm': 'video/webm',
+    '.wmv': 'video/wmv',
+    '.3gp': 'video/3gpp',
+}
+
+_cache_lock = threading.Lock()
+
+def guess_mime_type(path):
+    """Guess the mime type of a media file from its extension."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension in VIDEO_MIME_TYPES:
+        return VIDEO_MIME_TYPES[extension]
+    mime_type, _ = mimetypes.guess_type(path)
+    return mime_type or 'application/octet-stream'
+
+def file_sha256(path):
+    """Hash a file in fixed-size chunks without loading it into memory."""
+    # Repeated calls for an unchanged file are answered from memory
+    stat = os.stat(path)
+    return _file_sha256(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+@functools.lru_cache(maxsize=256)
+def _file_sha256(path, size, mtime_ns):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _load_upload_cache(cache_path):
+    try:
+        with open(cache_path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def _save_upload_cache(cache_path, cache):
+    os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp_path, cache_path)
+
+def _is_unexpired(entry, margin_seconds=600):
+    expiration_time = entry.get('expiration_time')
+    if not expiration_time:
+        return True
+    expires = datetime.datetime.fromisoformat(expiration_time)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return (expires - now).total_seconds() > margin_seconds
+
+def _wait_until_active(client, file, poll_interval=2.0, timeout=600.0):
+    """Poll an uploaded file until the service has finished processing it."""
+    from google.genai import types
+
+    deadline = time.monotonic() + timeout
+    while file.state == types.FileState.PROCESSING:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"File {file.name} was still processing after {timeout}s")
+        time.sleep(poll_interval)
+        file = client.files.get(name=file.name)
+    if file.state == types.FileState.FAILED:
+        raise RuntimeError(f"File {file.name} failed processing: {file.error}")
+    return file
+
+def upload_file(client, path, mime_type=None, cache_path=UPLOAD_CACHE_PATH):
+    """
+    Uploads a file through the Files API, reusing earlier uploads of the same content.
+
+    The open file is handed to the SDK, which reads and sends it in the
+    chunks of its resumable upload protocol, so it is never held in memory
+    here. The returned URI is cached under the SHA-256 of the file content
+    until shortly before the uploaded file expires.
+
+    Args:
+        client (genai.Client): Client used for the upload.
+        path (str): Path to the file to upload.
+        mime_type (str): Mime type of the file. Guessed from the extension if omitted.
+        cache_path (str): JSON file mapping content hashes to uploaded files.
+    Returns:
+        types.FileData pointing at the uploaded file.
+    """
+    from google.genai import types
+
+    mime_type = mime_type or guess_mime_type(path)
+    digest = file_sha256(path)
+
+    with _cache_lock:
+        entry = _load_upload_cache(cache_path).get(digest)
+    if entry and _is_unexpired(entry):
+        metrics.increment('upload_cache_hits')
+        return types.FileData(file_uri=entry['uri'], mime_type=entry['mime_type'])
+
+    with metrics.span('upload'), open(path, 'rb') as f:
+        file = client.files.upload(
+            file=f,
+            config=types.UploadFileConfig(mime_type=mime_type, display_name=os.path.basename(path)),
+        )
+    metrics.increment('bytes_uploaded', os.path.getsize(path))
+    with metrics.span('upload.processing'):
+        file = _wait_until_active(client, file)
+
+    with _cache_lock:
+        cache = _load_upload_cache(cache_path)
+        cache[digest] = {
+            'uri': file.uri,
+            'name': file.name,
+            'mime_type': file.mime_type or mime_type,
+            'expiration_time': file.expiration_time.isoformat() if file.expiration_time else None,
+        }
+        _save_upload_cache(cache_path, cache)
+
+    return types.FileData(file_uri=file.uri, mime_type=file.mime_type or mime_type)
+
+def media_part(client, path, mime_type=None, video_metadata=None, inline_max_bytes=INLINE_MAX_BYTES):
+    """
+    Builds the request part for a local media file.
+
+    Small files are sent inline; larger ones are uploaded through the Files API
+    (see `upload_file`) and referenced by URI.
+
+    Args:
+        client (genai.Client): Client used if the file has to be uploaded.
+        path (str): Path to the media file.
+        mime_type (str): Mime type of the file. Guessed from the extension if omitted.
+        video_metadata (types.VideoMetadata): Optional clipping offsets for videos.
+        inline_max_bytes (int): Largest file size sent as inline bytes.
+    Returns:
+        types.Part referencing the media.
+    """
+    from google.genai import types
+
+    mime_type = mime_type or guess_mime_type(path)
+
+    if os.path.getsize(path) <= inline_max_bytes:
+        with open(path, 'rb') as f:
+            data = f.read()
+        metrics.increment('bytes_inline', len(data))
+        return types.Part(
+            inline_data=types.Blob(data=data, mime_type=mime_type),
+            video_metadata=video_metadata,
+        )
+
+    return types.Part(
+        file_data=upload_file(client, path, mime_type=mime_type),
+        video_metadata=video_metadata,
+    )
@@ -0,0 +1,192 @@
+import bisect
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+# Upper bounds (seconds) of the latency histogram buckets; the last bucket is +Inf
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Token counts of `response.usage_metadata`, by the counter they are added to
+USAGE_COUNTERS = {
+    'prompt_token_count': 'prompt_tokens',
+    'candidates_token_count': 'output_tokens',
+    'thoughts_token_count': 'thinking_tokens',
+    'cached_content_token_count': 'cached_tokens',
+    'total_token_count': 'total_tokens',
+}
+
+# Shared by every disabled span; entering and leaving it does nothing
+_NULL_SPAN = contextlib.nullcontext()
+
+class Histogram:
+    """Latency observations of one stage, in fixed buckets plus count, sum and max."""
+
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Estimate of the `q` quantile: the upper bound of the bucket it falls in (capped at the max seen)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.bucket_counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+class _Span:
+    """Times one stage from `__enter__` to `__exit__`."""
+    __slots__ = ('metrics', 'stage', 'started')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.stage, time.perf_counter() - self.started)
+
+class Metrics:
+    """
+    Thread-safe span timers, counters and per-stage latency histograms.
+
+    Stages are timed with `span`, a context manager that adds the elapsed
+    seconds to the stage's histogram, or with the `timed` decorator.
+    Counters accumulate totals such as bytes uploaded and tokens used. When
+    disabled, `span` hands out a shared no-op context and the other methods
+    return at once, so instrumented code pays one attribute check per call.
+
+    Args:
+        enabled (bool): Whether anything is recorded.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def span(self, stage):
+        """Context manager timing a stage, e.g. `with metrics.span('segmentation.decode'):`."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, stage)
+
+    def timed(self, stage):
+        """Decorator timing every call of a function as a stage."""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with _Span(self, stage):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def observe(self, stage, seconds):
+        """Add a latency measured elsewhere to the stage's histogram."""
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, counter, value=1):
+        """Add `value` to a counter."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + value
+
+    def record_usage(self, usage_metadata):
+        """Add the token counts of a response's `usage_metadata` to the token counters."""
+        if not self.enabled or usage_metadata is None:
+            return
+        with self._lock:
+            for field, counter in USAGE_COUNTERS.items():
+                value = getattr(usage_metadata, field, None)
+                if value:
+                    self._counters[counter] = self._counters.get(counter, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def snapshot(self):
+        """
+        Everything recorded so far as a JSON-serializable dict.
+
+        Returns:
+            dict: 'counters' by name, and 'stages' with the count, total,
+                mean, p50, p95 and max seconds of each stage.
+        """
+        with self._lock:
+            stages = {
+                stage: {
+                    'count': histogram.count,
+                    'total_seconds': round(histogram.sum, 6),
+                    'mean_seconds': round(histogram.sum / histogram.count, 6),
+                    'p50_seconds': round(histogram.quantile(0.5), 6),
+                    'p95_seconds': round(histogram.quantile(0.95), 6),
+                    'max_seconds': round(histogram.max, 6),
+                }
+                for stage, histogram in sorted(self._histograms.items())
+            }
+            return {'counters': dict(sorted(self._counters.items())), 'stages': stages}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self, prefix='analyzer'):
+        """Everything recorded so far in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for counter, value in sorted(self._counters.items()):
+                lines.append(f'# TYPE {prefix}_{counter}_total counter')
+                lines.append(f'{prefix}_{counter}_total {value}')
+
+            if self._histograms:
+                name = f'{prefix}_stage_seconds'
+                lines.append(f'# TYPE {name} histogram')
+                for stage, histogram in sorted(self._histograms.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + (float('inf'),), histogram.bucket_counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                        lines.append(f'{name}_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                    lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum:.6f}')
+                    lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write everything recorded so far to `path`: Prometheus text for .prom/.txt, JSON otherwise."""
+        text = self.to_prometheus() if path.endswith(('.prom', '.txt')) else self.to_json()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(text)
+
+# Shared registry used by the analyzers. Set ANALYZER_METRICS=1 (or call
+# `metrics.enabled = True`) to record.
+metrics = Metrics(enabled=os.environ.get('ANALYZER_METRICS') == '1')
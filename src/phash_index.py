@@ -0,0 +1,232 @@
+from PIL import Image
+import contextlib
+import hashlib
+import json
+import os
+import threading
+import time
+import numpy as np
+
+PHASH_INDEX_PATH = os.path.join('.cache', 'phash_index.jsonl')
+
+def _dct_matrix(size):
+    """Orthonormal DCT-II basis, so the 2D DCT of X is D @ X @ D.T."""
+    n = np.arange(size)
+    matrix = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+_DCT_32 = _dct_matrix(32)
+
+def _bits_to_int(bits):
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), 'big')
+
+def dhash(image: Image.Image, hash_size: int = 8) -> int:
+    """Difference hash: whether each pixel of a tiny grayscale copy is brighter than its right neighbour."""
+    pixels = np.asarray(image.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR), dtype=np.int16)
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+def phash(image: Image.Image) -> int:
+    """
+    64-bit perceptual hash: the signs of the lowest 8x8 DCT coefficients of
+    a 32x32 grayscale copy relative to their median.
+    """
+    pixels = np.asarray(image.convert('L').resize((32, 32), Image.Resampling.LANCZOS), dtype=np.float64)
+    low = (_DCT_32 @ pixels @ _DCT_32.T)[:8, :8]
+    return _bits_to_int(low > np.median(low))
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+class BKTree:
+    """
+    Burkhard-Keller tree over integer hashes under Hamming distance.
+
+    Searches only descend into children whose edge distance is within the
+    query radius of the node's distance, by the triangle inequality.
+    """
+
+    def __init__(self):
+        self._root = None  # [hash, values, {distance: child}]
+
+    def add(self, hash_value: int, value):
+        if self._root is None:
+            self._root = [hash_value, [value], {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming_distance(hash_value, node[0])
+            if distance == 0:
+                node[1].append(value)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [hash_value, [value], {}]
+                return
+            node = child
+
+    def search(self, hash_value: int, max_distance: int):
+        """Return (distance, value) for every value within `max_distance`, nearest first."""
+        results = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(hash_value, node[0])
+            if distance <= max_distance:
+                results.extend((distance, value) for value in node[1])
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        results.sort(key=lambda result: result[0])
+        return results
+
+class PerceptualHashIndex:
+    """
+    Persistent index of analyzed images by perceptual hash.
+
+    Each entry stores the pHash and size of an analyzed image, a namespace
+    (which analysis produced it) and a JSON-serializable payload, usually the
+    model's detections in normalized 0-1000 coordinates, which stay valid
+    for a rescaled near-duplicate.
+
+    The index at `path` is an append-only JSONL log, one small line per
+    added entry, reloaded into a BK-tree on start. Payloads, which can hold
+    base64 PNG masks, are kept apart in `<path>.payloads/` as files named
+    after their SHA-256, and only read on a hit. Loading compacts the log:
+    entries older than `max_age_seconds`, beyond the newest `max_entries`,
+    or superseded by a newer one for the same hash and namespace are
+    dropped, and so are the payloads no entry refers to any more.
+
+    Args:
+        path (str): JSONL log backing the index, or None to keep it in memory.
+        max_distance (int): Largest Hamming distance (of 64 bits) still
+            considered a near-duplicate.
+        max_entries (int): Most entries kept when the index is loaded.
+        max_age_seconds (float): Age after which an entry is dropped on load.
+    """
+
+    def __init__(self, path=PHASH_INDEX_PATH, max_distance=4, max_entries=10000, max_age_seconds=30 * 24 * 3600):
+        self.path = path
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self.payload_dir = f'{path}.payloads' if path is not None else None
+        self._entries = []
+        self._payloads = {}  # payloads of an in-memory index, by key
+        self._tree = BKTree()
+        self._lock = threading.Lock()
+        if path is not None:
+            self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _insert(self, entry):
+        self._tree.add(int(entry['hash'], 16), len(self._entries))
+        self._entries.append(entry)
+
+    def _load(self):
+        """Read the log, keep the entries within the caps and rewrite it if anything was dropped."""
+        lines = 0
+        latest = {}
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        entry = json.loads(line)
+                        key = (entry['hash'], entry['namespace'])
+                    except (json.JSONDecodeError, KeyError, TypeError):
+                        # A torn last line from an interrupted write
+                        continue
+                    # The newest entry for a hash and namespace wins, in the order it was added
+                    latest.pop(key, None)
+                    latest[key] = entry
+        except FileNotFoundError:
+            return
+
+        cutoff = time.time() - self.max_age_seconds
+        entries = [entry for entry in latest.values() if entry['created'] >= cutoff][-self.max_entries:]
+        for entry in entries:
+            self._insert(entry)
+        if len(entries) < lines:
+            self._compact()
+
+    def _compact(self):
+        """Rewrite the log with the loaded entries and delete unreferenced payloads."""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for entry in self._entries:
+                f.write(json.dumps(entry) + '\n')
+        os.replace(tmp_path, self.path)
+
+        referenced = {f"{entry['payload_key']}.json" for entry in self._entries}
+        try:
+            names = os.listdir(self.payload_dir)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name not in referenced:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(self.payload_dir, name))
+
+    def _read_payload(self, key):
+        if self.payload_dir is None:
+            return self._payloads[key]
+        with open(os.path.join(self.payload_dir, f'{key}.json'), 'r') as f:
+            return json.load(f)
+
+    def _write_payload(self, payload):
+        """Store `payload` under the SHA-256 of its JSON and return that key; identical payloads are stored once."""
+        data = json.dumps(payload, sort_keys=True)
+        key = hashlib.sha256(data.encode()).hexdigest()
+        if self.payload_dir is None:
+            self._payloads[key] = payload
+            return key
+        path = os.path.join(self.payload_dir, f'{key}.json')
+        if not os.path.exists(path):
+            os.makedirs(self.payload_dir, exist_ok=True)
+            tmp_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return key
+
+    def lookup(self, image: Image.Image, namespace: str = 'default', hash_value: int | None = None):
+        """
+        Find the nearest analyzed near-duplicate of `image` in `namespace`.
+
+        Returns:
+            dict | None: The entry (with 'hash', 'size', 'namespace' and 'payload'), or None.
+        """
+        hash_value = phash(image) if hash_value is None else hash_value
+        with self._lock:
+            # Nearest first, and the newest of equally near ones
+            matches = sorted(self._tree.search(hash_value, self.max_distance), key=lambda match: (match[0], -match[1]))
+            for _, position in matches:
+                entry = self._entries[position]
+                if entry['namespace'] != namespace:
+                    continue
+                try:
+                    payload = self._read_payload(entry['payload_key'])
+                except (FileNotFoundError, json.JSONDecodeError):
+                    continue
+                return dict(entry, payload=payload)
+        return None
+
+    def add(self, image: Image.Image, payload, namespace: str = 'default', hash_value: int | None = None):
+        """Record the analysis `payload` of `image`, appending one line to the log."""
+        hash_value = phash(image) if hash_value is None else hash_value
+        entry = {
+            'hash': f'{hash_value:016x}',
+            'size': list(image.size),
+            'namespace': namespace,
+            'payload_key': self._write_payload(payload),
+            'created': time.time(),
+        }
+        with self._lock:
+            self._insert(entry)
+            if self.path is not None:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
@@ -0,0 +1,81 @@
+import random
+import threading
+import time
+
+class TokenBucket:
+    """
+    Thread-safe token bucket that refills continuously up to its capacity.
+
+    Args:
+        capacity (float): Maximum number of tokens the bucket can hold.
+        refill_per_second (float): Tokens added to the bucket every second.
+    """
+
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self._tokens = capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.refill_per_second)
+        self._last_refill = now
+
+    def acquire(self, tokens: float = 1.0):
+        """Block until `tokens` are available, then take them."""
+        # A request larger than the bucket would otherwise wait forever
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.refill_per_second
+            time.sleep(wait)
+
+class RateLimiter:
+    """
+    Limits calls to requests-per-minute and tokens-per-minute quotas.
+
+    Either quota can be None to leave it unlimited.
+    """
+
+    def __init__(self, requests_per_minute: float | None = None, tokens_per_minute: float | None = None):
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute / 60) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60) if tokens_per_minute else None
+
+    def acquire(self, tokens: float = 0):
+        """Block until one request carrying `tokens` input tokens fits in both quotas."""
+        if self.requests is not None:
+            self.requests.acquire(1)
+        if self.tokens is not None and tokens > 0:
+            self.tokens.acquire(tokens)
+
+def is_retryable(error: Exception) -> bool:
+    """Whether an API error is a rate limit (429) or a server-side (5xx) failure."""
+    from google.genai import errors
+
+    return isinstance(error, errors.APIError) and (error.code == 429 or error.code >= 500)
+
+def call_with_retry(fn, *args, max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0, **kwargs):
+    """
+    Calls `fn`, retrying with exponential backoff and full jitter on 429/5xx errors.
+
+    Args:
+        fn: The function to call.
+        max_retries (int): Number of retries after the first attempt.
+        base_delay (float): Delay in seconds before the first retry.
+        max_delay (float): Upper bound for a single delay in seconds.
+    Returns:
+        The return value of `fn`.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            time.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
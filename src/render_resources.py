@@ -0,0 +1,63 @@
+from PIL import ImageColor, ImageFont
+import functools
+
+# Fonts tried in order: the macOS/Windows Arial the renderers were designed
+# with, then the usual Linux stand-ins, by file name (found through the
+# system font paths) and by full path.
+FONT_CANDIDATES = {
+    False: [
+        "arial.ttf",
+        "Arial.ttf",
+        "LiberationSans-Regular.ttf",
+        "DejaVuSans.ttf",
+        "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
+        "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+        "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+    ],
+    True: [
+        "Arial Bold.ttf",
+        "arialbd.ttf",
+        "LiberationSans-Bold.ttf",
+        "DejaVuSans-Bold.ttf",
+        "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf",
+        "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+        "/usr/share/fonts/dejavu/DejaVuSans-Bold.ttf",
+    ],
+}
+
+# Mask and box colours, cycled through by index
+PALETTE = [
+    'red', 'green', 'blue', 'yellow', 'orange', 'pink', 'purple', 'brown',
+    'gray', 'beige', 'turquoise', 'cyan', 'magenta', 'lime', 'navy', 'maroon',
+    'teal', 'olive', 'coral', 'lavender', 'violet', 'gold', 'silver',
+]
+
+# Distinct colours for the boxes drawn on one video frame; all readable under white label text
+DETECTION_COLORS = [
+    'red', 'blue', 'green', 'darkorange', 'purple', 'magenta',
+    'teal', 'navy', 'maroon', 'olive', 'crimson', 'darkcyan',
+]
+
+@functools.lru_cache(maxsize=None)
+def get_font(size: int, bold: bool = False):
+    """
+    Load a font once per (size, bold) and reuse it.
+
+    Goes through FONT_CANDIDATES and falls back to Pillow's built-in font,
+    scalable since Pillow 10.1 and fixed-size before that, so rendering
+    never fails on a machine without Arial.
+    """
+    for candidate in FONT_CANDIDATES[bold]:
+        try:
+            return ImageFont.truetype(candidate, size)
+        except OSError:
+            continue
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:
+        return ImageFont.load_default()
+
+@functools.lru_cache(maxsize=None)
+def color_to_rgb(color: str) -> tuple[int, int, int]:
+    """RGB tuple of a colour name, parsed once and then served from the cache."""
+    return ImageColor.getrgb(color)[:3]
@@ -0,0 +1,239 @@
+from PIL import Image
+import base64
+import dataclasses
+import hashlib
+import io
+import itertools
+import json
+import os
+import random
+import threading
+import time
+import numpy as np
+from video_frames import seconds_to_timestamp
+
+RESPONSE_KINDS = ('segmentation', 'video')
+
+# Types given to synthetic detections, in turn
+PATTERN_TYPES = ('Fake urgency', 'Hidden costs', 'Confirmation Shaming', 'Disguised Ads', 'Preselection')
+
+@dataclasses.dataclass
+class ReplayUsage:
+    """Stand-in for `usage_metadata`; output tokens are estimated at 4 characters each."""
+    candidates_token_count: int
+    total_token_count: int
+
+@dataclasses.dataclass
+class ReplayResponse:
+    """Stand-in for a `GenerateContentResponse` (or one chunk of a stream)."""
+    text: str
+    usage_metadata: ReplayUsage | None = None
+
+@dataclasses.dataclass
+class ReplayFile:
+    """Stand-in for a file uploaded through the Files API, active at once."""
+    name: str
+    uri: str
+    mime_type: str
+    state: object
+    expiration_time: None = None
+    error: None = None
+
+def request_kind(contents):
+    """'segmentation' for segmentation-mask prompts, 'video' for everything else."""
+    texts = []
+
+    def collect(value):
+        if isinstance(value, str):
+            texts.append(value)
+        elif isinstance(value, (list, tuple)):
+            for v in value:
+                collect(v)
+        elif getattr(value, 'parts', None) is not None:
+            collect(value.parts)
+        elif getattr(value, 'text', None) is not None:
+            texts.append(value.text)
+
+    collect(contents)
+    return 'segmentation' if any('segmentation masks' in text for text in texts) else 'video'
+
+def synthetic_segmentation_response(rng, count=8, image_size=(1024, 768)):
+    """
+    A segmentation response as the model would send it: a JSON list of boxes
+    in 0-1000 coordinates with base64 PNG masks of elliptic blobs, each about
+    the pixel size of its box on an image of `image_size`.
+    """
+    width, height = image_size
+    items = []
+    for i in range(count):
+        y0, x0 = int(rng.integers(0, 700)), int(rng.integers(0, 700))
+        y1, x1 = y0 + int(rng.integers(100, 300)), x0 + int(rng.integers(100, 300))
+        mask_w, mask_h = max(8, (x1 - x0) * width // 1000), max(8, (y1 - y0) * height // 1000)
+        yy, xx = np.mgrid[-1:1:complex(0, mask_h), -1:1:complex(0, mask_w)]
+        mask = ((xx ** 2 + yy ** 2 < 0.8 + 0.2 * rng.random((mask_h, mask_w))) * 255).astype(np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(mask).save(buffer, format='PNG')
+        data_url = 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode()
+        items.append({
+            'box_2d': [y0, x0, y1, x1], 'mask': data_url, 'label': f'pattern {i}',
+            'type': PATTERN_TYPES[i % len(PATTERN_TYPES)], 'confidence': int(rng.integers(40, 100)),
+        })
+    return json.dumps(items)
+
+def synthetic_video_response(rng, duration_seconds, count=10):
+    """A video detection response: `count` events at random timestamps within `duration_seconds`."""
+    items = []
+    for seconds in sorted(rng.uniform(0, duration_seconds, count)):
+        y0, x0 = int(rng.integers(0, 700)), int(rng.integers(0, 700))
+        items.append({
+            'timestamp': seconds_to_timestamp(min(seconds, duration_seconds - 1)),
+            'type': PATTERN_TYPES[len(items) % len(PATTERN_TYPES)],
+            'description': 'A countdown timer pressures the user.',
+            'bounding_box': [y0, x0, y0 + int(rng.integers(50, 300)), x0 + int(rng.integers(50, 300))],
+            'confidence': int(rng.integers(40, 100)),
+        })
+    return json.dumps(items)
+
+def load_recordings(directory):
+    """
+    Read recorded responses saved by `RecordingClient`.
+
+    Returns:
+        dict[str, list[str]]: Response texts by request kind.
+    """
+    recordings = {}
+    for kind in RESPONSE_KINDS:
+        kind_dir = os.path.join(directory, kind)
+        if not os.path.isdir(kind_dir):
+            continue
+        for name in sorted(os.listdir(kind_dir)):
+            with open(os.path.join(kind_dir, name), 'r') as f:
+                recordings.setdefault(kind, []).append(f.read())
+    return recordings
+
+class ReplayClient:
+    """
+    Offline stand-in for `genai.Client` that replays recorded responses.
+
+    Requests are answered in turn from the responses recorded for their kind
+    (see `request_kind`) after a simulated model latency of `latency` plus
+    or minus up to `jitter` seconds. Streams yield the response in chunks of
+    `chunk_chars` characters, `chunk_seconds` apart, after the same latency
+    to the first chunk. Install it with `genai_client.set_client` to drive
+    the analyzers without a network.
+
+    Args:
+        responses (dict[str, list[str]]): Response texts by request kind, e.g.
+            from `load_recordings`.
+        latency (float): Mean seconds until a response (or its first chunk).
+        jitter (float): Largest deviation from `latency`, drawn uniformly.
+        chunk_chars (int): Characters per streamed chunk.
+        chunk_seconds (float): Seconds between streamed chunks.
+        seed (int): Seed of the latency jitter.
+    """
+
+    def __init__(self, responses, latency=0.0, jitter=0.0, chunk_chars=200, chunk_seconds=0.01, seed=0):
+        missing = [kind for kind in RESPONSE_KINDS if not responses.get(kind)]
+        if missing:
+            raise ValueError(f"No responses to replay for: {', '.join(missing)}")
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_chars = chunk_chars
+        self.chunk_seconds = chunk_seconds
+        self._responses = {kind: itertools.cycle(texts) for kind, texts in responses.items()}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.models = _ReplayModels(self)
+        self.files = _ReplayFiles()
+
+    def _next(self, contents):
+        """The next response text for the request and the simulated latency before it."""
+        with self._lock:
+            text = next(self._responses[request_kind(contents)])
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+        return text, delay
+
+    @staticmethod
+    def _usage(text):
+        tokens = len(text) // 4
+        return ReplayUsage(candidates_token_count=tokens, total_token_count=tokens)
+
+class _ReplayModels:
+    def __init__(self, client):
+        self._client = client
+
+    def generate_content(self, model, contents, config=None):
+        text, delay = self._client._next(contents)
+        time.sleep(delay)
+        return ReplayResponse(text, self._client._usage(text))
+
+    def generate_content_stream(self, model, contents, config=None):
+        text, delay = self._client._next(contents)
+        time.sleep(delay)
+        size = self._client.chunk_chars
+        for start in range(0, len(text), size):
+            if start:
+                time.sleep(self._client.chunk_seconds)
+            is_last = start + size >= len(text)
+            yield ReplayResponse(text[start:start + size], self._client._usage(text) if is_last else None)
+
+class _ReplayFiles:
+    """Accepts uploads (reading them through, like a real upload) and reports them active at once."""
+
+    def __init__(self):
+        self._files = {}
+
+    def upload(self, file, config=None):
+        from google.genai import types
+
+        digest = hashlib.sha256()
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+        name = f'files/{digest.hexdigest()[:16]}'
+        mime_type = getattr(config, 'mime_type', None) or 'application/octet-stream'
+        self._files[name] = ReplayFile(name, f'replay://{name}', mime_type, types.FileState.ACTIVE)
+        return self._files[name]
+
+    def get(self, name):
+        return self._files[name]
+
+class RecordingClient:
+    """
+    Wraps a real client and saves every response text to `directory`, by request kind, for `ReplayClient`.
+
+    Args:
+        client (genai.Client): The client making the requests.
+        directory (str): Folder the responses are saved to, as <kind>/<sha256>.json.
+    """
+
+    def __init__(self, client, directory):
+        self._client = client
+        self.directory = directory
+        self.models = _RecordingModels(self)
+        self.files = client.files
+
+    def save(self, contents, text):
+        if not text:
+            return
+        kind_dir = os.path.join(self.directory, request_kind(contents))
+        os.makedirs(kind_dir, exist_ok=True)
+        path = os.path.join(kind_dir, f'{hashlib.sha256(text.encode()).hexdigest()[:16]}.json')
+        with open(path, 'w') as f:
+            f.write(text)
+
+class _RecordingModels:
+    def __init__(self, recorder):
+        self._recorder = recorder
+
+    def generate_content(self, model, contents, config=None):
+        response = self._recorder._client.models.generate_content(model=model, contents=contents, config=config)
+        self._recorder.save(contents, response.text)
+        return response
+
+    def generate_content_stream(self, model, contents, config=None):
+        texts = []
+        for chunk in self._recorder._client.models.generate_content_stream(model=model, contents=contents, config=config):
+            if chunk.text:
+                texts.append(chunk.text)
+            yield chunk
+        self._recorder.save(contents, ''.join(texts))
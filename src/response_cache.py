@@ -0,0 +1,292 @@
+from PIL import Image
+import dataclasses
+import hashlib
+import json
+import os
+import threading
+import time
+import typing
+from metrics import metrics
+
+CACHE_DIR = os.path.join('.cache', 'responses')
+
+@dataclasses.dataclass
+class CachedResponse:
+    """Stand-in for a `GenerateContentResponse` served from the cache."""
+    text: str
+    usage_metadata: None = None
+
+@dataclasses.dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+def _fingerprint(value, media_key=None):
+    """
+    Reduces request contents or config to a JSON-serializable structure for hashing.
+
+    Media bytes and images are replaced by their SHA-256. When `media_key` is
+    given it stands for all media in the request, so inline bytes and file
+    URIs (which change every time a file is re-uploaded) are left out.
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, bytes):
+        return {'sha256': hashlib.sha256(value).hexdigest()}
+    if isinstance(value, Image.Image):
+        digest = hashlib.sha256(value.tobytes()).hexdigest()
+        return {'image': [value.mode, list(value.size), digest]}
+    if isinstance(value, dict):
+        if media_key is not None:
+            value = {k: v for k, v in value.items() if k not in ('inline_data', 'file_data')}
+        return {str(k): _fingerprint(v, media_key) for k, v in sorted(value.items(), key=lambda kv: str(kv[0]))}
+    if isinstance(value, (list, tuple)):
+        return [_fingerprint(v, media_key) for v in value]
+    if typing.get_origin(value) is not None:
+        # Generic response schemas such as list[Model], keyed by their arguments' schemas
+        origin = typing.get_origin(value)
+        return {'generic': getattr(origin, '__qualname__', repr(origin)), 'args': [_fingerprint(arg) for arg in typing.get_args(value)]}
+    if isinstance(value, type) and hasattr(value, 'model_json_schema'):
+        # Pydantic model classes used as response schemas
+        return {'schema': value.model_json_schema()}
+    if hasattr(value, 'model_dump'):
+        return _fingerprint(value.model_dump(exclude_none=True), media_key)
+    # Anything else is keyed by its repr
+    return {'repr': repr(value)}
+
+class ResponseCache:
+    """
+    Persistent on-disk cache of model responses, keyed by content.
+
+    Each entry is a JSON file named after the SHA-256 of the model name, the
+    request contents (with media reduced to content hashes) and the request
+    config. Entries expire after `ttl_seconds`, and the least recently used
+    entries are evicted once the cache grows past `max_bytes`.
+
+    Args:
+        cache_dir (str): Directory holding the cache entries.
+        max_bytes (int): Size the cache is trimmed back to after a write.
+        ttl_seconds (float): Age after which an entry is no longer served.
+        bypass (bool): Skip cache reads and always call the model. Fresh
+            responses are still written, so this also refreshes entries.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=512 * 1024 * 1024, ttl_seconds=7 * 24 * 3600, bypass=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.bypass = bypass
+        self.stats = CacheStats()
+        self._size = None
+        self._lock = threading.Lock()
+
+    def key(self, model, contents, config=None, media_key=None):
+        """Compute the cache key of a request."""
+        payload = {
+            'model': model,
+            'contents': _fingerprint(contents, media_key),
+            'config': _fingerprint(config),
+            'media_key': media_key,
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f'{key}.json')
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.json'):
+                    yield os.path.join(root, name)
+
+    def get(self, key):
+        """Return the cached response text for `key`, or None."""
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        if time.time() - entry['created'] > self.ttl_seconds:
+            self._remove(path)
+            return None
+
+        # The modification time tracks the last use for LRU eviction
+        os.utime(path)
+        return entry['text']
+
+    def put(self, key, text, model=None):
+        """Store the response text for `key` and evict entries if over budget."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps({'created': time.time(), 'model': model, 'text': text})
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(os.path.getsize(p) for p in self._entries())
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size -= size
+
+    def _evict(self):
+        """Delete least recently used entries until the cache fits in `max_bytes`. Caller holds the lock."""
+        entries = []
+        for path in self._entries():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+            self.stats.evictions += 1
+
+    def _cached(self, key, parse):
+        """
+        The cached text for `key` and its parsed items (None without `parse`), or (None, None) on a miss.
+
+        An entry that does not parse is dropped, so it counts as a miss.
+        """
+        text = self.get(key)
+        if text is None or parse is None:
+            return text, None
+        try:
+            return text, parse(text)
+        except Exception:
+            self._remove(self._path(key))
+            return None, None
+
+    def generate_content(self, client, model, contents, config=None, media_key=None, parse=None, limiter=None, tokens=0):
+        """
+        Drop-in replacement for `client.models.generate_content` that serves repeated requests from the cache.
+
+        Args:
+            client (genai.Client): Client used on a cache miss.
+            model (str): Model name.
+            contents: Request contents.
+            config: Request config.
+            media_key (str): Optional content hash standing for the media in
+                `contents`, for media referenced by an unstable file URI.
+            parse: Optional function turning the response text into items,
+                e.g. with `parse_items`. A response is only stored once it
+                parses, so a truncated or malformed reply is requested again
+                on the next call instead of being replayed until it expires.
+            limiter (RateLimiter): Optional rate limiter a request waits for,
+                carrying `tokens` input tokens. Cache hits are not counted.
+        Returns:
+            The model response, or a CachedResponse on a hit. With `parse`,
+            a (response, parsed items) pair; parse errors are raised.
+        """
+        key = self.key(model, contents, config, media_key)
+        if not self.bypass:
+            text, items = self._cached(key, parse)
+            if text is not None:
+                with self._lock:
+                    self.stats.hits += 1
+                return CachedResponse(text) if parse is None else (CachedResponse(text), items)
+
+        with self._lock:
+            self.stats.misses += 1
+        if limiter is not None:
+            limiter.acquire(tokens)
+        metrics.increment('model_requests')
+        with metrics.span('model.request'):
+            response = client.models.generate_content(model=model, contents=contents, config=config)
+        metrics.record_usage(response.usage_metadata)
+        if parse is None:
+            if response.text is not None:
+                self.put(key, response.text, model=model)
+            return response
+
+        items = parse(response.text)
+        self.put(key, response.text, model=model)
+        return response, items
+
+    def generate_content_stream(self, client, model, contents, config=None, media_key=None, parse=None, limiter=None, tokens=0):
+        """
+        Drop-in replacement for `client.models.generate_content_stream` backed by the cache.
+
+        A hit yields the whole cached response as a single chunk. On a miss the
+        chunks are passed through as they arrive and the joined text is stored
+        once the stream has finished, with `parse` only if it parses. Only a
+        miss waits for `limiter` (see `generate_content`).
+        """
+        key = self.key(model, contents, config, media_key)
+        if not self.bypass:
+            text, _ = self._cached(key, parse)
+            if text is not None:
+                with self._lock:
+                    self.stats.hits += 1
+                yield CachedResponse(text)
+                return
+
+        with self._lock:
+            self.stats.misses += 1
+        if limiter is not None:
+            limiter.acquire(tokens)
+        metrics.increment('model_requests')
+        texts = []
+        usage_metadata = None
+        started = time.perf_counter()
+        for chunk in client.models.generate_content_stream(model=model, contents=contents, config=config):
+            if not texts and chunk.text:
+                metrics.observe('model.first_chunk', time.perf_counter() - started)
+            if chunk.text:
+                texts.append(chunk.text)
+            # Every chunk carries the usage so far
+            usage_metadata = chunk.usage_metadata or usage_metadata
+            yield chunk
+        metrics.observe('model.stream', time.perf_counter() - started)
+        metrics.record_usage(usage_metadata)
+        text = "".join(texts)
+        if parse is not None:
+            try:
+                parse(text)
+            except Exception:
+                return
+        self.put(key, text, model=model)
+
+# Shared cache used by the analyzers. Set GEMINI_CACHE_BYPASS=1 to always call the model.
+response_cache = ResponseCache(bypass=os.environ.get('GEMINI_CACHE_BYPASS') == '1')
+
+def cached_generate_content(client, model, contents, config=None, media_key=None, parse=None, limiter=None, tokens=0):
+    """Call `generate_content` through the shared response cache."""
+    return response_cache.generate_content(
+        client, model, contents, config=config, media_key=media_key, parse=parse, limiter=limiter, tokens=tokens
+    )
+
+def cached_generate_content_stream(client, model, contents, config=None, media_key=None, parse=None, limiter=None, tokens=0):
+    """Call `generate_content_stream` through the shared response cache."""
+    return response_cache.generate_content_stream(
+        client, model, contents, config=config, media_key=media_key, parse=parse, limiter=limiter, tokens=tokens
+    )
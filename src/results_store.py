@@ -0,0 +1,450 @@
+import bisect
+import contextlib
+import dataclasses
+import json
+import os
+import threading
+import time
+import uuid
+import numpy as np
+from image_detection import SegmentationMask
+from schemas import VideoDetection
+from video_frames import timestamp_to_seconds
+
+RESULTS_DIR = os.path.join('output', 'results')
+
+def rle_counts(mask: SegmentationMask) -> list[int]:
+    """
+    COCO run lengths of a mask over its whole image.
+
+    Pixels are taken in column-major order, as in COCO, and the runs
+    alternate starting with background. Only the columns of the bounding box
+    are expanded; the background before and after them is one run each.
+    """
+    width, height = mask.image_size
+    # The box's columns, full height, in column-major order
+    columns = np.zeros((mask.x1 - mask.x0, height), dtype=bool)
+    columns[:, mask.y0:mask.y1] = mask.crop.T > 127
+    pixels = columns.ravel()
+
+    changes = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [pixels.size]))).tolist()
+    if pixels.size and pixels[0]:
+        counts.insert(0, 0)
+    counts[0] += mask.x0 * height
+    after = (width - mask.x1) * height
+    if len(counts) % 2:
+        counts[-1] += after
+    elif after:
+        counts.append(after)
+    return counts
+
+def encode_counts(counts: list[int]) -> str:
+    """Compress run lengths into the string form of COCO RLE (as pycocotools' `rleToString`)."""
+    chars = []
+    for i, x in enumerate(counts):
+        if i > 2:
+            x -= counts[i - 2]
+        more = True
+        while more:
+            c = x & 0x1f
+            x >>= 5
+            more = x != -1 if c & 0x10 else x != 0
+            if more:
+                c |= 0x20
+            chars.append(chr(c + 48))
+    return ''.join(chars)
+
+def decode_counts(text: str) -> list[int]:
+    """Expand the string form of COCO RLE into run lengths (as pycocotools' `rleFrString`)."""
+    counts = []
+    position = 0
+    while position < len(text):
+        x = 0
+        shift = 0
+        more = True
+        while more:
+            c = ord(text[position]) - 48
+            x |= (c & 0x1f) << shift
+            more = c & 0x20
+            position += 1
+            shift += 5
+            if not more and c & 0x10:
+                x |= -1 << shift
+        if len(counts) > 2:
+            x += counts[-2]
+        counts.append(x)
+    return counts
+
+def rle_to_crop(counts: list[int], box: tuple[int, int, int, int], image_size: tuple[int, int]) -> np.ndarray:
+    """The part of an RLE mask inside `box` (y0, x0, y1, x1), as 0/255, without expanding the rest of the image."""
+    y0, x0, y1, x1 = box
+    width, height = image_size
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    # Foreground runs, clipped to the box's columns
+    low, high = x0 * height, x1 * height
+    run_starts = np.clip(starts[1::2], low, high) - low
+    run_ends = np.clip(ends[1::2], low, high) - low
+    edges = np.zeros(high - low + 1, dtype=np.int32)
+    np.add.at(edges, run_starts, 1)
+    np.add.at(edges, run_ends, -1)
+    columns = (np.cumsum(edges[:-1]) > 0).reshape(x1 - x0, height)
+    return columns.T[y0:y1].astype(np.uint8) * np.uint8(255)
+
+def _timestamp_seconds(timestamp):
+    """The seconds of a model timestamp, or None if it does not parse (such records are left out of time queries)."""
+    try:
+        return float(timestamp_to_seconds(timestamp))
+    except ValueError:
+        return None
+
+@dataclasses.dataclass
+class DetectionRecord:
+    """
+    One stored detection: everything but its mask, which is kept apart and loaded on demand.
+
+    Boxes are COCO [x, y, width, height] in pixels of the image (or video
+    frame) when its size is known; `box_2d` keeps the model's 0-1000 box.
+    """
+    id: int
+    run: str  # the run (store session) that added it
+    created: float
+    kind: str  # 'image', 'video' or 'youtube'
+    source: str  # image or video path, or YouTube URL
+    type: str | None  # type of dark pattern
+    label: str  # the model's label (images) or type (videos)
+    confidence: float | None  # 0-100
+    box_2d: list[int]  # [y_min, x_min, y_max, x_max] in 0-1000 scale
+    bbox: list[int] | None  # [x, y, width, height] in pixels
+    image_size: list[int] | None  # [width, height]
+    timestamp: str | None = None  # HH:MM:SS in the source video
+    seconds: float | None = None
+    description: str | None = None
+    area: int | None = None  # mask pixels
+    mask: list[int] | None = None  # [offset, length] of the mask's line in masks.jsonl
+    media_path: str | None = None  # local video file the frames come from
+    offset_seconds: float = 0.0  # source time of the media file's first frame
+
+class ResultsStore:
+    """
+    Append-only store of detections, queryable without loading masks.
+
+    Detections go to `detections.jsonl` in `directory`, one JSON line each.
+    Masks go to `masks.jsonl` as COCO RLE (compressed counts) and each
+    record keeps the byte offset of its mask, so masks are only read when
+    asked for. Opening the store reads the records and indexes them by
+    source, by dark pattern type (case-insensitively) and by timestamp.
+    Nothing is ever rewritten, so a crash can at most lose the last line.
+
+    Every store instance is one run; records carry its id, and `render`
+    redraws the latest run of a source. Safe to use from several threads.
+
+    Args:
+        directory (str): Folder of the store.
+    """
+
+    def __init__(self, directory=RESULTS_DIR):
+        self.directory = directory
+        self.run = f'{time.strftime("%Y%m%dT%H%M%S")}-{uuid.uuid4().hex[:8]}'
+        self._records_path = os.path.join(directory, 'detections.jsonl')
+        self._masks_path = os.path.join(directory, 'masks.jsonl')
+        self._records = []
+        self._by_source = {}
+        self._by_type = {}
+        self._by_seconds = []  # sorted (seconds, id)
+        self._lock = threading.Lock()
+        self._torn = False
+
+        try:
+            with open(self._records_path, 'r') as f:
+                for line in f:
+                    try:
+                        self._index(DetectionRecord(**json.loads(line)))
+                    except (json.JSONDecodeError, TypeError):
+                        # A torn last line from an interrupted write; the next append starts on a fresh line
+                        self._torn = not line.endswith('\n')
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        return len(self._records)
+
+    def _index(self, record):
+        record.id = len(self._records)
+        self._records.append(record)
+        self._by_source.setdefault(record.source, []).append(record.id)
+        self._by_type.setdefault((record.type or '').lower(), []).append(record.id)
+        if record.seconds is not None:
+            bisect.insort(self._by_seconds, (record.seconds, record.id))
+
+    def _append(self, records, masks=None):
+        """Write `records` (and the RLE of `masks`, one per record or None) and index them."""
+        masks = masks or [None] * len(records)
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            if any(mask is not None for mask in masks):
+                with open(self._masks_path, 'ab') as f:
+                    for record, mask in zip(records, masks):
+                        if mask is None:
+                            continue
+                        counts = rle_counts(mask)
+                        width, height = mask.image_size
+                        line = json.dumps({'size': [height, width], 'counts': encode_counts(counts)}).encode() + b'\n'
+                        record.mask = [f.tell(), len(line)]
+                        record.area = sum(counts[1::2])
+                        f.write(line)
+            with open(self._records_path, 'a') as f:
+                if self._torn:
+                    f.write('\n')
+                    self._torn = False
+                for record in records:
+                    self._index(record)
+                    f.write(json.dumps(dataclasses.asdict(record)) + '\n')
+        return records
+
+    def add_image_result(self, source, masks: list[SegmentationMask]) -> list[DetectionRecord]:
+        """Store the segmentation masks of an image."""
+        records = []
+        for mask in masks:
+            width, height = mask.image_size
+            records.append(DetectionRecord(
+                id=-1, run=self.run, created=time.time(), kind='image', source=str(source),
+                type=mask.type, label=mask.label, confidence=mask.confidence,
+                box_2d=[
+                    round(mask.y0 / height * 1000), round(mask.x0 / width * 1000),
+                    round(mask.y1 / height * 1000), round(mask.x1 / width * 1000),
+                ],
+                bbox=[mask.x0, mask.y0, mask.x1 - mask.x0, mask.y1 - mask.y0],
+                image_size=[width, height],
+            ))
+        return self._append(records, masks)
+
+    def add_video_result(self, source, items: list[VideoDetection], media_path=None, offset_seconds=0.0, kind='video') -> list[DetectionRecord]:
+        """
+        Store the detections of a video.
+
+        Args:
+            source (str): The video path or YouTube URL.
+            items (list[VideoDetection]): The detections, timestamped in source time.
+                Those whose timestamp does not parse are stored without `seconds`.
+            media_path (str): Local file of the analyzed video (the download,
+                for YouTube), read for the frame size and by `render`.
+            offset_seconds (float): Source time of `media_path`'s first frame.
+            kind (str): 'video' or 'youtube'.
+        """
+        media_path = media_path or str(source)
+        image_size = _video_frame_size(media_path) if os.path.exists(media_path) else None
+        records = []
+        for item in items:
+            bbox = None
+            if image_size is not None:
+                width, height = image_size
+                y_min, x_min, y_max, x_max = item.bounding_box[:4]
+                x, y = round(x_min / 1000 * width), round(y_min / 1000 * height)
+                bbox = [x, y, round(x_max / 1000 * width) - x, round(y_max / 1000 * height) - y]
+            records.append(DetectionRecord(
+                id=-1, run=self.run, created=time.time(), kind=kind, source=str(source),
+                type=item.type, label=item.type, confidence=item.confidence,
+                box_2d=list(item.bounding_box), bbox=bbox, image_size=list(image_size) if image_size else None,
+                timestamp=item.timestamp, seconds=_timestamp_seconds(item.timestamp),
+                description=item.description, media_path=media_path, offset_seconds=offset_seconds,
+            ))
+        return self._append(records)
+
+    def query(
+        self,
+        source=None,
+        type=None,
+        min_confidence=None,
+        start_seconds=None,
+        end_seconds=None,
+        kind=None,
+        run=None,
+    ) -> list[DetectionRecord]:
+        """
+        Records matching every given condition, in the order they were added. Masks are not read.
+
+        Source, type (case-insensitive) and time range are looked up in the
+        indexes; confidence, kind and run filter what they return. A record
+        without a confidence never passes `min_confidence`.
+        """
+        with self._lock:
+            candidates = None
+            if source is not None:
+                candidates = set(self._by_source.get(str(source), ()))
+            if type is not None:
+                matches = set(self._by_type.get(type.lower(), ()))
+                candidates = matches if candidates is None else candidates & matches
+            if start_seconds is not None or end_seconds is not None:
+                low = bisect.bisect_left(self._by_seconds, (start_seconds if start_seconds is not None else float('-inf'), -1))
+                high = bisect.bisect_right(self._by_seconds, (end_seconds if end_seconds is not None else float('inf'), len(self._records)))
+                matches = {record_id for _, record_id in self._by_seconds[low:high]}
+                candidates = matches if candidates is None else candidates & matches
+            records = self._records if candidates is None else [self._records[i] for i in sorted(candidates)]
+
+        return [
+            record for record in records
+            if (min_confidence is None or (record.confidence is not None and record.confidence > min_confidence))
+            and (kind is None or record.kind == kind)
+            and (run is None or record.run == run)
+        ]
+
+    def load_masks(self, records: list[DetectionRecord]) -> list[SegmentationMask]:
+        """The masks of image records, read from `masks.jsonl` by offset; records without one are skipped."""
+        masks = []
+        records = [record for record in records if record.mask is not None]
+        if not records:
+            # Video-only stores have no masks file
+            return masks
+        with open(self._masks_path, 'rb') as f:
+            for record in records:
+                offset, length = record.mask
+                f.seek(offset)
+                rle = json.loads(f.read(length))
+                x, y, width, height = record.bbox
+                box = (y, x, y + height, x + width)
+                crop = rle_to_crop(decode_counts(rle['counts']), box, tuple(record.image_size))
+                masks.append(SegmentationMask(*box, crop, record.label, tuple(record.image_size), record.type, record.confidence))
+        return masks
+
+    def latest_run(self, source) -> list[DetectionRecord]:
+        """The records of the last run that stored `source`."""
+        records = self.query(source=source)
+        if not records:
+            return []
+        return [record for record in records if record.run == records[-1].run]
+
+    def render(self, source, output_dir, encoding=None):
+        """
+        Redraw the latest stored detections of `source` without calling the model.
+
+        Images get their masks drawn again (as masks_<name>); videos get
+        their annotated frames, from the stored media file.
+
+        Returns:
+            list[str]: Paths of the saved images.
+        """
+        records = self.latest_run(source)
+        if not records:
+            raise ValueError(f"No stored detections for {source}")
+        os.makedirs(output_dir, exist_ok=True)
+
+        if records[0].kind == 'image':
+            from PIL import Image
+            from image_detection import plot_segmentation_masks, save_rendered_masks
+
+            with Image.open(source) as im:
+                rendered = plot_segmentation_masks(im, self.load_masks(records))
+            return [str(save_rendered_masks(rendered, source, output_dir, encoding))]
+
+        from annotation import FrameWriter, annotate_frame_detections
+        from video_frames import group_detections_by_frame
+
+        items = [
+            VideoDetection(
+                timestamp=record.timestamp, type=record.type or record.label, description=record.description or '',
+                bounding_box=record.box_2d, confidence=record.confidence,
+            )
+            for record in records
+        ]
+        futures = []
+        with FrameWriter(output_dir, encoding=encoding) as writer:
+            for frame_index, frame, group in group_detections_by_frame(records[0].media_path, items, records[0].offset_seconds):
+                futures.append(annotate_frame_detections(frame, group, writer, frame_index=frame_index))
+        return [future.result() for future in futures]
+
+    def to_coco(self, records=None) -> dict:
+        """
+        Records (by default all) as a COCO detection results dataset.
+
+        Every image, and every video frame with detections, is a COCO image;
+        categories are the dark pattern types. Image detections carry their
+        mask as compressed RLE, video detections only a box. Confidence is
+        given as `score` in 0-1.
+
+        Returns:
+            dict: 'images', 'annotations' and 'categories'.
+        """
+        records = self._records if records is None else records
+        images, annotations, categories = {}, [], {}
+        with open(self._masks_path, 'rb') if os.path.exists(self._masks_path) else contextlib.nullcontext() as masks_file:
+            for record in records:
+                frame_key = (record.source, record.timestamp)
+                if frame_key not in images:
+                    width, height = record.image_size or (None, None)
+                    image = {'id': len(images) + 1, 'file_name': record.source, 'width': width, 'height': height}
+                    if record.timestamp is not None:
+                        image['timestamp'] = record.timestamp
+                    images[frame_key] = image
+                # Types differ in case between responses
+                category = (record.type or record.label).lower()
+                if category not in categories:
+                    categories[category] = {'id': len(categories) + 1, 'name': record.type or record.label}
+
+                annotation = {
+                    'id': record.id + 1,
+                    'image_id': images[frame_key]['id'],
+                    'category_id': categories[category]['id'],
+                    'bbox': record.bbox,
+                    'area': record.area if record.area is not None else (record.bbox[2] * record.bbox[3] if record.bbox else None),
+                    'iscrowd': 0,
+                    'label': record.label,
+                }
+                if record.confidence is not None:
+                    annotation['score'] = record.confidence / 100
+                if record.mask is not None:
+                    offset, length = record.mask
+                    masks_file.seek(offset)
+                    annotation['segmentation'] = json.loads(masks_file.read(length))
+                annotations.append(annotation)
+
+        return {'images': list(images.values()), 'annotations': annotations, 'categories': list(categories.values())}
+
+    def export_coco(self, path, records=None):
+        """Write `to_coco` to `path`."""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.to_coco(records), f)
+        return path
+
+def _video_frame_size(path):
+    import cv2
+    from video_reader import video_reader_pool
+
+    with video_reader_pool.lease(path) as reader:
+        return int(reader.cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(reader.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Query, re-render and export stored detections, without calling the model.')
+    parser.add_argument('--store', default=RESULTS_DIR, help='results store folder (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    query = commands.add_parser('query', help='print matching detections as JSON lines (masks are not read)')
+    query.add_argument('--source')
+    query.add_argument('--type', help='dark pattern type, case-insensitive')
+    query.add_argument('--min-confidence', type=float, help='only detections above this confidence (0-100)')
+    query.add_argument('--start', type=float, help='earliest timestamp, in seconds')
+    query.add_argument('--end', type=float, help='latest timestamp, in seconds')
+    query.add_argument('--kind', choices=['image', 'video', 'youtube'])
+    render = commands.add_parser('render', help='redraw the latest stored detections of a source')
+    render.add_argument('source')
+    render.add_argument('--output-dir', default=os.path.join('output', 'rerendered'))
+    coco = commands.add_parser('coco', help='export matching detections (by default all) as COCO JSON')
+    coco.add_argument('path')
+    coco.add_argument('--source')
+    coco.add_argument('--type')
+    coco.add_argument('--min-confidence', type=float)
+    args = parser.parse_args()
+
+    store = ResultsStore(args.store)
+    if args.command == 'query':
+        for record in store.query(args.source, args.type, args.min_confidence, args.start, args.end, args.kind):
+            print(json.dumps(dataclasses.asdict(record)))
+    elif args.command == 'render':
+        for path in store.render(args.source, args.output_dir):
+            print(path)
+    else:
+        records = store.query(args.source, args.type, args.min_confidence)
+        print(f"{store.export_coco(args.path, records)} ({len(records)} detections)")
@@ -0,0 +1,191 @@
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+import functools
+import json
+
+class SegmentationItem(BaseModel):
+    box_2d: list[int] = Field(min_length=4, max_length=4)  # [y_min, x_min, y_max, x_max] in 0-1000 scale
+    mask: str  # base64 PNG, prefixed with "data:image/png;base64,"
+    label: str
+    type: str | None = None  # type of dark pattern; missing from older responses
+    confidence: float | None = None  # 0-100; missing from older responses
+
+class VideoDetection(BaseModel):
+    timestamp: str  # HH:MM:SS
+    type: str
+    description: str
+    bounding_box: list[int] = Field(min_length=4, max_length=4)  # [y_min, x_min, y_max, x_max] in 0-1000 scale
+    confidence: float | None = None  # 0-100; missing from older responses
+
+def response_config(model: type[BaseModel]) -> dict:
+    """
+    Config entries asking the model for a JSON list of `model` objects.
+
+    Without them the model replies in free text, which `parse_items` still
+    parses leniently.
+    """
+    return {
+        "response_mime_type": "application/json",
+        "response_schema": list[model],
+    }
+
+@functools.cache
+def _list_adapter(model: type[BaseModel]) -> TypeAdapter:
+    return TypeAdapter(list[model])
+
+def decode_json(text: str):
+    """
+    Decode the first JSON array or object embedded in free-form model output.
+
+    Handles markdown fences with any info string (or none) and surrounding
+    prose. Candidates are decoded in place with `raw_decode`, without
+    splitting the text into lines or copying substrings.
+    """
+    decoder = json.JSONDecoder()
+    position = 0
+    while True:
+        starts = [i for i in (text.find('[', position), text.find('{', position)) if i != -1]
+        if not starts:
+            raise ValueError("No JSON value found in model output")
+        start = min(starts)
+        try:
+            value, _ = decoder.raw_decode(text, start)
+            return value
+        except json.JSONDecodeError:
+            position = start + 1
+
+def _report_malformed(model: type[BaseModel], error: ValidationError):
+    print(f"Skipping malformed {model.__name__}: {error.errors()[0]['msg']}")
+
+def _valid_items(values: list, model: type[BaseModel]) -> list:
+    """Validate each element on its own, skipping and reporting malformed ones; raises if there are elements but none is valid."""
+    items = []
+    error = None
+    for value in values:
+        try:
+            items.append(model.model_validate(value))
+        except ValidationError as e:
+            error = e
+            _report_malformed(model, e)
+    if error is not None and not items:
+        raise error
+    return items
+
+def parse_items(text: str, model: type[BaseModel]) -> list:
+    """
+    Parse a model response into a list of `model` objects.
+
+    Structured-output responses are validated straight from the JSON text.
+    Anything else (fenced or prose-wrapped JSON) goes through `decode_json`;
+    a single object is accepted as a one-item list. A malformed element,
+    such as a box without four values, is skipped rather than failing the
+    whole response.
+    """
+    adapter = _list_adapter(model)
+    try:
+        return adapter.validate_json(text)
+    except ValidationError:
+        pass
+
+    value = decode_json(text)
+    if isinstance(value, dict):
+        value = [value]
+    if not isinstance(value, list):
+        return adapter.validate_python(value)
+    return _valid_items(value, model)
+
+class JsonArrayStream:
+    """
+    Incremental parser that yields the elements of a JSON array as text arrives.
+
+    Feed it the response in arbitrary chunks; every object (or nested array)
+    element is returned by `feed` as soon as its closing bracket has been
+    seen. Anything before the opening bracket, such as a markdown fence, is
+    skipped. Each character is scanned once and consumed text is dropped.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._position = 0  # next character of the buffer to scan
+        self._in_array = False
+        self._done = False
+        self._depth = 0  # nesting depth inside the current element
+        self._in_string = False
+        self._escaped = False
+        self._element_start = None
+
+    def feed(self, text: str) -> list:
+        """Add a chunk of text and return the elements completed by it."""
+        if self._done or not text:
+            return []
+        self._buffer += text
+        elements = []
+        buffer = self._buffer
+        i = self._position
+
+        while i < len(buffer):
+            char = buffer[i]
+            if not self._in_array:
+                if char == '[':
+                    self._in_array = True
+            elif self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in '{[':
+                if self._depth == 0:
+                    self._element_start = i
+                self._depth += 1
+            elif char in '}]':
+                if self._depth == 0:
+                    # Closing bracket of the top-level array
+                    self._done = True
+                    break
+                self._depth -= 1
+                if self._depth == 0:
+                    elements.append(json.loads(buffer[self._element_start:i + 1]))
+                    self._element_start = None
+            i += 1
+
+        # Keep only the unfinished element, if any
+        keep_from = self._element_start if self._element_start is not None else i
+        self._buffer = buffer[keep_from:]
+        self._position = i - keep_from
+        if self._element_start is not None:
+            self._element_start = 0
+        return elements
+
+def iter_stream_items(chunks, model: type[BaseModel]):
+    """
+    Yield `model` objects from streamed response text as soon as each one is complete.
+
+    `JsonArrayStream` takes the first '[' as the start of the array, so a
+    reply with brackets in its prose can end without yielding anything.
+    If no item has been yielded once the stream is over, the whole text is
+    parsed with `parse_items` instead, like a response that is not streamed.
+    Malformed elements are skipped, as in `parse_items`.
+
+    Args:
+        chunks: Iterable of text chunks, e.g. the `.text` of streamed responses.
+        model: Pydantic model every array element is validated against.
+    """
+    parser = JsonArrayStream()
+    texts = []
+    yielded = False
+    for text in chunks:
+        texts.append(text or "")
+        for element in parser.feed(text or ""):
+            if isinstance(element, dict):
+                try:
+                    item = model.model_validate(element)
+                except ValidationError as e:
+                    _report_malformed(model, e)
+                    continue
+                yielded = True
+                yield item
+    if not yielded:
+        yield from parse_items("".join(texts), model)
@@ -0,0 +1,227 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import json
+import os
+import threading
+from rate_limiter import call_with_retry
+from response_cache import response_cache
+from schemas import VideoDetection
+from video_frames import timestamp_to_seconds, seconds_to_timestamp
+
+CHECKPOINT_DIR = os.path.join('.cache', 'chunks')
+
+def plan_windows(start_seconds, end_seconds, window_seconds, overlap_seconds):
+    """
+    Split [start_seconds, end_seconds] into windows of `window_seconds` that overlap by `overlap_seconds`.
+
+    Returns:
+        list[tuple[float, float]]: (start, end) of every window, in order.
+    """
+    if window_seconds <= overlap_seconds:
+        raise ValueError("window_seconds must be larger than overlap_seconds")
+
+    windows = []
+    start = start_seconds
+    while True:
+        end = min(start + window_seconds, end_seconds)
+        windows.append((start, end))
+        if end >= end_seconds:
+            return windows
+        start = end - overlap_seconds
+
+def _parsed_seconds(items):
+    """(seconds, item) for every detection whose timestamp parses; the rest are skipped, as in the single-call path."""
+    parsed = []
+    for item in items:
+        try:
+            parsed.append((timestamp_to_seconds(item.timestamp), item))
+        except ValueError:
+            continue
+    return parsed
+
+def rebase_detections(items, window_start, relative=False):
+    """
+    Convert the timestamps of one window's detections to source-video time.
+
+    Requests clipped with `VideoMetadata` offsets are read as reporting
+    source time, as the unchunked analyzers read them, so by default the
+    timestamps are only normalized. With `relative` they are taken as
+    relative to the window and shifted by `window_start`. Detections with an
+    unparsable timestamp are dropped.
+    """
+    shift = window_start if relative else 0
+    return [
+        item.model_copy(update={"timestamp": seconds_to_timestamp(seconds + shift)})
+        for seconds, item in _parsed_seconds(items)
+    ]
+
+def box_iou(a, b):
+    """Intersection over union of two [y_min, x_min, y_max, x_max] boxes."""
+    y0, x0 = max(a[0], b[0]), max(a[1], b[1])
+    y1, x1 = min(a[2], b[2]), min(a[3], b[3])
+    intersection = max(0, y1 - y0) * max(0, x1 - x0)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+def merge_detections(detections_by_window, time_tolerance=2.0, iou_threshold=0.5):
+    """
+    Merge the rebased detections of all windows, dropping duplicates from overlapping windows.
+
+    A detection is a duplicate when a detection kept from another window has
+    the same type, lies within `time_tolerance` seconds and its box overlaps
+    with an IoU of at least `iou_threshold`. Detections from the same window
+    are never merged, so events the model tracked through time are kept.
+    Detections with an unparsable timestamp are dropped.
+
+    Args:
+        detections_by_window (list[list[VideoDetection]]): Detections per window, in window order.
+    Returns:
+        list[VideoDetection]: Merged detections sorted by timestamp.
+    """
+    candidates = [
+        (seconds, window, item)
+        for window, items in enumerate(detections_by_window)
+        for seconds, item in _parsed_seconds(items)
+    ]
+    # Detections are not comparable, so ties keep their order
+    candidates.sort(key=lambda candidate: candidate[:2])
+
+    kept = []
+    for seconds, window, item in candidates:
+        duplicate = any(
+            other_window != window
+            and seconds - other_seconds <= time_tolerance
+            and other.type.lower() == item.type.lower()
+            and box_iou(other.bounding_box, item.bounding_box) >= iou_threshold
+            for other_seconds, other_window, other in kept
+        )
+        if not duplicate:
+            kept.append((seconds, window, item))
+    return [item for _, _, item in kept]
+
+class ChunkCheckpoint:
+    """
+    JSON file recording the detections of every finished window, so an interrupted run can resume.
+
+    It only lives until the run succeeds; `analyze_in_chunks` clears it then,
+    so a later run asks the model (or the response cache) again.
+
+    Args:
+        path (str): Checkpoint file. Use `checkpoint_path` to derive one per analysis.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, 'r') as f:
+                self._done = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._done = {}
+
+    @staticmethod
+    def _key(window):
+        return f"{window[0]}-{window[1]}"
+
+    def get(self, window):
+        """Return the detections of a finished window, or None."""
+        items = self._done.get(self._key(window))
+        return None if items is None else [VideoDetection.model_validate(item) for item in items]
+
+    def put(self, window, items):
+        """Record a finished window and persist the checkpoint."""
+        with self._lock:
+            self._done[self._key(window)] = [item.model_dump() for item in items]
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self._done, f)
+            os.replace(tmp_path, self.path)
+
+    def clear(self):
+        """Forget every window and delete the checkpoint file."""
+        with self._lock:
+            self._done = {}
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+def checkpoint_path(*parts):
+    """Checkpoint file for an analysis identified by `parts` (source, range, window settings...)."""
+    key = hashlib.sha256(json.dumps([str(part) for part in parts]).encode()).hexdigest()
+    return os.path.join(CHECKPOINT_DIR, f'{key}.json')
+
+def analyze_in_chunks(
+    detect,
+    start_seconds,
+    end_seconds,
+    window_seconds=60,
+    overlap_seconds=5,
+    max_workers=4,
+    checkpoint=None,
+    max_retries=3,
+    relative_timestamps=False,
+):
+    """
+    Analyze a long video range as overlapping windows, concurrently.
+
+    Args:
+        detect: Called as detect(start_offset, end_offset) with offsets such as
+            '60s', returning the list of VideoDetection for that window.
+        start_seconds (float): Start of the range in source time.
+        end_seconds (float): End of the range in source time.
+        window_seconds (float): Length of each window.
+        overlap_seconds (float): Overlap between consecutive windows, so events
+            on a boundary are seen whole by at least one window.
+        max_workers (int): Windows analyzed concurrently.
+        checkpoint (ChunkCheckpoint): Optional checkpoint; windows already in
+            it are not analyzed again and new ones are added as they finish.
+            It is cleared once every window has succeeded, and ignored when
+            the response cache is bypassed.
+        max_retries (int): Retries per window on rate limit and server errors.
+        relative_timestamps (bool): Whether `detect` reports times relative
+            to the window rather than in source time (see `rebase_detections`).
+    Returns:
+        list[VideoDetection]: Merged detections in source time, sorted by timestamp.
+    Raises:
+        The first window failure, after every other window has finished and
+        been checkpointed.
+    """
+    windows = plan_windows(start_seconds, end_seconds, window_seconds, overlap_seconds)
+    results = [None] * len(windows)
+    if checkpoint is not None and response_cache.bypass:
+        # Bypassing the cache means calling the model for every window
+        checkpoint.clear()
+
+    def run(window):
+        items = call_with_retry(detect, f"{window[0]:g}s", f"{window[1]:g}s", max_retries=max_retries)
+        items = rebase_detections(items, window[0], relative_timestamps)
+        if checkpoint is not None:
+            checkpoint.put(window, items)
+        return items
+
+    first_error = None
+    with ThreadPoolExecutor(max_workers) as executor:
+        futures = {}
+        for index, window in enumerate(windows):
+            done = checkpoint.get(window) if checkpoint is not None else None
+            if done is not None:
+                results[index] = done
+            else:
+                futures[executor.submit(run, window)] = index
+
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                results[index] = future.result()
+                print(f"Analyzed window {windows[index][0]:g}s-{windows[index][1]:g}s: {len(results[index])} detections")
+            except Exception as e:
+                print(f"Failed to analyze window {windows[index][0]:g}s-{windows[index][1]:g}s: {str(e)}")
+                first_error = first_error or e
+
+    if first_error is not None:
+        raise first_error
+    if checkpoint is not None:
+        checkpoint.clear()
+    return merge_detections(results)
@@ -1,68 +1,20 @@
-from google import genai
-from google.genai import types
-from PIL import Image, ImageDraw, ImageFont
-import json
 import os
-import cv2
-import yt_dlp
-import tempfile
-
-client = genai.Client()
-
-def parse_json(json_output: str):
-    """Parse JSON output by removing markdown fencing."""
-    lines = json_output.splitlines()
-    for i, line in enumerate(lines):
-        if line == "```json":
-            json_output = "\n".join(lines[i+1:])  # Remove everything before "```json"
-            json_output = json_output.split("```")[0]  # Remove everything after the closing "```"
-            break  # Exit the loop once "```json" is found
-    return json_output
-
-def timestamp_to_seconds(timestamp):
-    """Convert timestamp string (HH:MM:SS) to seconds."""
-    parts = timestamp.split(':')
-    if len(parts) == 3:
-        hours, minutes, seconds = map(int, parts)
-        return hours * 3600 + minutes * 60 + seconds
-    elif len(parts) == 2:
-        minutes, seconds = map(int, parts)
-        return minutes * 60 + seconds
-    else:
-        return int(parts[0])
-
-def extract_frame_at_timestamp(video_path, timestamp, output_path=None):
-    """Extract a frame from video at the specified timestamp."""
-    cap = cv2.VideoCapture(video_path)
-    
-    if not cap.isOpened():
-        raise ValueError(f"Could not open video file: {video_path}")
-    
-    # Convert timestamp to seconds
-    seconds = timestamp_to_seconds(timestamp)
-    print(f"Extracting frame at timestamp: {timestamp} (seconds: {seconds})")
-    
-    # Set video position to the timestamp
-    cap.set(cv2.CAP_PROP_POS_MSEC, seconds * 1000)
-    
-    # Read the frame
-    ret, frame = cap.read()
-    cap.release()
-    
-    if not ret:
-        raise ValueError(f"Could not extract frame at timestamp {timestamp}")
-    
-    # Convert BGR to RGB
-    frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-    
-    # Convert to PIL Image
-    pil_image = Image.fromarray(frame_rgb)
-    
-    # Save if output path is provided
-    if output_path:
-        pil_image.save(output_path)
-    
-    return pil_image
+from annotation import FrameWriter, OutputEncoding
+from genai_client import get_client
+from image_tiling import image_tokens
+from keyframes import keyframe_parts, select_keyframes
+from media_transport import media_part, file_sha256
+from metrics import metrics
+from phash_index import PerceptualHashIndex, phash
+from rate_limiter import RateLimiter
+from response_cache import cached_generate_content
+from schemas import VideoDetection, parse_items, response_config
+from video_chunking import ChunkCheckpoint, analyze_in_chunks, checkpoint_path
+from video_render import check_output_mode, save_video_annotations
+from video_frames import estimate_video_tokens, offset_to_seconds, timestamp_to_seconds
+
+# Namespace of keyframe detections in the perceptual-hash index
+KEYFRAME_NAMESPACE = 'keyframe'
 
 # def download_youtube_video(url, output_path=None):
 #     """Download YouTube video to a temporary file."""
@@ -83,62 +35,62 @@ def extract_frame_at_timestamp(video_path, timestamp, output_path=None):
     
 #     return output_path
 
-def draw_bounding_box(image_path, bounding_box, label):
+def _reuse_keyframe_detections(keyframes, dedupe_index):
     """
-    Draws a bounding box with label on the image.
-    Args:
-        image_path (str): Path to the input image.
-        bounding_box (list): [y_min, x_min, y_max, x_max] in 0-1000 scale.
-        label (str): Label for the bounding box.
+    Look the keyframes up in `dedupe_index`.
+
     Returns:
-        Image object with bounding box drawn.
+        tuple[list[tuple[Keyframe, int]], list[VideoDetection]]: The keyframes
+            still to send, with their hashes, and the detections of the
+            others' near-duplicates, moved to their timestamps.
     """
-    image = Image.open(image_path).convert('RGB')
-    draw = ImageDraw.Draw(image)
-    width, height = image.size
-
-    # Convert normalized coordinates to pixel values
-    y_min, x_min, y_max, x_max = bounding_box
-    
-    y_min = int(y_min / 1000 * height)
-    y_max = int(y_max / 1000 * height)
-    x_min = int(x_min / 1000 * width)
-    x_max = int(x_max / 1000 * width)
-
-    # Draw rectangle
-    draw.rectangle((x_min, y_min, x_max, y_max), outline='red', width=3)
-
-    # Prepare label text
-    text = f"{label}"
-    try:
-        font = ImageFont.truetype("arial.ttf", 20)
-    except:
-        font = ImageFont.load_default()
-    
-    # Calculate text size using textbbox for compatibility
-    text_bbox = draw.textbbox((x_min, y_min), text, font=font)
-    text_width = text_bbox[2] - text_bbox[0]
-    text_height = text_bbox[3] - text_bbox[1]
-    text_bg = (x_min, y_min - text_height, x_min + text_width, y_min)
-    draw.rectangle(text_bg, fill='red')
-    draw.text((x_min, y_min - text_height), text, fill='white', font=font)
+    new, reused = [], []
+    with metrics.span('video.dedupe_lookup'):
+        for keyframe in keyframes:
+            hash_value = phash(keyframe.image)
+            entry = dedupe_index.lookup(keyframe.image, KEYFRAME_NAMESPACE, hash_value)
+            if entry is None:
+                new.append((keyframe, hash_value))
+            else:
+                reused.extend(VideoDetection.model_validate(dict(item, timestamp=keyframe.timestamp)) for item in entry['payload'])
+    metrics.increment('dedupe_hits', len(keyframes) - len(new))
+    return new, reused
+
+def _index_keyframe_detections(sent, items, dedupe_index):
+    """Record the detections of every sent keyframe in `dedupe_index`, giving each detection to the keyframe nearest its timestamp."""
+    detections = [[] for _ in sent]
+    for item in items:
+        try:
+            seconds = timestamp_to_seconds(item.timestamp)
+        except ValueError:
+            continue
+        nearest = min(range(len(sent)), key=lambda i: abs(sent[i][0].seconds - seconds))
+        detections[nearest].append(item.model_dump())
+    # Keyframes without detections are recorded too, so they are not sent again
+    for (keyframe, hash_value), payload in zip(sent, detections):
+        dedupe_index.add(keyframe.image, payload, KEYFRAME_NAMESPACE, hash_value)
+
+def detect_dark_patterns(
+    video_path: str,
+    start_offset: str,
+    end_offset: str,
+    structured_output: bool = True,
+    keyframes_only: bool = False,
+    limiter: RateLimiter | None = None,
+    dedupe_index: PerceptualHashIndex | None = None,
+):
+    """
+    Ask the model for the dark patterns in a section of a video file, waiting for a slot of `limiter` if given and not cached.
 
-    return image
+    With `keyframes_only` the video itself is not sent, only its keyframes
+    (see `select_keyframes`), each labelled with its timestamp. With a
+    `dedupe_index` as well, a keyframe whose near-duplicate was analyzed
+    before, in this video or another, reuses its detections instead of being
+    sent.
 
-def save_image_to_output(image, filename):
-    """
-    Saves the image to the output folder, creating it if necessary.
-    Args:
-        image (PIL.Image): Image object to save.
-        filename (str): Name of the file to save as.
+    Returns:
+        list[VideoDetection]: The detected events.
     """
-    output_dir = 'output'
-    os.makedirs(output_dir, exist_ok=True)
-    output_path = os.path.join(output_dir, filename)
-    image.save(output_path)
-
-def analyze_video(video_path: str, start_offset: str, end_offset: str):
-    """Analyze YouTube video for dark patterns."""
     prompt = """
     Give the detections for dark patterns.
     Type of Dark Patterns:
@@ -168,66 +120,128 @@ def analyze_video(video_path: str, start_offset: str, end_offset: str):
             - type: The type of dark pattern
             - description: Describe what the dark pattern is doing at that timestamp
             - bounding_box: Include a bounding box in y_min, x_min, y_max, x_max format
+            - confidence: How confident you are in the detection, from 0 to 100
     4. The origin is the top-left of the image.
     5. The video resolution is 640 x 360.
     """
 
-    # Only for videos of size <20Mb
-    video_bytes = open(video_path, 'rb').read()
-    response = client.models.generate_content(
+    from google.genai import types
+
+    reused = []
+    if keyframes_only:
+        # Screens the video returns to are only sent once
+        with metrics.span('video.keyframes'):
+            keyframes = select_keyframes(video_path, offset_to_seconds(start_offset), offset_to_seconds(end_offset), dedupe_distance=4)
+        sent = [(keyframe, None) for keyframe in keyframes]
+        if dedupe_index is not None:
+            sent, reused = _reuse_keyframe_detections(keyframes, dedupe_index)
+            if not sent:
+                return reused
+            keyframes = [keyframe for keyframe, _ in sent]
+        parts = keyframe_parts(keyframes)
+        prompt += """
+    The video is given as keyframes taken at every scene change, each preceded
+    by its timestamp. Use those timestamps for the events.
+    """
+        # The keyframe images are part of the key themselves
+        media_key = None
+        tokens = sum(image_tokens(*keyframe.image.size) for keyframe in keyframes)
+    else:
+        # Small videos are sent inline, larger ones go through the Files API
+        parts = [media_part(
+            get_client(),
+            video_path,
+            video_metadata=types.VideoMetadata(
+                start_offset=start_offset,
+                end_offset=end_offset
+            )
+        )]
+        media_key = file_sha256(video_path)
+        tokens = estimate_video_tokens(start_offset, end_offset)
+
+    def parse(text):
+        with metrics.span('video.parse'):
+            return parse_items(text, VideoDetection)
+
+    response, items = cached_generate_content(
+        get_client(),
         model='models/gemini-2.5-flash',
         contents=types.Content(
-            parts=[
-                types.Part(
-                    inline_data=types.Blob(data=video_bytes, mime_type='video/mov'),
-                    video_metadata=types.VideoMetadata(
-                        start_offset=start_offset,
-                        end_offset=end_offset
-                    )
-                ),
+            parts=parts + [
                 types.Part(text=prompt)
             ]
-        )
+        ),
+        config=types.GenerateContentConfig(
+            **(response_config(VideoDetection) if structured_output else {})
+        ),
+        media_key=media_key,
+        parse=parse,
+        limiter=limiter,
+        tokens=tokens,
     )
     print(response.text)
-    items = json.loads(parse_json(response.text))
-    
-    # # Download the video
-    # print(f"Downloading video from {video_url}...")
-    # video_path = download_youtube_video(video_url)
+    if keyframes_only and dedupe_index is not None:
+        _index_keyframe_detections(sent, items, dedupe_index)
+    return items + reused
+
+@metrics.timed('video.analyze')
+def analyze_video(
+    video_path: str,
+    start_offset: str,
+    end_offset: str,
+    structured_output: bool = True,
+    keyframes_only: bool = False,
+    chunk_seconds: float | None = None,
+    chunk_overlap_seconds: float = 5,
+    max_workers: int = 4,
+    encoding: OutputEncoding | None = None,
+    writer_workers: int = 2,
+    output_mode: str = 'frames',
+    hold_seconds: float = 1.0,
+    video_max_height: int | None = None,
+    output_dir: str = 'output',
+    limiter: RateLimiter | None = None,
+    dedupe_index: PerceptualHashIndex | None = None,
+):
+    """
+    Analyze a video file for dark patterns and save the detections as annotated frames or video.
 
-    # Extract frames and draw bounding boxes for each detected pattern
-    for item in items:
-        try:
-            # Extract frame at the timestamp
-            frame = extract_frame_at_timestamp(video_path, item["timestamp"])
-            
-            # Save frame to temporary file
-            temp_frame_path = tempfile.mktemp(suffix='.png')
-            frame.save(temp_frame_path)
-            
-            # Draw bounding box on the frame
-            img_with_box = draw_bounding_box(
-                image_path=temp_frame_path,
-                bounding_box=item["bounding_box"],
-                label=item["type"],
-            )
-            
-            # Save the frame with bounding box
-            safe_pattern_type = ''.join(c for c in item["type"] if c.isalnum() or c in '-_')
-            safe_timestamp = item["timestamp"].replace(':', '-')
-            filename = f'file_video_frame_{safe_timestamp}_{safe_pattern_type}.png'
-            save_image_to_output(img_with_box, filename)
-            print(f'Saved frame with bounding box: {filename}')
-            
-            # Clean up temporary frame file
-            # try:
-            #     os.remove(temp_frame_path)
-            # except:
-            #     pass
-                
-        except Exception as e:
-            print(f"Failed to process frame at {item['timestamp']}: {str(e)}")
+    See `analyze_in_chunks` for `chunk_seconds` and `save_video_annotations`
+    for `output_mode`. Everything is saved to `output_dir`.
+
+    Returns:
+        list[VideoDetection]: The detections.
+    """
+    check_output_mode(output_mode)
+
+    if chunk_seconds is None:
+        items = detect_dark_patterns(video_path, start_offset, end_offset, structured_output, keyframes_only, limiter, dedupe_index)
+    else:
+        items = analyze_in_chunks(
+            lambda start, end: detect_dark_patterns(video_path, start, end, structured_output, keyframes_only, limiter, dedupe_index),
+            offset_to_seconds(start_offset),
+            offset_to_seconds(end_offset),
+            window_seconds=chunk_seconds,
+            overlap_seconds=chunk_overlap_seconds,
+            max_workers=max_workers,
+            checkpoint=ChunkCheckpoint(checkpoint_path(
+                file_sha256(video_path), start_offset, end_offset, chunk_seconds, chunk_overlap_seconds, structured_output, keyframes_only
+            )),
+        )
+
+    with FrameWriter(output_dir, encoding=encoding, max_workers=writer_workers) as writer:
+        save_video_annotations(
+            video_path,
+            items,
+            output_mode,
+            writer,
+            os.path.join(output_dir, f'{os.path.splitext(os.path.basename(video_path))[0]}_annotated.mp4'),
+            prefix='file_video_frame',
+            hold_seconds=hold_seconds,
+            max_height=video_max_height,
+            start_seconds=offset_to_seconds(start_offset),
+            end_seconds=offset_to_seconds(end_offset),
+        )
 
     # # Clean up the downloaded video
     # try:
@@ -235,5 +249,4 @@ def analyze_video(video_path: str, start_offset: str, end_offset: str):
     # except:
     #     pass
 
-if __name__ == "__main__":
-    analyze_video('reference/videos/random_sgcarmart-2.mov', '0s', '63s')
\ No newline at end of file
+    return items
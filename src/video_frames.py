@@ -0,0 +1,195 @@
+from PIL import Image
+from metrics import metrics
+from video_reader import video_reader_pool
+
+def timestamp_to_seconds(timestamp):
+    """Convert timestamp string (HH:MM:SS) to seconds."""
+    parts = timestamp.split(':')
+    if len(parts) == 3:
+        hours, minutes, seconds = map(int, parts)
+        return hours * 3600 + minutes * 60 + seconds
+    elif len(parts) == 2:
+        minutes, seconds = map(int, parts)
+        return minutes * 60 + seconds
+    else:
+        return int(parts[0])
+
+def seconds_to_timestamp(seconds):
+    """Convert seconds to a timestamp string (HH:MM:SS)."""
+    seconds = int(round(seconds))
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+def offset_to_seconds(offset):
+    """Convert a video offset string such as '1250s' (or a plain number) to seconds."""
+    return float(str(offset).strip().removesuffix('s'))
+
+# Gemini bills video at 258 tokens per frame, sampled at 1 fps, plus 32 tokens per second of audio
+VIDEO_TOKENS_PER_SECOND = 290
+
+def estimate_video_tokens(start_offset, end_offset):
+    """Input tokens the model bills for the `start_offset`-`end_offset` section of a video."""
+    return max(1.0, offset_to_seconds(end_offset) - offset_to_seconds(start_offset)) * VIDEO_TOKENS_PER_SECOND
+
+def _read_frame_at_msec(video_path, seconds):
+    """Seek a fresh capture to `seconds` and read one frame; for videos without a usable frame rate."""
+    import cv2
+
+    cap = cv2.VideoCapture(video_path)
+
+    if not cap.isOpened():
+        raise ValueError(f"Could not open video file: {video_path}")
+
+    # Set video position to the timestamp
+    cap.set(cv2.CAP_PROP_POS_MSEC, seconds * 1000)
+
+    # Read the frame
+    ret, frame = cap.read()
+    cap.release()
+
+    # Convert BGR to RGB
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) if ret else None
+
+def extract_frame_at_timestamp(video_path, timestamp, output_path=None, offset_seconds=0):
+    """
+    Extract a frame from video at the specified timestamp.
+
+    `offset_seconds` is the source time of the file's first frame, for clips
+    cut out of a longer video; timestamps stay in source time.
+
+    Frames come from the shared `video_reader_pool`, so repeated and nearby
+    timestamps reuse an open capture and the decoded frame cache.
+    """
+    # Convert timestamp to seconds
+    seconds = timestamp_to_seconds(timestamp) - offset_seconds
+    if seconds < 0:
+        raise ValueError(f"Timestamp {timestamp} is before the start of the clip")
+
+    fps = video_reader_pool.fps(video_path)
+    if fps > 0:
+        frame = video_reader_pool.get_frame(video_path, int(round(seconds * fps)))
+    else:
+        frame = _read_frame_at_msec(video_path, seconds)
+
+    if frame is None:
+        raise ValueError(f"Could not extract frame at timestamp {timestamp}")
+
+    # Convert to PIL Image
+    pil_image = Image.fromarray(frame)
+
+    # Save if output path is provided
+    if output_path:
+        pil_image.save(output_path)
+
+    return pil_image
+
+def _group_timestamps_by_frame(timestamps, fps, offset_seconds=0):
+    """Map frame index -> the timestamps resolving to it, leaving out unparsable and negative ones."""
+    targets = {}
+    for timestamp in dict.fromkeys(timestamps):
+        try:
+            seconds = timestamp_to_seconds(timestamp) - offset_seconds
+        except ValueError:
+            continue
+        if seconds < 0:
+            continue
+        frame_index = int(round(seconds * fps))
+        targets.setdefault(frame_index, []).append(timestamp)
+    return targets
+
+def extract_frames_at_timestamps(video_path, timestamps, offset_seconds=0):
+    """
+    Extracts the frames for many timestamps with a single sequential decode.
+
+    Timestamps are mapped to frame indices, sorted and deduplicated, and read
+    in increasing order through the shared `video_reader_pool`: frames
+    already in its cache are not decoded again, and the rest are read with
+    one capture that only grabs (demuxes and decodes, but never converts)
+    the frames between targets. This avoids reopening the container and
+    re-decoding from the previous keyframe for every timestamp.
+
+    Args:
+        video_path (str): Path to the video file.
+        timestamps (list[str]): Timestamps in HH:MM:SS, MM:SS or SS format.
+        offset_seconds (float): Source time of the file's first frame, for
+            clips cut out of a longer video.
+    Returns:
+        dict[str, PIL.Image]: Frames keyed by the timestamp strings passed in.
+            Timestamps that cannot be parsed or lie outside the video are
+            left out.
+    """
+    fps = video_reader_pool.fps(video_path)
+    if fps <= 0:
+        # Without a frame rate we cannot map timestamps to frame indices,
+        # so fall back to seeking for each timestamp.
+        frames = {}
+        for timestamp in dict.fromkeys(timestamps):
+            try:
+                frames[timestamp] = extract_frame_at_timestamp(video_path, timestamp, offset_seconds=offset_seconds)
+            except ValueError:
+                pass
+        return frames
+
+    targets = _group_timestamps_by_frame(timestamps, fps, offset_seconds)
+
+    frames = {}
+    for frame_index, frame in video_reader_pool.get_frames(video_path, targets).items():
+        pil_image = Image.fromarray(frame)
+        for timestamp in targets[frame_index]:
+            frames[timestamp] = pil_image
+
+    return frames
+
+@metrics.timed('video.frames')
+def group_detections_by_frame(video_path, items, offset_seconds=0):
+    """
+    Group timestamped detections by the video frame they fall on and extract each frame once.
+
+    Args:
+        video_path (str): Path to the video file.
+        items (list): Detections with a `timestamp` attribute (HH:MM:SS, MM:SS or SS).
+        offset_seconds (float): Source time of the file's first frame, for
+            clips cut out of a longer video.
+    Returns:
+        list[tuple[int | None, PIL.Image, list]]: (frame index, frame,
+            detections) in frame order. Detections whose frame cannot be
+            extracted are left out. The index is None for videos without a
+            usable frame rate, where detections are grouped by timestamp.
+    """
+    fps = video_reader_pool.fps(video_path)
+    if fps <= 0:
+        frames = extract_frames_at_timestamps(video_path, [item.timestamp for item in items], offset_seconds)
+        groups = {}
+        for item in items:
+            if item.timestamp in frames:
+                groups.setdefault(item.timestamp, []).append(item)
+        return [(None, frames[timestamp], group) for timestamp, group in groups.items()]
+
+    targets = _group_timestamps_by_frame([item.timestamp for item in items], fps, offset_seconds)
+    frames = video_reader_pool.get_frames(video_path, targets)
+    groups = []
+    for frame_index in sorted(frames):
+        timestamps = set(targets[frame_index])
+        group = [item for item in items if item.timestamp in timestamps]
+        groups.append((frame_index, Image.fromarray(frames[frame_index]), group))
+    return groups
+
+def iter_frames_at_indices(cap, frame_indices, position=0):
+    """
+    Yield (frame index, BGR frame) for the given indices, in increasing order, reading the capture sequentially.
+
+    The capture must be positioned at frame `position`. Frames in between are
+    only grabbed; reading stops at the end of the video.
+    """
+    for frame_index in sorted(frame_indices):
+        # Skip ahead without converting the frames we don't need
+        while position < frame_index:
+            if not cap.grab():
+                return
+            position += 1
+
+        if not cap.grab():
+            return
+        position += 1
+        ret, frame = cap.retrieve()
+        if ret:
+            yield frame_index, frame
@@ -0,0 +1,229 @@
+from collections import OrderedDict
+import contextlib
+import os
+import threading
+from metrics import metrics
+from response_cache import CacheStats
+
+class VideoReader:
+    """
+    An open `cv2.VideoCapture` that remembers its decode position.
+
+    Reads just ahead of the current position are served by grabbing the
+    frames in between, which is much cheaper than a seek (a seek re-decodes
+    from the previous keyframe). Backward reads and long jumps seek.
+
+    Args:
+        path (str): Path to the video file.
+        max_skip_frames (int): Longest forward gap bridged by grabbing.
+    """
+
+    def __init__(self, path, max_skip_frames=120):
+        self.path = path
+        self.max_skip_frames = max_skip_frames
+        import cv2
+
+        self.cap = cv2.VideoCapture(path)
+        if not self.cap.isOpened():
+            raise ValueError(f"Could not open video file: {path}")
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.frame_count = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.position = 0  # index of the frame the next read returns
+
+    def read(self, frame_index):
+        """Return the BGR frame at `frame_index`, or None past the end of the video."""
+        if frame_index < self.position or frame_index - self.position > self.max_skip_frames:
+            import cv2
+
+            metrics.increment('frame_seeks')
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+            self.position = frame_index
+
+        while self.position < frame_index:
+            if not self.cap.grab():
+                return None
+            self.position += 1
+
+        ret, frame = self.cap.read()
+        if not ret:
+            return None
+        self.position += 1
+        return frame
+
+    def release(self):
+        self.cap.release()
+
+class VideoReaderPool:
+    """
+    Pool of open video readers keyed by path, behind an LRU cache of decoded frames.
+
+    Frames are cached as read-only RGB arrays keyed by (path, frame index)
+    and evicted least recently used first once they take more than
+    `max_cache_bytes`. Misses are read from a leased reader: at most
+    `max_handles` captures are open across all paths, idle ones are reused
+    for their path, and when the pool is full the least recently used idle
+    capture is closed to make room. A file that changes on disk (new size
+    or modification time) has its readers and frames dropped.
+
+    Args:
+        max_handles (int): Maximum number of open captures.
+        max_cache_bytes (int): Memory budget of the frame cache.
+        max_skip_frames (int): See `VideoReader`.
+    """
+
+    def __init__(self, max_handles=4, max_cache_bytes=256 * 1024 * 1024, max_skip_frames=120):
+        self.max_handles = max_handles
+        self.max_cache_bytes = max_cache_bytes
+        self.max_skip_frames = max_skip_frames
+        self.stats = CacheStats()
+        self.opened = 0  # captures opened over the pool's lifetime
+        self._frames = OrderedDict()  # (path, frame index) -> RGB array
+        self._cache_bytes = 0
+        self._idle = OrderedDict()  # (path, reader id) -> reader, least recently used first
+        self._handles = 0  # open captures, idle or leased
+        self._versions = {}  # path -> (size, mtime_ns) the readers and frames belong to
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+
+    def _check_version(self, path):
+        """Drop readers and frames of `path` if the file changed since they were made. Caller holds the lock."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            raise ValueError(f"Could not open video file: {path}")
+        version = (stat.st_size, stat.st_mtime_ns)
+        if self._versions.get(path, version) != version:
+            self._drop(path)
+        self._versions[path] = version
+
+    def _drop(self, path):
+        """Close idle readers and forget cached frames of `path`. Caller holds the lock."""
+        for key in [key for key in self._idle if key[0] == path]:
+            self._idle.pop(key).release()
+            self._handles -= 1
+        for key in [key for key in self._frames if key[0] == path]:
+            self._cache_bytes -= self._frames.pop(key).nbytes
+        self._versions.pop(path, None)
+        self._available.notify_all()
+
+    @contextlib.contextmanager
+    def lease(self, path):
+        """Lease a reader for `path` for exclusive use, opening one if none is idle."""
+        path = os.path.abspath(path)
+        with self._lock:
+            self._check_version(path)
+            version = self._versions[path]
+            while True:
+                key = next((key for key in reversed(self._idle) if key[0] == path), None)
+                if key is not None:
+                    reader = self._idle.pop(key)
+                    break
+                if self._handles < self.max_handles or self._idle:
+                    if self._handles >= self.max_handles:
+                        # Close the least recently used idle reader of another file
+                        self._idle.popitem(last=False)[1].release()
+                        self._handles -= 1
+                    self._handles += 1
+                    reader = None
+                    break
+                self._available.wait()
+
+        if reader is None:
+            try:
+                reader = VideoReader(path, self.max_skip_frames)
+            except Exception:
+                with self._lock:
+                    self._handles -= 1
+                    self._available.notify()
+                raise
+            with self._lock:
+                self.opened += 1
+
+        try:
+            yield reader
+        finally:
+            with self._lock:
+                if self._versions.get(path) == version:
+                    self._idle[(path, id(reader))] = reader
+                else:
+                    # The file was released or changed while leased
+                    reader.release()
+                    self._handles -= 1
+                self._available.notify()
+
+    def fps(self, path):
+        """Frame rate of the video at `path`."""
+        with self.lease(path) as reader:
+            return reader.fps
+
+    def get_frames(self, path, frame_indices):
+        """
+        Return the frames at `frame_indices` as read-only RGB arrays.
+
+        Cached frames are returned directly; the rest are read in increasing
+        order with a single leased reader.
+
+        Returns:
+            dict[int, np.ndarray]: Frames keyed by index. Indices past the end
+                of the video are left out.
+        """
+        path = os.path.abspath(path)
+        frames = {}
+        missing = []
+        with self._lock:
+            self._check_version(path)
+            for frame_index in sorted(set(frame_indices)):
+                frame = self._frames.get((path, frame_index))
+                if frame is None:
+                    missing.append(frame_index)
+                    continue
+                self._frames.move_to_end((path, frame_index))
+                frames[frame_index] = frame
+            self.stats.hits += len(frames)
+            self.stats.misses += len(missing)
+
+        if missing:
+            import cv2
+
+            with metrics.span('frames.decode'), self.lease(path) as reader:
+                for frame_index in missing:
+                    frame = reader.read(frame_index)
+                    if frame is None:
+                        continue
+                    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                    frame.flags.writeable = False
+                    frames[frame_index] = frame
+                    self._put((path, frame_index), frame)
+        return frames
+
+    def get_frame(self, path, frame_index):
+        """Return the frame at `frame_index` as a read-only RGB array, or None past the end of the video."""
+        return self.get_frames(path, [frame_index]).get(frame_index)
+
+    def _put(self, key, frame):
+        if frame.nbytes > self.max_cache_bytes:
+            return
+        with self._lock:
+            previous = self._frames.pop(key, None)
+            if previous is not None:
+                self._cache_bytes -= previous.nbytes
+            self._frames[key] = frame
+            self._cache_bytes += frame.nbytes
+            while self._cache_bytes > self.max_cache_bytes:
+                _, evicted = self._frames.popitem(last=False)
+                self._cache_bytes -= evicted.nbytes
+                self.stats.evictions += 1
+
+    def release(self, path):
+        """Close the idle readers and drop the cached frames of `path`, e.g. before deleting the file."""
+        with self._lock:
+            self._drop(os.path.abspath(path))
+
+    def close(self):
+        """Close every idle reader and clear the frame cache."""
+        with self._lock:
+            for path in {key[0] for key in self._idle} | {key[0] for key in self._frames}:
+                self._drop(path)
+
+# Shared pool used by the frame extraction helpers
+video_reader_pool = VideoReaderPool()
@@ -0,0 +1,203 @@
+import dataclasses
+import os
+import time
+from annotation import annotate_detection_frames
+from metrics import metrics
+from render_resources import DETECTION_COLORS, color_to_rgb
+from video_frames import timestamp_to_seconds
+
+OUTPUT_MODES = ('frames', 'video', 'both')
+
+@dataclasses.dataclass
+class RenderStats:
+    frames: int
+    seconds: float  # wall-clock time spent rendering
+    fps: float  # frame rate of the source video
+
+    @property
+    def realtime_factor(self) -> float:
+        """Video seconds rendered per wall-clock second."""
+        return self.frames / self.fps / self.seconds if self.seconds else 0.0
+
+def _active_spans(items, fps, offset_seconds, hold_seconds):
+    """(first frame, last frame, detection index) for every parsable detection, sorted by first frame."""
+    spans = []
+    for i, item in enumerate(items):
+        try:
+            seconds = timestamp_to_seconds(item.timestamp) - offset_seconds
+        except ValueError:
+            continue
+        first = max(0, int(round((seconds - hold_seconds) * fps)))
+        last = int(round((seconds + hold_seconds) * fps))
+        if last >= 0:
+            spans.append((first, last, i))
+    spans.sort()
+    return spans
+
+def _output_size(width, height, max_height):
+    """Frame size after downscaling to at most `max_height`, rounded to even sides for the encoder."""
+    if max_height is None or height <= max_height:
+        return width, height
+    scale = max_height / height
+    return max(2, int(width * scale) // 2 * 2), max(2, int(max_height) // 2 * 2)
+
+@metrics.timed('render.video')
+def render_annotated_video(
+    video_path,
+    items,
+    output_path,
+    offset_seconds=0,
+    hold_seconds=1.0,
+    max_height=None,
+    start_seconds=0,
+    end_seconds=None,
+    fourcc='mp4v',
+):
+    """
+    Render detections back into a video in one decode/encode pass.
+
+    The source is streamed through `cv2.VideoCapture` once; each detection
+    is drawn on every frame within `hold_seconds` of its timestamp, and the
+    frames go straight to `cv2.VideoWriter`. Only the current frame is held
+    in memory, so memory use does not grow with the video's length. Boxes
+    and labels are drawn with OpenCV directly on the decoded BGR frames, with
+    their pixel coordinates computed once per detection.
+
+    Args:
+        video_path (str): Path to the source video.
+        items (list[VideoDetection]): Detections, with timestamps in source time.
+        output_path (str): Path of the video to write, e.g. ending in .mp4.
+        offset_seconds (float): Source time of the file's first frame, for
+            clips cut out of a longer video.
+        hold_seconds (float): How long before and after its timestamp a
+            detection stays on screen.
+        max_height (int): Downscale frames taller than this, or None to keep the size.
+        start_seconds (float): Start of the rendered section, in file time.
+        end_seconds (float): End of the rendered section in file time, or None for the end of the video.
+        fourcc (str): Four-character code of the output codec.
+    Returns:
+        RenderStats: Frames written and throughput.
+    """
+    import cv2
+
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise ValueError(f"Could not open video file: {video_path}")
+
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    if fps <= 0:
+        cap.release()
+        raise ValueError(f"Could not read the frame rate of {video_path}")
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    out_width, out_height = _output_size(width, height, max_height)
+
+    # Pixel geometry and colour of every detection, computed once
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    font_scale = max(0.4, out_height / 900)
+    thickness = max(1, round(out_height / 360))
+    boxes = []
+    for i, item in enumerate(items):
+        y_min, x_min, y_max, x_max = item.bounding_box
+        rect = (
+            int(x_min / 1000 * out_width), int(y_min / 1000 * out_height),
+            int(x_max / 1000 * out_width), int(y_max / 1000 * out_height),
+        )
+        red, green, blue = color_to_rgb(DETECTION_COLORS[i % len(DETECTION_COLORS)])
+        (text_width, text_height), baseline = cv2.getTextSize(item.type, font, font_scale, thickness)
+        boxes.append((rect, (blue, green, red), item.type, text_width, text_height, baseline))
+
+    spans = _active_spans(items, fps, offset_seconds, hold_seconds)
+
+    start_index = int(round(start_seconds * fps))
+    end_index = None if end_seconds is None else int(round(end_seconds * fps))
+    if start_index > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start_index)
+
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*fourcc), fps, (out_width, out_height))
+    if not writer.isOpened():
+        cap.release()
+        raise ValueError(f"Could not open video writer for {output_path} with codec {fourcc}")
+
+    started = time.perf_counter()
+    frame_index = start_index
+    next_span = 0
+    active = []  # (last frame, detection index)
+    try:
+        while end_index is None or frame_index <= end_index:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if (out_width, out_height) != (width, height):
+                frame = cv2.resize(frame, (out_width, out_height), interpolation=cv2.INTER_AREA)
+
+            # Sweep the spans: add those starting by this frame, drop those that ended
+            while next_span < len(spans) and spans[next_span][0] <= frame_index:
+                active.append((spans[next_span][1], spans[next_span][2]))
+                next_span += 1
+            active = [(last, i) for last, i in active if last >= frame_index]
+
+            # Boxes first, then labels, so no box covers a label
+            for _, i in active:
+                (x0, y0, x1, y1), color, *_ = boxes[i]
+                cv2.rectangle(frame, (x0, y0), (x1, y1), color, thickness + 1)
+            for _, i in active:
+                (x0, y0, _, _), color, label, text_width, text_height, baseline = boxes[i]
+                top = max(0, y0 - text_height - baseline)
+                cv2.rectangle(frame, (x0, top), (x0 + text_width, top + text_height + baseline), color, cv2.FILLED)
+                cv2.putText(frame, label, (x0, top + text_height), font, font_scale, (255, 255, 255), thickness, cv2.LINE_AA)
+
+            writer.write(frame)
+            frame_index += 1
+    finally:
+        cap.release()
+        writer.release()
+
+    metrics.increment('video_frames_rendered', frame_index - start_index)
+    return RenderStats(frame_index - start_index, time.perf_counter() - started, fps)
+
+def check_output_mode(output_mode):
+    if output_mode not in OUTPUT_MODES:
+        raise ValueError(f"Unknown output mode: {output_mode}")
+
+def save_video_annotations(
+    video_path,
+    items,
+    output_mode,
+    writer,
+    video_output_path,
+    prefix='video_frame',
+    offset_seconds=0,
+    hold_seconds=1.0,
+    max_height=None,
+    start_seconds=0,
+    end_seconds=None,
+    skip_frames=False,
+):
+    """
+    Save the detections of a video as `output_mode` asks.
+
+    'frames' draws them onto their frames, saved by `writer` with a JSON
+    sidecar each (see `annotate_detection_frames`); 'video' renders an
+    annotated copy of the `start_seconds`-`end_seconds` section to
+    `video_output_path` (see `render_annotated_video`); 'both' does both.
+    `skip_frames` leaves out frames that were already drawn, e.g. while
+    streaming.
+    """
+    check_output_mode(output_mode)
+    if output_mode in ('frames', 'both') and not skip_frames:
+        annotate_detection_frames(video_path, items, writer, prefix=prefix, offset_seconds=offset_seconds)
+
+    if output_mode in ('video', 'both'):
+        stats = render_annotated_video(
+            video_path,
+            items,
+            video_output_path,
+            offset_seconds=offset_seconds,
+            hold_seconds=hold_seconds,
+            max_height=max_height,
+            start_seconds=start_seconds,
+            end_seconds=end_seconds,
+        )
+        print(f'Saved annotated video: {video_output_path} ({stats.frames} frames, {stats.realtime_factor:.1f}x real time)')
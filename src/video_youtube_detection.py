@@ -1,143 +1,86 @@
-from google import genai
-from google.genai import types
-from PIL import Image, ImageDraw, ImageFont
-import json
 import os
-import cv2
-import yt_dlp
 import tempfile
+import hashlib
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, wait
+from annotation import FrameWriter, OutputEncoding, annotate_frame_detections
+from genai_client import get_client
+from metrics import metrics
+from rate_limiter import RateLimiter
+from response_cache import cached_generate_content, cached_generate_content_stream
+from schemas import VideoDetection, iter_stream_items, parse_items, response_config
+from video_chunking import ChunkCheckpoint, analyze_in_chunks, checkpoint_path
+from video_frames import estimate_video_tokens, offset_to_seconds, group_detections_by_frame
+from video_render import check_output_mode, save_video_annotations
+from video_reader import video_reader_pool
 
-client = genai.Client()
-
-def parse_json(json_output: str):
-    """Parse JSON output by removing markdown fencing."""
-    lines = json_output.splitlines()
-    for i, line in enumerate(lines):
-        if line == "```json":
-            json_output = "\n".join(lines[i+1:])  # Remove everything before "```json"
-            json_output = json_output.split("```")[0]  # Remove everything after the closing "```"
-            break  # Exit the loop once "```json" is found
-    return json_output
-
-def timestamp_to_seconds(timestamp):
-    """Convert timestamp string (HH:MM:SS) to seconds."""
-    parts = timestamp.split(':')
-    if len(parts) == 3:
-        hours, minutes, seconds = map(int, parts)
-        return hours * 3600 + minutes * 60 + seconds
-    elif len(parts) == 2:
-        minutes, seconds = map(int, parts)
-        return minutes * 60 + seconds
-    else:
-        return int(parts[0])
-
-def extract_frame_at_timestamp(video_path, timestamp, output_path=None):
-    """Extract a frame from video at the specified timestamp."""
-    cap = cv2.VideoCapture(video_path)
-    
-    if not cap.isOpened():
-        raise ValueError(f"Could not open video file: {video_path}")
-    
-    # Convert timestamp to seconds
-    seconds = timestamp_to_seconds(timestamp)
-    
-    # Set video position to the timestamp
-    cap.set(cv2.CAP_PROP_POS_MSEC, seconds * 1000)
-    
-    # Read the frame
-    ret, frame = cap.read()
-    cap.release()
-    
-    if not ret:
-        raise ValueError(f"Could not extract frame at timestamp {timestamp}")
-    
-    # Convert BGR to RGB
-    frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-    
-    # Convert to PIL Image
-    pil_image = Image.fromarray(frame_rgb)
-    
-    # Save if output path is provided
-    if output_path:
-        pil_image.save(output_path)
-    
-    return pil_image
+VIDEO_CACHE_DIR = os.path.join('.cache', 'videos')
 
-def download_youtube_video(url, output_path=None):
-    """Download YouTube video to a temporary file."""
+def video_cache_key(url, start_seconds=None, end_seconds=None, video_format='best[height<=720]'):
+    """
+    Key a download by the video it contains rather than the exact URL.
+
+    YouTube watch URLs that differ only in extra query parameters (such as
+    `ab_channel`) or in their short form (youtu.be) share the same key.
+    """
+    parsed = urllib.parse.urlparse(url)
+    video_id = urllib.parse.parse_qs(parsed.query).get('v', [None])[0]
+    if video_id is None and parsed.netloc.endswith('youtu.be'):
+        video_id = parsed.path.strip('/')
+    source = f'youtube:{video_id}' if video_id else url
+    key = f'{source}|{video_format}|{start_seconds}|{end_seconds}'
+    return hashlib.sha256(key.encode()).hexdigest()
+
+@metrics.timed('youtube.download')
+def download_youtube_video(url, output_path=None, start_seconds=None, end_seconds=None, cache_dir=VIDEO_CACHE_DIR):
+    """
+    Download YouTube video, or just a section of it, to a local file.
+
+    When `start_seconds`/`end_seconds` are given only that range is downloaded
+    (with keyframes forced at the cuts so the clip starts exactly at
+    `start_seconds`). Downloads are kept in `cache_dir`, keyed by
+    `video_cache_key`, so repeated analyses of the same video and range skip
+    the download. Pass `cache_dir=None` to download to a temporary file.
+    """
+    video_format = 'best[height<=720]'  # Limit to 720p for faster processing
     if output_path is None:
-        output_path = tempfile.mktemp(suffix='.mp4')
-    
+        if cache_dir is None:
+            output_path = tempfile.mktemp(suffix='.mp4')
+        else:
+            key = video_cache_key(url, start_seconds, end_seconds, video_format)
+            output_path = os.path.join(cache_dir, f'{key}.mp4')
+            if os.path.exists(output_path):
+                return output_path
+            os.makedirs(cache_dir, exist_ok=True)
+
+    # Download next to the destination and move it in place once complete,
+    # so an interrupted download never leaves a truncated file in the cache
+    import yt_dlp
+
+    partial_path = f'{output_path}.part.mp4'
     ydl_opts = {
-        'format': 'best[height<=720]',  # Limit to 720p for faster processing
-        'outtmpl': output_path,
+        'format': video_format,
+        'outtmpl': partial_path,
     }
-    
+    if start_seconds is not None or end_seconds is not None:
+        ydl_opts['download_ranges'] = yt_dlp.utils.download_range_func(
+            None, [(start_seconds or 0, end_seconds if end_seconds is not None else float('inf'))]
+        )
+        ydl_opts['force_keyframes_at_cuts'] = True
+
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
         ydl.download([url])
-    
-    # Check if file was actually created
-    if not os.path.exists(output_path):
-        raise FileNotFoundError(f"Video download failed - file not found at {output_path}")
-    
-    return output_path
 
-def draw_bounding_box(image_path, bounding_box, label):
-    """
-    Draws a bounding box with label on the image.
-    Args:
-        image_path (str): Path to the input image.
-        bounding_box (list): [y_min, x_min, y_max, x_max] in 0-1000 scale.
-        label (str): Label for the bounding box.
-    Returns:
-        Image object with bounding box drawn.
-    """
-    image = Image.open(image_path).convert('RGB')
-    draw = ImageDraw.Draw(image)
-    width, height = image.size
-
-    # Convert normalized coordinates to pixel values
-    y_min, x_min, y_max, x_max = bounding_box
-    
-    y_min = int(y_min / 1000 * height)
-    y_max = int(y_max / 1000 * height)
-    x_min = int(x_min / 1000 * width)
-    x_max = int(x_max / 1000 * width)
-
-    # Draw rectangle
-    draw.rectangle((x_min, y_min, x_max, y_max), outline='red', width=3)
-
-    # Prepare label text
-    text = f"{label}"
-    try:
-        font = ImageFont.truetype("arial.ttf", 20)
-    except:
-        font = ImageFont.load_default()
-    
-    # Calculate text size using textbbox for compatibility
-    text_bbox = draw.textbbox((x_min, y_min), text, font=font)
-    text_width = text_bbox[2] - text_bbox[0]
-    text_height = text_bbox[3] - text_bbox[1]
-    text_bg = (x_min, y_min - text_height, x_min + text_width, y_min)
-    draw.rectangle(text_bg, fill='red')
-    draw.text((x_min, y_min - text_height), text, fill='white', font=font)
-
-    return image
+    # Check if file was actually created
+    if not os.path.exists(partial_path):
+        raise FileNotFoundError(f"Video download failed - file not found at {partial_path}")
+    metrics.increment('bytes_downloaded', os.path.getsize(partial_path))
+    os.replace(partial_path, output_path)
 
-def save_image_to_output(image, filename):
-    """
-    Saves the image to the output folder, creating it if necessary.
-    Args:
-        image (PIL.Image): Image object to save.
-        filename (str): Name of the file to save as.
-    """
-    output_dir = 'output'
-    os.makedirs(output_dir, exist_ok=True)
-    output_path = os.path.join(output_dir, filename)
-    image.save(output_path)
+    return output_path
 
-def analyze_youtube_video(video_url: str, start_offset: str, end_offset: str):
-    """Analyze YouTube video for dark patterns."""
+def build_request(video_url: str, start_offset: str, end_offset: str, structured_output: bool = True):
+    """Build the contents and config of a detection request for a section of a YouTube video."""
     prompt = """
     Give the detections for dark patterns.
     Type of Dark Patterns:
@@ -167,73 +110,176 @@ def analyze_youtube_video(video_url: str, start_offset: str, end_offset: str):
             - type: The type of dark pattern
             - description: Describe what the dark pattern is doing at that timestamp
             - bounding_box: Include a bounding box in y_min, x_min, y_max, x_max format
+            - confidence: How confident you are in the detection, from 0 to 100
     4. The origin is the top-left of the image
     """
 
-    response = client.models.generate_content(
-        model='models/gemini-2.5-flash',
-        contents=types.Content(
-            parts=[
-                types.Part(
-                    file_data=types.FileData(file_uri=video_url),
-                    video_metadata=types.VideoMetadata(
-                        start_offset=start_offset,
-                        end_offset=end_offset
-                    )
-                ),
-                types.Part(text=prompt)
-            ]
-        )
+    from google.genai import types
+
+    contents = types.Content(
+        parts=[
+            types.Part(
+                file_data=types.FileData(file_uri=video_url),
+                video_metadata=types.VideoMetadata(
+                    start_offset=start_offset,
+                    end_offset=end_offset
+                )
+            ),
+            types.Part(text=prompt)
+        ]
+    )
+    config = types.GenerateContentConfig(
+        **(response_config(VideoDetection) if structured_output else {})
+    )
+
+    return contents, config
+
+def _parse_detections(text):
+    with metrics.span('video.parse'):
+        return parse_items(text, VideoDetection)
+
+def detect_dark_patterns(
+    video_url: str, start_offset: str, end_offset: str, structured_output: bool = True, limiter: RateLimiter | None = None
+):
+    """
+    Ask the model for the dark patterns in a section of a YouTube video, waiting for a slot of `limiter` if given and not cached.
+
+    Returns:
+        list[VideoDetection]: The detected events.
+    """
+    contents, config = build_request(video_url, start_offset, end_offset, structured_output)
+    response, items = cached_generate_content(
+        get_client(), model='models/gemini-2.5-flash', contents=contents, config=config, parse=_parse_detections,
+        limiter=limiter, tokens=estimate_video_tokens(start_offset, end_offset),
     )
-    
     print(response.text)
-    items = json.loads(parse_json(response.text))
-    
-    # Download the video
-    print(f"Downloading video from {video_url}...")
-    video_path = download_youtube_video(video_url)
+    return items
 
-    # Extract frames and draw bounding boxes for each detected pattern
-    for item in items:
-        try:
-            # Extract frame at the timestamp
-            frame = extract_frame_at_timestamp(video_path, item["timestamp"])
-            
-            # Save frame to temporary file
-            temp_frame_path = tempfile.mktemp(suffix='.png')
-            frame.save(temp_frame_path)
-            
-            # Draw bounding box on the frame
-            img_with_box = draw_bounding_box(
-                image_path=temp_frame_path,
-                bounding_box=item["bounding_box"],
-                label=item["type"],
+@metrics.timed('youtube.analyze')
+def analyze_youtube_video(
+    video_url: str,
+    start_offset: str,
+    end_offset: str,
+    structured_output: bool = True,
+    stream: bool = False,
+    pipelined: bool = True,
+    cache_video: bool = True,
+    chunk_seconds: float | None = None,
+    chunk_overlap_seconds: float = 5,
+    max_workers: int = 4,
+    encoding: OutputEncoding | None = None,
+    writer_workers: int = 2,
+    output_mode: str = 'frames',
+    hold_seconds: float = 1.0,
+    video_max_height: int | None = None,
+    output_dir: str = 'output',
+    limiter: RateLimiter | None = None,
+):
+    """
+    Analyze YouTube video for dark patterns.
+
+    Only the `start_offset`-`end_offset` section of the video is downloaded.
+    With `pipelined` the download runs while the model is analyzing the
+    video. With `cache_video` the section is kept in the local video cache
+    for later analyses, otherwise it is deleted afterwards.
+
+    With `stream` each detection is annotated as soon as it is received, and
+    a frame is redrawn when another detection lands on it. It cannot be
+    combined with `chunk_seconds` (see `analyze_in_chunks`).
+
+    See `save_video_annotations` for `output_mode`. Everything is saved to
+    `output_dir`.
+
+    Returns:
+        list[VideoDetection]: The detections.
+    """
+    if stream and chunk_seconds is not None:
+        raise ValueError("stream and chunk_seconds cannot be combined")
+    check_output_mode(output_mode)
+    draw_frames = output_mode in ('frames', 'both')
+
+    start_seconds = offset_to_seconds(start_offset)
+    end_seconds = offset_to_seconds(end_offset)
+
+    def fetch_video():
+        print(f"Downloading video from {video_url}...")
+        return download_youtube_video(
+            video_url,
+            start_seconds=start_seconds,
+            end_seconds=end_seconds,
+            cache_dir=VIDEO_CACHE_DIR if cache_video else None,
+        )
+
+    with ThreadPoolExecutor(max_workers=1) as executor, FrameWriter(output_dir, encoding=encoding, max_workers=writer_workers) as writer:
+        download = executor.submit(fetch_video)
+        if not pipelined:
+            download.result()
+
+        if stream:
+            contents, config = build_request(video_url, start_offset, end_offset, structured_output)
+            chunks = cached_generate_content_stream(
+                get_client(), model='models/gemini-2.5-flash', contents=contents, config=config, parse=_parse_detections,
+                limiter=limiter, tokens=estimate_video_tokens(start_offset, end_offset),
             )
-            
-            # Save the frame with bounding box
-            safe_pattern_type = ''.join(c for c in item["type"] if c.isalnum() or c in '-_')
-            safe_timestamp = item["timestamp"].replace(':', '-')
-            filename = f'video_frame_{safe_timestamp}_{safe_pattern_type}.png'
-            save_image_to_output(img_with_box, filename)
-            print(f'Saved frame with bounding box: {filename}')
-            
-            # Clean up temporary frame file
-            try:
-                os.remove(temp_frame_path)
-            except:
-                pass
-                
-        except Exception as e:
-            print(f"Failed to process frame at {item['timestamp']}: {str(e)}")
-
-    # Clean up the downloaded video
-    try:
-        os.remove(video_path)
-    except:
-        pass
-
-if __name__ == "__main__":
-    # analyze_youtube_video('https://www.youtube.com/watch?v=XEzRZ35urlk', '1250s', '1570s')
-    analyze_youtube_video('https://www.youtube.com/watch?v=DeumyOzKqgI&ab_channel=AdeleVEVO', '0s', '120s')
-    # analyze_youtube_video('https://www.youtube.com/watch?v=K-j7Ty2rHBc&ab_channel=KevinStratvert', '0s', '361s')
-    # analyze_youtube_video('https://www.youtube.com/watch?v=EMWFZ6HoyMY&ab_channel=Techquickie', '0s', '40s')
\ No newline at end of file
+            # Detections seen so far and the last write, per frame index
+            stream_groups = {}
+            writes = {}
+            items = []
+            for item in iter_stream_items((chunk.text for chunk in chunks), VideoDetection):
+                items.append(item)
+                if not draw_frames:
+                    continue
+                try:
+                    # The downloaded clip starts at start_seconds of the source video
+                    groups = group_detections_by_frame(download.result(), [item], offset_seconds=start_seconds)
+                    if not groups:
+                        raise ValueError(f"Could not extract frame at timestamp {item.timestamp}")
+                    frame_index, frame, _ = groups[0]
+                    group = stream_groups.setdefault(frame_index, [])
+                    group.append(item)
+                    # Redraw the frame with every detection so far; the newer
+                    # write must not be overtaken by the one it replaces
+                    if frame_index in writes:
+                        wait([writes[frame_index]])
+                    writes[frame_index] = annotate_frame_detections(frame, group, writer, frame_index=frame_index)
+                except Exception as e:
+                    print(f"Failed to process frame at {item.timestamp}: {str(e)}")
+        else:
+            if chunk_seconds is None:
+                items = detect_dark_patterns(video_url, start_offset, end_offset, structured_output, limiter)
+            else:
+                items = analyze_in_chunks(
+                    lambda start, end: detect_dark_patterns(video_url, start, end, structured_output, limiter),
+                    start_seconds,
+                    end_seconds,
+                    window_seconds=chunk_seconds,
+                    overlap_seconds=chunk_overlap_seconds,
+                    max_workers=max_workers,
+                    checkpoint=ChunkCheckpoint(checkpoint_path(
+                        video_cache_key(video_url), start_offset, end_offset, chunk_seconds, chunk_overlap_seconds, structured_output
+                    )),
+                )
+
+        # The downloaded clip starts at start_seconds of the source video
+        save_video_annotations(
+            download.result(),
+            items,
+            output_mode,
+            writer,
+            os.path.join(output_dir, f'youtube_{video_cache_key(video_url)[:12]}_annotated.mp4'),
+            offset_seconds=start_seconds,
+            hold_seconds=hold_seconds,
+            max_height=video_max_height,
+            # Streamed detections were drawn as they arrived
+            skip_frames=stream,
+        )
+
+    # Clean up the downloaded video unless it is kept in the cache
+    if not cache_video:
+        try:
+            video_reader_pool.release(download.result())
+            os.remove(download.result())
+        except:
+            pass
+
+    return items
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The analyzers are flat modules in src/, imported the way main.py does;
+# main.py itself is at the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'src'))
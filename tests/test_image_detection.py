@@ -0,0 +1,64 @@
+import base64
+import io
+import numpy as np
+from PIL import Image
+import genai_client
+from image_detection import analyze_images_concurrently, decode_segmentation_masks, mask_boxes
+from replay_client import ReplayClient, synthetic_segmentation_response
+from response_cache import response_cache
+from schemas import SegmentationItem
+
+def png_item(box, mask):
+    buffer = io.BytesIO()
+    Image.fromarray(mask).save(buffer, format='PNG')
+    return SegmentationItem(
+        box_2d=list(box), mask='data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode(), label='ad',
+    )
+
+def test_mask_boxes_truncates_like_int():
+    items = [png_item((100, 250, 999, 500), np.zeros((4, 4), np.uint8))]
+    assert mask_boxes(items, (333, 200)).tolist() == [[int(100 / 1000 * 200), int(250 / 1000 * 333), int(999 / 1000 * 200), int(500 / 1000 * 333)]]
+
+def test_decoders_agree_and_threshold_to_0_255():
+    mask = np.linspace(0, 255, 32 * 32).astype(np.uint8).reshape(32, 32)
+    items = [png_item((0, 0, 500, 500), mask)]
+    masks = {decoder: decode_segmentation_masks(items, (100, 80), decoder) for decoder in ('cv2', 'pil')}
+    for decoded in masks.values():
+        assert len(decoded) == 1
+        assert decoded[0].crop.shape == (40, 50)
+        assert set(np.unique(decoded[0].crop)) <= {0, 255}
+    # Both resize with area averaging or bilinear filtering; only pixels at the threshold may differ
+    assert np.mean(masks['cv2'][0].crop != masks['pil'][0].crop) < 0.05
+
+def test_items_with_empty_boxes_or_no_png_are_skipped():
+    good = png_item((0, 0, 500, 500), np.full((4, 4), 255, np.uint8))
+    empty = png_item((500, 0, 500, 500), np.full((4, 4), 255, np.uint8))
+    not_png = good.model_copy(update={'mask': 'data:image/jpeg;base64,AAAA'})
+    assert len(decode_segmentation_masks([good, empty, not_png], (100, 100))) == 1
+
+def test_cached_reruns_do_not_use_request_quota(tmp_path, monkeypatch):
+    class CountingLimiter:
+        def __init__(self):
+            self.acquired = []
+
+        def acquire(self, tokens=0):
+            self.acquired.append(tokens)
+
+    monkeypatch.setattr(response_cache, 'cache_dir', str(tmp_path / 'responses'))
+    segmentation = synthetic_segmentation_response(np.random.default_rng(0), count=2, image_size=(400, 300))
+    genai_client.set_client(ReplayClient({'segmentation': [segmentation], 'video': ['[]']}))
+    try:
+        # Tall enough to be tiled
+        source = tmp_path / 'page.png'
+        Image.fromarray(np.random.default_rng(1).integers(0, 256, (1200, 300, 3), dtype=np.uint8)).save(source)
+        runs = []
+        for _ in range(2):
+            limiter = CountingLimiter()
+            results = list(analyze_images_concurrently([source], tmp_path / 'out', limiter=limiter))
+            assert results[0].error is None
+            runs.append(limiter.acquired)
+    finally:
+        genai_client.set_client(None)
+
+    assert len(runs[0]) > 1 and all(tokens > 0 for tokens in runs[0])
+    assert runs[1] == []
@@ -0,0 +1,15 @@
+from image_tiling import plan_resolution
+
+def test_image_just_over_the_aspect_limit_stays_whole():
+    tiles = plan_resolution(800, 1601)
+    assert [(tile.left, tile.top, tile.right, tile.bottom) for tile in tiles] == [(0, 0, 800, 1601)]
+
+def test_tall_screenshot_is_cut_into_overlapping_tiles():
+    tiles = plan_resolution(800, 6000)
+    assert len(tiles) > 1
+    assert tiles[0].top == 0 and tiles[-1].bottom == 6000
+    for upper, lower in zip(tiles, tiles[1:]):
+        assert lower.top < upper.bottom
+    for tile in tiles:
+        assert tile.bottom - tile.top <= 1600
+        assert max(tile.request_size) <= 1024
@@ -0,0 +1,29 @@
+import json
+import numpy as np
+import pytest
+from PIL import Image
+import genai_client
+import main
+from replay_client import ReplayClient, synthetic_segmentation_response
+from response_cache import response_cache
+
+@pytest.fixture
+def replay(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(response_cache, 'cache_dir', str(tmp_path / 'responses'))
+    segmentation = synthetic_segmentation_response(np.random.default_rng(0), count=3, image_size=(320, 240))
+    genai_client.set_client(ReplayClient({'segmentation': [segmentation], 'video': ['[]']}))
+    yield
+    genai_client.set_client(None)
+
+@pytest.mark.parametrize('suffix', ['.jpg', '.bmp', '.gif'])
+def test_image_in_a_format_without_alpha_is_rendered_in_that_format(replay, tmp_path, suffix):
+    source = tmp_path / f'screen{suffix}'
+    Image.new('RGB', (320, 240), 'white').save(source)
+
+    assert main.main([str(source), '--output-dir', 'output', '--summary', 'summary.json']) == 0
+
+    summary = json.loads((tmp_path / 'summary.json').read_text())
+    assert summary['failed'] == 0
+    with Image.open(tmp_path / 'output' / 'images_mask' / f'masks_screen{suffix}') as rendered:
+        assert rendered.size == (320, 240)
@@ -0,0 +1,87 @@
+import datetime
+import json
+from google.genai import types
+from media_transport import file_sha256, media_part, upload_file
+
+class FakeFile:
+    def __init__(self, name, mime_type, expiration_time):
+        self.name = name
+        self.uri = f'https://files.test/{name}'
+        self.mime_type = mime_type
+        self.expiration_time = expiration_time
+        self.state = types.FileState.PROCESSING
+        self.error = None
+
+class FakeFiles:
+    """Stands in for `client.files`: reads uploads through and finishes processing on the first poll."""
+
+    def __init__(self, expires_in=datetime.timedelta(hours=48)):
+        self.expires_in = expires_in
+        self.uploads = []
+        self._files = {}
+
+    def upload(self, file, config=None):
+        data = file.read()
+        name = f'files/{len(self.uploads)}'
+        self.uploads.append(data)
+        self._files[name] = FakeFile(name, config.mime_type, datetime.datetime.now(datetime.timezone.utc) + self.expires_in)
+        return self._files[name]
+
+    def get(self, name):
+        self._files[name].state = types.FileState.ACTIVE
+        return self._files[name]
+
+class FakeClient:
+    def __init__(self, **kwargs):
+        self.files = FakeFiles(**kwargs)
+
+def test_upload_is_reused_for_the_same_content(tmp_path, monkeypatch):
+    monkeypatch.setattr('media_transport.time.sleep', lambda seconds: None)
+    video = tmp_path / 'clip.mp4'
+    video.write_bytes(b'video bytes')
+    cache_path = str(tmp_path / 'uploads.json')
+    client = FakeClient()
+
+    first = upload_file(client, str(video), cache_path=cache_path)
+    second = upload_file(client, str(video), cache_path=cache_path)
+
+    assert client.files.uploads == [b'video bytes']
+    assert first.file_uri == second.file_uri == 'https://files.test/files/0'
+    assert first.mime_type == 'video/mp4'
+    assert list(json.loads(open(cache_path).read())) == [file_sha256(str(video))]
+
+    # New content is a new upload
+    video.write_bytes(b'other video bytes')
+    assert upload_file(client, str(video), cache_path=cache_path).file_uri == 'https://files.test/files/1'
+
+def test_expiring_upload_is_uploaded_again(tmp_path, monkeypatch):
+    monkeypatch.setattr('media_transport.time.sleep', lambda seconds: None)
+    video = tmp_path / 'clip.mp4'
+    video.write_bytes(b'video bytes')
+    cache_path = str(tmp_path / 'uploads.json')
+    client = FakeClient(expires_in=datetime.timedelta(minutes=5))
+
+    upload_file(client, str(video), cache_path=cache_path)
+    upload_file(client, str(video), cache_path=cache_path)
+    assert len(client.files.uploads) == 2
+
+def test_small_files_are_sent_inline(tmp_path):
+    video = tmp_path / 'clip.mp4'
+    video.write_bytes(b'video bytes')
+    client = FakeClient()
+
+    part = media_part(client, str(video))
+    assert part.inline_data.data == b'video bytes'
+    assert client.files.uploads == []
+
+def test_larger_files_are_uploaded(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr('media_transport.time.sleep', lambda seconds: None)
+    video = tmp_path / 'clip.mp4'
+    video.write_bytes(b'video bytes')
+    client = FakeClient()
+
+    part = media_part(client, str(video), video_metadata=types.VideoMetadata(start_offset='5s'), inline_max_bytes=4)
+    assert part.inline_data is None
+    assert part.file_data.file_uri == 'https://files.test/files/0'
+    assert part.video_metadata.start_offset == '5s'
@@ -0,0 +1,67 @@
+import json
+import pytest
+from pydantic import BaseModel
+from response_cache import ResponseCache
+from schemas import response_config
+
+class FakeResponse:
+    usage_metadata = None
+
+    def __init__(self, text):
+        self.text = text
+
+class FakeClient:
+    """Stands in for `genai.Client`, replying with `texts` in order."""
+
+    def __init__(self, *texts):
+        self.models = self
+        self.texts = list(texts)
+        self.calls = 0
+
+    def generate_content(self, model, contents, config=None):
+        self.calls += 1
+        return FakeResponse(self.texts.pop(0))
+
+def test_key_changes_with_the_model_of_a_list_schema():
+    cache = ResponseCache(cache_dir=None)
+
+    class Item(BaseModel):
+        label: str
+
+    before = cache.key('model', 'prompt', response_config(Item))
+
+    # Same name, new field
+    class Item(BaseModel):
+        label: str
+        confidence: float
+
+    assert cache.key('model', 'prompt', response_config(Item)) != before
+
+def test_only_responses_that_parse_are_stored(tmp_path):
+    cache = ResponseCache(cache_dir=str(tmp_path))
+    client = FakeClient('[{"trunc', '[1, 2]')
+
+    with pytest.raises(ValueError):
+        cache.generate_content(client, 'model', 'prompt', parse=json.loads)
+    _, items = cache.generate_content(client, 'model', 'prompt', parse=json.loads)
+    _, cached_items = cache.generate_content(client, 'model', 'prompt', parse=json.loads)
+
+    assert items == cached_items == [1, 2]
+    assert client.calls == 2
+    assert (cache.stats.hits, cache.stats.misses) == (1, 2)
+
+class CountingLimiter:
+    def __init__(self):
+        self.acquired = []
+
+    def acquire(self, tokens=0):
+        self.acquired.append(tokens)
+
+def test_only_cache_misses_wait_for_the_limiter(tmp_path):
+    cache = ResponseCache(cache_dir=str(tmp_path))
+    client = FakeClient('[1]')
+    limiter = CountingLimiter()
+
+    for _ in range(2):
+        cache.generate_content(client, 'model', 'prompt', parse=json.loads, limiter=limiter, tokens=300)
+    assert limiter.acquired == [300]
@@ -0,0 +1,31 @@
+import numpy as np
+from image_detection import SegmentationMask
+from results_store import ResultsStore, decode_counts, encode_counts, rle_counts, rle_to_crop
+from schemas import VideoDetection
+
+def make_mask(box, image_size, seed=0):
+    y0, x0, y1, x1 = box
+    crop = np.random.default_rng(seed).integers(0, 2, (y1 - y0, x1 - x0), dtype=np.uint8) * np.uint8(255)
+    return SegmentationMask(y0, x0, y1, x1, crop, 'label', image_size)
+
+def test_rle_round_trip():
+    mask = make_mask((3, 4, 17, 11), (20, 25))
+    counts = rle_counts(mask)
+    assert sum(counts) == 20 * 25
+    assert decode_counts(encode_counts(counts)) == counts
+    np.testing.assert_array_equal(rle_to_crop(counts, (3, 4, 17, 11), (20, 25)), mask.crop)
+
+def test_rle_matches_full_mask_in_column_major_order():
+    mask = make_mask((0, 0, 6, 5), (5, 6), seed=1)
+    mask.crop[0, 0] = 255
+    counts = rle_counts(mask)
+    # Runs start with background, so a set first pixel gives an empty first run
+    assert counts[0] == 0
+    pixels = np.repeat([i % 2 for i in range(len(counts))], counts)
+    np.testing.assert_array_equal(pixels.reshape(5, 6).T, mask.full_mask() > 127)
+
+def test_load_masks_of_a_video_only_store(tmp_path):
+    store = ResultsStore(str(tmp_path))
+    detection = VideoDetection(timestamp='00:00:07', type='Nagging', description='', bounding_box=[0, 0, 10, 10])
+    records = store.add_video_result('clip.mp4', [detection])
+    assert store.load_masks(records) == []
@@ -0,0 +1,32 @@
+import pytest
+from pydantic import ValidationError
+from schemas import JsonArrayStream, VideoDetection, iter_stream_items, parse_items
+
+DETECTION = '{"timestamp": "00:00:07", "type": "Nagging", "description": "A [popup]", "bounding_box": [1, 2, 3, 4], "confidence": 80}'
+
+def test_json_array_stream_yields_elements_across_chunks():
+    text = f'```json\n[{DETECTION}, {DETECTION}]\n```'
+    stream = JsonArrayStream()
+    elements = []
+    for i in range(0, len(text), 7):
+        elements += stream.feed(text[i:i + 7])
+    assert [element['description'] for element in elements] == ['A [popup]', 'A [popup]']
+
+def test_iter_stream_items():
+    chunks = ['[', DETECTION[:20], DETECTION[20:], ']']
+    assert [item.timestamp for item in iter_stream_items(chunks, VideoDetection)] == ['00:00:07']
+
+def test_iter_stream_items_falls_back_to_whole_text_after_prose_bracket():
+    # The stream takes "[see below]" as the array and yields nothing from it
+    chunks = ['Results [see below]:\n', f'```json\n[{DETECTION}]\n```']
+    assert [item.type for item in iter_stream_items(chunks, VideoDetection)] == ['Nagging']
+
+def test_malformed_boxes_are_skipped_not_fatal():
+    short_box = DETECTION.replace('[1, 2, 3, 4]', '[1, 2, 3]')
+    text = f'[{DETECTION}, {short_box}]'
+    assert len(parse_items(text, VideoDetection)) == 1
+    assert len(list(iter_stream_items([text], VideoDetection))) == 1
+
+def test_a_reply_without_any_valid_item_is_an_error():
+    with pytest.raises(ValidationError):
+        parse_items(f"[{DETECTION.replace('[1, 2, 3, 4]', '[1, 2, 3, 4, 5]')}]", VideoDetection)
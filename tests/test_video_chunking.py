@@ -0,0 +1,64 @@
+import pytest
+from response_cache import response_cache
+from schemas import VideoDetection
+from video_chunking import ChunkCheckpoint, analyze_in_chunks, merge_detections, rebase_detections
+
+def detection(timestamp, type='Nagging', box=(0, 0, 100, 100)):
+    return VideoDetection(timestamp=timestamp, type=type, description='', bounding_box=list(box), confidence=50)
+
+def timestamps(items):
+    return [item.timestamp for item in items]
+
+def test_rebase_drops_unparsable_timestamps():
+    assert timestamps(rebase_detections([detection('7s'), detection('0:40')], 30)) == ['00:00:40']
+
+def test_rebase_keeps_source_times_of_clipped_requests():
+    # Times that would also fit in the 60s window are not mistaken for clip time
+    assert timestamps(rebase_detections([detection('00:00:35'), detection('00:01:15')], 30)) == ['00:00:35', '00:01:15']
+
+def test_rebase_shifts_clip_relative_times():
+    assert timestamps(rebase_detections([detection('00:00:10'), detection('00:01:00')], 30, relative=True)) == ['00:00:40', '00:01:30']
+
+def test_merge_drops_duplicates_from_other_windows_only():
+    windows = [
+        [detection('00:00:50'), detection('00:00:51')],
+        [detection('00:00:51'), detection('garbled')],
+    ]
+    # The same-window pair is kept, the overlapping window's copy and the unparsable one are not
+    assert timestamps(merge_detections(windows)) == ['00:00:50', '00:00:51']
+
+def test_merge_orders_ties_by_window():
+    windows = [[detection('00:00:50', 'Nagging')], [detection('00:00:50', 'Sneaking')]]
+    assert [item.type for item in merge_detections(windows)] == ['Nagging', 'Sneaking']
+
+def test_checkpoint_resumes_a_failed_run_and_is_cleared_after_success(tmp_path):
+    checkpoint = ChunkCheckpoint(str(tmp_path / 'checkpoint.json'))
+    calls = []
+
+    def detect(start, end):
+        calls.append(start)
+        if start == '60s' and calls.count('60s') == 1:
+            raise ValueError('window failed')
+        return [detection('00:00:05')]
+
+    with pytest.raises(ValueError):
+        analyze_in_chunks(detect, 0, 120, window_seconds=60, overlap_seconds=0, checkpoint=checkpoint, max_retries=0)
+    assert ChunkCheckpoint(checkpoint.path).get((0, 60)) is not None
+
+    # The rerun only analyzes the failed window, then drops the checkpoint
+    analyze_in_chunks(detect, 0, 120, window_seconds=60, overlap_seconds=0, checkpoint=checkpoint, max_retries=0)
+    assert sorted(calls) == ['0s', '60s', '60s']
+    assert not (tmp_path / 'checkpoint.json').exists()
+
+def test_checkpoint_is_ignored_when_the_cache_is_bypassed(tmp_path, monkeypatch):
+    checkpoint = ChunkCheckpoint(str(tmp_path / 'checkpoint.json'))
+    checkpoint.put((0, 60), [detection('00:00:05')])
+    monkeypatch.setattr(response_cache, 'bypass', True)
+    calls = []
+
+    def detect(start, end):
+        calls.append(start)
+        return []
+
+    analyze_in_chunks(detect, 0, 60, window_seconds=60, overlap_seconds=0, checkpoint=ChunkCheckpoint(checkpoint.path))
+    assert calls == ['0s']
@@ -0,0 +1,73 @@
+import json
+import cv2
+import numpy as np
+import pytest
+import genai_client
+import video_chunking
+from phash_index import PerceptualHashIndex
+from replay_client import ReplayClient
+from response_cache import response_cache
+from video_file_detection import analyze_video, detect_dark_patterns
+
+REPLY = json.dumps([
+    {'timestamp': '00:00:40', 'type': 'Nagging', 'description': '', 'bounding_box': [0, 0, 500, 500], 'confidence': 80},
+    {'timestamp': '00:00:55', 'type': 'Sneaking', 'description': '', 'bounding_box': [0, 0, 500, 500], 'confidence': 80},
+])
+
+@pytest.fixture
+def replay(tmp_path, monkeypatch):
+    monkeypatch.setattr(response_cache, 'cache_dir', str(tmp_path / 'responses'))
+    monkeypatch.setattr(video_chunking, 'CHECKPOINT_DIR', str(tmp_path / 'chunks'))
+    genai_client.set_client(ReplayClient({'video': [REPLY], 'segmentation': ['[]']}))
+    yield
+    genai_client.set_client(None)
+
+@pytest.fixture
+def video_path(tmp_path):
+    path = str(tmp_path / 'video.mp4')
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), 2, (32, 24))
+    for i in range(2 * 100):
+        writer.write(np.full((24, 32, 3), i, np.uint8))
+    writer.release()
+    return path
+
+def frames_saved(output_dir):
+    sidecars = sorted(output_dir.glob('*.json'))
+    return [(json.loads(path.read_text())['frame_index'], path.stem) for path in sidecars]
+
+def test_chunked_and_unchunked_runs_agree_on_the_same_reply(replay, video_path, tmp_path):
+    whole = analyze_video(video_path, '30s', '90s', output_dir=str(tmp_path / 'whole'))
+    # One 60s window; both times would also fit in it as clip time
+    chunked = analyze_video(video_path, '30s', '90s', chunk_seconds=60, output_dir=str(tmp_path / 'chunked'))
+
+    assert [item.timestamp for item in chunked] == [item.timestamp for item in whole] == ['00:00:40', '00:00:55']
+    assert frames_saved(tmp_path / 'chunked') == frames_saved(tmp_path / 'whole') == [
+        (80, 'file_video_frame_00-00-40'), (110, 'file_video_frame_00-00-55'),
+    ]
+
+def write_scenes(path, scenes, seconds_each=3, fps=2):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (64, 48))
+    for scene in scenes:
+        for _ in range(seconds_each * fps):
+            writer.write(scene)
+    writer.release()
+    return path
+
+def test_keyframes_reuse_detections_of_near_duplicates_across_videos(replay, tmp_path):
+    rng = np.random.default_rng(0)
+    first, second = (np.repeat(np.repeat(rng.integers(0, 256, (6, 8, 3), dtype=np.uint8), 8, 0), 8, 1) for _ in range(2))
+    video_a = write_scenes(str(tmp_path / 'a.mp4'), [first, second])
+    video_b = write_scenes(str(tmp_path / 'b.mp4'), [second, first])
+    genai_client.set_client(ReplayClient({'video': [json.dumps([
+        {'timestamp': '00:00:03', 'type': 'Nagging', 'description': '', 'bounding_box': [0, 0, 500, 500], 'confidence': 80},
+    ])], 'segmentation': ['[]']}))
+    index = PerceptualHashIndex(None)
+
+    requests = response_cache.stats.misses
+    items = detect_dark_patterns(video_a, '0s', '6s', keyframes_only=True, dedupe_index=index)
+    assert [(item.timestamp, item.type) for item in items] == [('00:00:03', 'Nagging')]
+
+    # Both screens were seen in the first video: no request, and the detection moves to this video's time
+    items = detect_dark_patterns(video_b, '0s', '6s', keyframes_only=True, dedupe_index=index)
+    assert [(item.timestamp, item.type) for item in items] == [('00:00:00', 'Nagging')]
+    assert response_cache.stats.misses - requests == 1
@@ -0,0 +1,84 @@
+import json
+import shutil
+import sys
+import threading
+import types
+import cv2
+import numpy as np
+import pytest
+import genai_client
+from replay_client import ReplayResponse
+from response_cache import response_cache
+from video_youtube_detection import analyze_youtube_video
+
+URL = 'https://www.youtube.com/watch?v=abc123&ab_channel=test'
+REPLY = json.dumps([
+    {'timestamp': '00:00:02', 'type': 'Nagging', 'description': '', 'bounding_box': [0, 0, 500, 500], 'confidence': 80},
+])
+
+class FakeYoutubeDL:
+    """Stands in for `yt_dlp.YoutubeDL`, copying a local video to the output template."""
+    source = None
+    downloads = []
+    barrier = None
+
+    def __init__(self, options):
+        self.options = options
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def download(self, urls):
+        if self.barrier is not None:
+            # Only passes while the model request is in flight too
+            self.barrier.wait()
+        self.downloads.append(urls)
+        shutil.copy(self.source, self.options['outtmpl'])
+
+class FakeModels:
+    def __init__(self):
+        self.calls = 0
+
+    def generate_content(self, model, contents, config=None):
+        self.calls += 1
+        if FakeYoutubeDL.barrier is not None:
+            FakeYoutubeDL.barrier.wait()
+        return ReplayResponse(REPLY)
+
+@pytest.fixture
+def youtube(tmp_path, monkeypatch):
+    video = str(tmp_path / 'source.mp4')
+    writer = cv2.VideoWriter(video, cv2.VideoWriter_fourcc(*'mp4v'), 5, (32, 24))
+    for i in range(5 * 10):
+        writer.write(np.full((24, 32, 3), i, np.uint8))
+    writer.release()
+
+    fake_yt_dlp = types.SimpleNamespace(
+        YoutubeDL=FakeYoutubeDL, utils=types.SimpleNamespace(download_range_func=lambda chapters, ranges: ranges),
+    )
+    monkeypatch.setitem(sys.modules, 'yt_dlp', fake_yt_dlp)
+    monkeypatch.setattr(FakeYoutubeDL, 'source', video)
+    monkeypatch.setattr(FakeYoutubeDL, 'downloads', [])
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(response_cache, 'cache_dir', str(tmp_path / 'responses'))
+    client = types.SimpleNamespace(models=FakeModels())
+    genai_client.set_client(client)
+    yield client
+    genai_client.set_client(None)
+
+def test_download_overlaps_inference_and_the_section_is_cached(youtube, tmp_path, monkeypatch):
+    # Each side waits for the other, so this only finishes if they run at the same time
+    monkeypatch.setattr(FakeYoutubeDL, 'barrier', threading.Barrier(2, timeout=5))
+    items = analyze_youtube_video(URL, '0s', '10s', output_dir=str(tmp_path / 'first'))
+    assert [item.timestamp for item in items] == ['00:00:02']
+    assert len(FakeYoutubeDL.downloads) == 1
+    assert list((tmp_path / 'first').glob('video_frame_00-00-02.png'))
+
+    # The same section of the same video, under another URL form
+    monkeypatch.setattr(FakeYoutubeDL, 'barrier', None)
+    analyze_youtube_video('https://youtu.be/abc123', '0s', '10s', output_dir=str(tmp_path / 'second'))
+    assert len(FakeYoutubeDL.downloads) == 1
+    assert list((tmp_path / 'second').glob('video_frame_00-00-02.png'))